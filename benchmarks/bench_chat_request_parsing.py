@@ -0,0 +1,91 @@
+"""
+聊天请求体处理基准测试：对比完整校验模式、直接json.loads与原样透传模式的单请求CPU开销
+
+透传模式的扫描开销与字段顺序有关，因此分别测试model在messages之前（手写请求常见）和
+OpenAI SDK的顺序（messages在前，model、stream在后），以及带和不带stream字段的情况。
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_chat_request_parsing
+
+注意：导入gpt_proxy会加载config.ini并初始化data目录下的数据库。
+"""
+import json
+import time
+
+from gpt_proxy import schemas
+from gpt_proxy import utils
+
+PAYLOAD_SIZES = {"4KB": 4 * 1024, "64KB": 64 * 1024, "1MB": 1024 * 1024}
+# 请求体的字段顺序；不含stream字段时透传模式需扫描整个请求体确认其不存在
+PAYLOAD_LAYOUTS = {
+    "model在前": ("model", "temperature", "messages"),
+    "model在前+stream在后": ("model", "temperature", "messages", "stream"),
+    "SDK顺序": ("messages", "model", "temperature"),
+    "SDK顺序+stream": ("messages", "model", "stream", "temperature"),
+}
+FIELD_VALUES = {"model": "gpt-4o-mini", "temperature": 0, "stream": True}
+MESSAGE_CHUNK = "The quick brown fox jumps over the lazy dog. " * 20
+
+
+def build_payload(target_size: int, layout: tuple = PAYLOAD_LAYOUTS["model在前"]) -> bytes:
+    """按layout的字段顺序构造一个接近目标大小的多轮对话请求体"""
+    messages = []
+    payload = {field: messages if field == "messages" else FIELD_VALUES[field] for field in layout}
+    size = len(json.dumps(payload))
+    turn = 0
+    while size < target_size:
+        message = {"role": "user" if turn % 2 == 0 else "assistant", "content": MESSAGE_CHUNK}
+        messages.append(message)
+        size += len(json.dumps(message)) + 2
+        turn += 1
+    return json.dumps(payload).encode("utf-8")
+
+
+def validate_mode(raw_body: bytes) -> bytes:
+    """完整校验模式：Pydantic解析后重新序列化"""
+    request_data = schemas.OpenAIChatRequest.model_validate_json(raw_body)
+    payload = request_data.model_dump(exclude_none=True)
+    return json.dumps(payload).encode("utf-8")
+
+
+def json_loads_mode(raw_body: bytes) -> bytes:
+    """对照：只用json.loads完整解析后读取model和stream"""
+    payload = json.loads(raw_body)
+    payload.get("model"), payload.get("stream")
+    return raw_body
+
+
+def passthrough_mode(raw_body: bytes) -> bytes:
+    """透传模式：仅扫描model和stream字段"""
+    utils.sniff_chat_request_fields(raw_body)
+    return raw_body
+
+
+def measure_cpu_per_request(func, raw_body: bytes, min_seconds: float = 1.0) -> float:
+    """返回单次调用的平均CPU时间（微秒）"""
+    iterations = 0
+    start = time.process_time()
+    while True:
+        func(raw_body)
+        iterations += 1
+        elapsed = time.process_time() - start
+        if elapsed >= min_seconds:
+            return elapsed / iterations * 1_000_000
+
+
+def main():
+    print(f"{'字段顺序':<20}{'大小':<8}{'完整校验(µs)':>16}{'json.loads(µs)':>16}{'透传(µs)':>14}{'加速比':>10}")
+    for layout_label, layout in PAYLOAD_LAYOUTS.items():
+        for label, size in PAYLOAD_SIZES.items():
+            raw_body = build_payload(size, layout)
+            validate_us = measure_cpu_per_request(validate_mode, raw_body)
+            json_loads_us = measure_cpu_per_request(json_loads_mode, raw_body)
+            passthrough_us = measure_cpu_per_request(passthrough_mode, raw_body)
+            print(
+                f"{layout_label:<20}{label:<8}{validate_us:>16.1f}{json_loads_us:>16.1f}{passthrough_us:>14.1f}"
+                f"{validate_us / passthrough_us:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+密钥选取基准测试：测量不同密钥池规模下每秒可完成的选取次数和每个密钥占用的内存，并对比在选取路径上等待异步锁的开销
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_key_selection
+
+注意：导入gpt_proxy会加载config.ini并初始化data目录下的数据库。
+"""
+import asyncio
+import time
+import tracemalloc
+
+from gpt_proxy import key_scheduler
+
+POOL_SIZES = {"10": 10, "1k": 1_000, "100k": 100_000}
+
+
+def build_scheduler(key_count: int) -> key_scheduler.KeyScheduler:
+    """构造一个不限调用次数、包含key_count个密钥的调度器"""
+    scheduler = key_scheduler.KeyScheduler(capacity=0, window_seconds=0)
+    scheduler.set_keys([{"id": f"key-{index}", "api_key": f"sk-{index:048d}", "name": None} for index in range(key_count)])
+    return scheduler
+
+
+def measure_bytes_per_key(key_count: int) -> float:
+    """返回调度器中每个密钥的平均内存占用（字节，包含密钥字符串本身）"""
+    tracemalloc.start()
+    scheduler = build_scheduler(key_count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del scheduler
+    return current / key_count
+
+
+async def measure_selections_per_second(scheduler: key_scheduler.KeyScheduler, use_lock: bool, min_seconds: float = 1.0) -> float:
+    """在事件循环中连续选取密钥，返回每秒选取次数；use_lock模拟旧实现在每次选取前等待asyncio.Lock"""
+    lock = asyncio.Lock()
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(1000):
+            if use_lock:
+                async with lock:
+                    scheduler.acquire()
+            else:
+                scheduler.acquire()
+        iterations += 1000
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return iterations / elapsed
+
+
+async def run():
+    print(f"{'密钥数':<8}{'无锁(次/秒)':>16}{'加锁(次/秒)':>16}{'提升':>10}{'每密钥内存(B)':>16}")
+    for label, key_count in POOL_SIZES.items():
+        scheduler = build_scheduler(key_count)
+        lock_free = await measure_selections_per_second(scheduler, use_lock=False)
+        locked = await measure_selections_per_second(scheduler, use_lock=True)
+        bytes_per_key = measure_bytes_per_key(key_count)
+        print(f"{label:<8}{lock_free:>16,.0f}{locked:>16,.0f}{lock_free / locked:>9.2f}x{bytes_per_key:>16,.0f}")
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+准入控制模块
+
+限制全局并发的上游请求数。超出全局并发上限的请求进入有界FIFO等待队列，
+等待超过最大时间或队列已满时快速失败，返回503和Retry-After头，避免无限堆积协程。
+每个Key的在途请求数由key_scheduler统计和限制，所有Key都已满或额度耗尽时在这里有界地等待。
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from fastapi import HTTPException
+
+from . import config
+from . import key_scheduler
+from . import logger
+
+# 等待时间的指数加权移动平均系数
+WAIT_TIME_EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(HTTPException):
+    """准入控制拒绝请求（503，等待Key超过请求截止时间时为504），重试循环不应捕获后重试"""
+
+
+class AdmissionTicket:
+    """一次准入得到的全局并发名额，release可重复调用"""
+
+    __slots__ = ("_controller", "_released")
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release_slot()
+
+
+class AdmissionController:
+    """全局并发上限 + 有界FIFO等待队列 + 等待Key名额或额度恢复"""
+
+    def __init__(self, max_concurrent: int, max_queue_size: int, max_queue_wait: float, max_inflight_per_key: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue_size = max_queue_size
+        self.max_queue_wait = max_queue_wait
+        self.max_inflight_per_key = max_inflight_per_key
+
+        self.in_flight = 0
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.key_capacity_waits = 0
+        self.key_budget_waits = 0
+        self.rejected_key_budget = 0
+        self.wait_time_ewma = 0.0
+        self.wait_time_max = 0.0
+
+    # --- 全局并发 ---
+
+    async def admit(self) -> AdmissionTicket:
+        """获取一个全局并发名额，必要时在FIFO队列中等待；队列已满或等待超时时抛出503"""
+        if self.max_concurrent <= 0 or (self.in_flight < self.max_concurrent and not self._waiters):
+            self.in_flight += 1
+            self.admitted += 1
+            return AdmissionTicket(self)
+
+        if len(self._waiters) >= self.max_queue_size:
+            self.rejected_queue_full += 1
+            logger.warning(f"准入控制: 等待队列已满 ({self.max_queue_size})，拒绝请求。")
+            raise self._rejection("服务繁忙：等待队列已满，请稍后重试。")
+
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        wait_started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_queue_wait)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            logger.warning(f"准入控制: 请求排队超过 {self.max_queue_wait} 秒，拒绝请求。")
+            raise self._rejection("服务繁忙：排队等待超时，请稍后重试。")
+        except BaseException:
+            # 调用方被取消时，若名额已经移交给本请求则归还
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._record_wait_time(time.monotonic() - wait_started_at)
+
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _release_slot(self):
+        # 名额直接移交给队首仍在等待的请求，in_flight保持不变
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _record_wait_time(self, wait_seconds: float):
+        self.wait_time_ewma += WAIT_TIME_EWMA_ALPHA * (wait_seconds - self.wait_time_ewma)
+        self.wait_time_max = max(self.wait_time_max, wait_seconds)
+
+    def _rejection(self, detail: str, retry_after_seconds: Optional[float] = None) -> AdmissionRejected:
+        retry_after = max(1, math.ceil(self.wait_time_ewma if retry_after_seconds is None else retry_after_seconds))
+        return AdmissionRejected(status_code=503, detail=detail, headers={"Retry-After": str(retry_after)})
+
+    # --- 每个Key的在途请求 ---
+
+    async def wait_for_key_capacity(self, max_wait: Optional[float] = None):
+        """
+        所有Key的在途请求都已满时，等待调度器释放任意Key的名额（release）。
+
+        超过最大等待时间抛出503；max_wait（请求剩余的截止时间）更短时等到max_wait后直接返回，由调用方判断是否已超时。
+        """
+        self.key_capacity_waits += 1
+        timeout = self.max_queue_wait if max_wait is None else min(self.max_queue_wait, max_wait)
+        wait_started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(key_scheduler.scheduler.released_event().wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            if timeout < self.max_queue_wait:
+                return
+            self.rejected_timeout += 1
+            logger.warning(f"准入控制: 所有Key的在途请求均已达上限，等待超过 {self.max_queue_wait} 秒。")
+            raise self._rejection("服务繁忙：所有API Key的并发均已达上限，请稍后重试。")
+        finally:
+            self._record_wait_time(time.monotonic() - wait_started_at)
+
+    async def wait_for_key_budget(self, wait_seconds: float, max_wait: Optional[float] = None):
+        """
+        所有Key的调用额度都已耗尽时，在最大等待时间内等待最早恢复的Key，否则抛出503并给出Retry-After。
+
+        max_wait（请求剩余的截止时间）更短时只等待max_wait。
+        """
+        if wait_seconds > self.max_queue_wait:
+            self.rejected_key_budget += 1
+            logger.warning(f"准入控制: 所有Key的调用额度均已耗尽，最早 {wait_seconds:.1f} 秒后恢复。")
+            raise self._rejection("服务繁忙：所有API Key的调用额度均已耗尽，请稍后重试。", wait_seconds)
+        if max_wait is not None:
+            wait_seconds = min(wait_seconds, max_wait)
+        self.key_budget_waits += 1
+        await asyncio.sleep(wait_seconds)
+        self._record_wait_time(wait_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent_requests": self.max_concurrent,
+            "max_queue_size": self.max_queue_size,
+            "max_queue_wait_seconds": self.max_queue_wait,
+            "max_inflight_per_key": self.max_inflight_per_key,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "key_capacity_waits": self.key_capacity_waits,
+            "key_budget_waits": self.key_budget_waits,
+            "rejected_key_budget": self.rejected_key_budget,
+            "wait_time_ewma_ms": round(self.wait_time_ewma * 1000, 1),
+            "wait_time_max_ms": round(self.wait_time_max * 1000, 1),
+            "key_in_flight": key_scheduler.scheduler.in_flight_by_key(),
+        }
+
+
+controller = AdmissionController(
+    max_concurrent=config.ADMISSION_MAX_CONCURRENT_REQUESTS,
+    max_queue_size=config.ADMISSION_MAX_QUEUE_SIZE,
+    max_queue_wait=config.ADMISSION_MAX_QUEUE_WAIT_SECONDS,
+    max_inflight_per_key=config.ADMISSION_MAX_INFLIGHT_PER_KEY,
+)
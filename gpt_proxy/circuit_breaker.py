@@ -0,0 +1,176 @@
+"""
+上游端点熔断模块
+
+连接/超时等传输错误以及网关类错误（502/503/504）是上游端点（或本机出口网络）的问题，而不是某个Key的问题，
+因此按端点（scheme://host:port）计数，不再冷却或停用当前Key。每个端点一个熔断器：
+
+- closed：正常放行，连续失败次数达到阈值后进入open；
+- open：直接快速失败（503和Retry-After），不消耗重试次数和Key，open_seconds后进入half_open；
+- half_open：只放行少量探测请求，探测成功回到closed，失败重新进入open。
+
+收到上游的任何其他响应（包括4xx）都说明端点可达，视为成功。
+"""
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from . import config
+from . import logger
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 视为端点故障的上游状态码
+ENDPOINT_FAULT_STATUS_CODES = {502, 503, 504}
+
+
+class CircuitOpen(HTTPException):
+    """端点熔断中，快速失败（503）；选择上游时抛出则直接返回给客户端，发送前抛出则换一个上游重试"""
+
+
+def endpoint_of(url: str) -> str:
+    """返回URL所属的端点（scheme://host:port），同一主机上的不同接口共享熔断状态"""
+    parsed = httpx.URL(url)
+    port = f":{parsed.port}" if parsed.port else ""
+    return f"{parsed.scheme}://{parsed.host}{port}"
+
+
+class CircuitBreaker:
+    """单个上游端点的熔断器"""
+
+    def __init__(self, endpoint: str, failure_threshold: int, open_seconds: float, half_open_max_probes: int):
+        self.endpoint = endpoint
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.half_open_max_probes = max(1, half_open_max_probes)
+
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.last_probe_at = 0.0
+
+        self.opens = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def _current_state(self, now: float) -> str:
+        if self.state == STATE_OPEN and now >= self.opened_at + self.open_seconds:
+            self.state = STATE_HALF_OPEN
+            self.probes_in_flight = 0
+            logger.info(f"上游端点 {self.endpoint} 熔断到期，进入半开状态，放行探测请求。")
+        return self.state
+
+    def is_available(self) -> bool:
+        """不占用半开状态的探测名额，判断当前是否会放行请求"""
+        now = time.monotonic()
+        state = self._current_state(now)
+        if state == STATE_HALF_OPEN:
+            return self.probes_in_flight < self.half_open_max_probes or now - self.last_probe_at > self.open_seconds
+        return state == STATE_CLOSED
+
+    def allow_request(self) -> bool:
+        """是否放行一次上游请求；半开状态下放行的请求作为探测，其结果决定是否恢复"""
+        now = time.monotonic()
+        state = self._current_state(now)
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_HALF_OPEN:
+            # 探测请求没有报告结果（例如客户端断开）时，超过open_seconds后允许新的探测
+            if self.probes_in_flight > 0 and now - self.last_probe_at > self.open_seconds:
+                self.probes_in_flight = 0
+            if self.probes_in_flight < self.half_open_max_probes:
+                self.probes_in_flight += 1
+                self.last_probe_at = now
+                return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> float:
+        """距离下一次允许探测的剩余秒数"""
+        now = time.monotonic()
+        if self._current_state(now) == STATE_OPEN:
+            return max(0.0, self.opened_at + self.open_seconds - now)
+        return max(0.0, self.last_probe_at + self.open_seconds - now) if self.state == STATE_HALF_OPEN else 0.0
+
+    def record_success(self):
+        """上游返回了响应（端点可达）"""
+        self.consecutive_failures = 0
+        if self.state == STATE_HALF_OPEN:
+            self.state = STATE_CLOSED
+            self.probes_in_flight = 0
+            logger.info(f"上游端点 {self.endpoint} 探测成功，熔断器恢复为关闭状态。")
+
+    def record_failure(self):
+        """传输错误或网关类错误"""
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or (
+            self.state == STATE_CLOSED and self.consecutive_failures >= self.failure_threshold
+        ):
+            self.state = STATE_OPEN
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+            self.opens += 1
+            logger.warning(
+                f"上游端点 {self.endpoint} 连续失败 {self.consecutive_failures} 次，熔断 {self.open_seconds} 秒。"
+            )
+
+    def record_status(self, status_code: int):
+        """按上游响应状态码记录结果"""
+        if status_code in ENDPOINT_FAULT_STATUS_CODES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self._current_state(time.monotonic()),
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after_seconds": round(self.retry_after(), 3),
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "failures": self.failures,
+        }
+
+
+class CircuitBreakerRegistry:
+    """按端点保存熔断器；未开启时get返回None（总是放行）"""
+
+    def __init__(self, enabled: bool, failure_threshold: int, open_seconds: float, half_open_max_probes: int):
+        self.enabled = enabled
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_probes = half_open_max_probes
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> Optional[CircuitBreaker]:
+        """返回URL所属端点的熔断器，未开启熔断时返回None"""
+        if not self.enabled:
+            return None
+        endpoint = endpoint_of(url)
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint, self.failure_threshold, self.open_seconds, self.half_open_max_probes)
+            self._breakers[endpoint] = breaker
+        return breaker
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "failure_threshold": self.failure_threshold,
+            "open_seconds": self.open_seconds,
+            "half_open_max_probes": self.half_open_max_probes,
+            "endpoints": {endpoint: breaker.stats() for endpoint, breaker in self._breakers.items()},
+        }
+
+
+breakers = CircuitBreakerRegistry(
+    enabled=config.CIRCUIT_BREAKER_ENABLED,
+    failure_threshold=config.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    open_seconds=config.CIRCUIT_BREAKER_OPEN_SECONDS,
+    half_open_max_probes=config.CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES,
+)
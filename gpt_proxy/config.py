@@ -1,6 +1,6 @@
 import os
 import configparser
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from . import logger
 
 # 密钥状态常量
@@ -16,6 +16,16 @@ DB_CONNECTION_PARAMS = {}  # 默认连接参数为空
 OPENAI_API_ENDPOINT: str = "https://api.openai.com/v1/chat/completions"
 OPENAI_VALIDATION_ENDPOINT: str = "https://api.openai.com/v1/models"
 
+# 多上游配置：每个 [Upstream:名称] 部分定义一个上游（name、chat_completions_url、models_url、weight、models、model_map），
+# 没有定义时[OpenAI_Endpoints]作为名为default的唯一上游
+DEFAULT_UPSTREAM_NAME = "default"
+UPSTREAM_SECTION_PREFIX = "Upstream:"
+UPSTREAMS: List[Dict[str, Any]] = []
+UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS: float = 0.0  # 主动健康检查间隔，0表示不检查
+UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS: float = 5.0
+UPSTREAM_UNHEALTHY_THRESHOLD: int = 2  # 连续检查失败达到该次数后标记为不健康
+UPSTREAM_HEALTHY_THRESHOLD: int = 1  # 不健康的上游连续检查成功达到该次数后恢复
+
 # 代理认证
 PROXY_API_KEYS: List[str] = []
 PROXY_API_KEY_HEADER: str = "X-Proxy-API-Key"
@@ -28,23 +38,180 @@ JWT_ACCESS_TOKEN_EXPIRE_MINUTES: int = 60  # 1小时
 # 应用配置
 APP_CONFIG_MAX_RETRIES: int = 5
 APP_LOG_LEVEL: str = "info"  # 默认日志级别
+APP_REQUEST_VALIDATION: bool = False  # 是否对聊天请求进行完整的Pydantic校验（默认原样透传请求体）
 
 # OpenAI API 密钥轮换配置
 MAX_CALLS_PER_KEY_PER_WINDOW: int = 1000
 USAGE_WINDOW_SECONDS: int = 3600  # 1小时
-# 查询活跃API密钥时返回的最大数量
-MAX_ACTIVE_KEYS_LIMIT: int = 100
+# 密钥池中活跃API密钥的最大数量（0表示不限制，调度全部活跃密钥）
+MAX_ACTIVE_KEYS_LIMIT: int = 0
+
+# 重试策略配置
+RETRY_REQUEST_DEADLINE_SECONDS: float = 120.0  # 单个请求所有尝试共享的总截止时间
+RETRY_BACKOFF_BASE_SECONDS: float = 0.1
+RETRY_BACKOFF_MAX_SECONDS: float = 2.0
+# 上游默认超时（秒）：连接、读取（等待响应/首个流事件）、流式空闲（相邻数据块间隔）
+UPSTREAM_CONNECT_TIMEOUT: float = 5.0
+UPSTREAM_READ_TIMEOUT: float = 30.0
+UPSTREAM_IDLE_TIMEOUT: float = 30.0
+# 按模型覆盖的超时设置: 模型名（或以*结尾的前缀） -> (connect, read, idle)
+MODEL_TIMEOUTS: Dict[str, Tuple[float, float, float]] = {}
+
+# 响应缓存配置（默认关闭）
+RESPONSE_CACHE_ENABLED: bool = False
+RESPONSE_CACHE_MAX_ENTRIES: int = 1000
+RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+RESPONSE_CACHE_TTL_SECONDS: float = 3600.0
+RESPONSE_CACHE_PERSIST: bool = False  # 是否持久化到数据库
+RESPONSE_CACHE_DETERMINISTIC_ONLY: bool = True  # 仅缓存temperature=0的请求
+
+# 在途请求合并配置（默认关闭）
+COALESCING_ENABLED: bool = False
+COALESCING_DETERMINISTIC_ONLY: bool = True  # 仅合并temperature=0的请求
+COALESCING_STREAM_FANOUT: bool = False  # 是否将一个上游流扇出给多个相同的流式请求
+COALESCING_STREAM_REPLAY_MAX_BYTES: int = 1024 * 1024  # 扇出的流超过该字节数后不再接受新的订阅者，并丢弃所有订阅者都已读取的数据块
+COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS: float = 30.0  # 订阅者有待读数据却超过该时间未读取时断开该订阅者
+
+# /v1/models 模型列表缓存配置
+MODELS_CACHE_ENABLED: bool = True
+MODELS_CACHE_TTL_SECONDS: float = 300.0
+MODELS_CACHE_REFRESH_AHEAD_SECONDS: float = 60.0  # 距离过期不足该时间时在后台刷新
+
+# 准入控制配置（0表示不限制）
+ADMISSION_MAX_CONCURRENT_REQUESTS: int = 256  # 全局并发的上游请求数上限
+ADMISSION_MAX_QUEUE_SIZE: int = 512  # 等待队列的最大长度，队列已满时直接返回503
+ADMISSION_MAX_QUEUE_WAIT_SECONDS: float = 10.0  # 请求在队列中的最长等待时间
+ADMISSION_MAX_INFLIGHT_PER_KEY: int = 0  # 每个Key的在途请求数上限
+
+# 基于上游x-ratelimit-*响应头的Key路由配置
+RATE_LIMIT_ROUTING_ENABLED: bool = True
+RATE_LIMIT_MIN_REMAINING_REQUESTS: int = 1  # 剩余请求数低于该值的Key在重置前不被选取
+RATE_LIMIT_MIN_REMAINING_TOKENS: int = 1  # 剩余Token数低于该值的Key在重置前不被选取
+RATE_LIMIT_ROUTING_CANDIDATES: int = 2  # 每次选取时比较剩余额度的候选Key数量
+
+# Key冷却配置：429和临时错误使Key在内存中冷却（指数退避），到期后自动恢复
+KEY_COOLDOWN_BASE_SECONDS: float = 1.0
+KEY_COOLDOWN_MAX_SECONDS: float = 300.0
+
+# Key选取策略配置
+KEY_SELECTION_POLICY_ROUND_ROBIN = "round_robin"
+KEY_SELECTION_POLICY_LEAST_LOADED = "least_loaded"
+KEY_SELECTION_POLICY: str = KEY_SELECTION_POLICY_ROUND_ROBIN
+KEY_SELECTION_CANDIDATES: int = 2  # least_loaded策略每次比较的候选Key数量
+KEY_SELECTION_EWMA_ALPHA: float = 0.3  # 延迟、首字节时间和错误率的指数加权移动平均系数
+KEY_SELECTION_DECAY_SECONDS: float = 30.0  # 长时间未被使用的Key的统计逐渐回归到全局平均值
+
+# Key可调用模型列表配置
+KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT: bool = False  # 是否通过每个Key的/v1/models响应学习其可调用的模型
+
+# Token用量统计配置
+TOKEN_USAGE_STREAM_INCLUDE_USAGE: bool = False  # 是否为流式请求注入stream_options.include_usage以获取Token用量
+TOKEN_USAGE_TPM_PER_KEY: int = 0  # 单个Key每分钟允许消耗的Token数（0表示不限制）
+
+# 上游端点熔断配置
+CIRCUIT_BREAKER_ENABLED: bool = True
+CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5  # 连续传输错误/网关错误达到该次数后熔断
+CIRCUIT_BREAKER_OPEN_SECONDS: float = 30.0  # 熔断持续时间，到期后放行探测请求
+CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES: int = 1  # 半开状态下同时放行的探测请求数
+
+# 内存密钥池的全量同步配置（增量更新的兜底）
+KEY_POOL_RESYNC_DEBOUNCE_SECONDS: float = 1.0  # 防抖时间内的多次同步请求只查询一次数据库
+KEY_POOL_RESYNC_INTERVAL_SECONDS: float = 300.0  # 定期全量同步的间隔，0表示不定期同步
+KEY_POOL_SYNC_POLL_INTERVAL_SECONDS: float = 2.0  # 多进程部署时检查数据库中密钥池版本号的间隔，0表示不检查
+KEY_POOL_SYNC_LISTEN: bool = True  # 使用PostgreSQL时是否LISTEN版本号变化通知（立即同步）
+KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES: int = 100  # 两次检查之间的变更超过该条数（批量修改）时全量同步，否则逐个Key增量更新
+
+# 多进程共享的Key计数器配置（同一台机器上的多个工作进程共同遵守每Key的调用次数和TPM上限）
+SHARED_COUNTERS_ENABLED: bool = False
+SHARED_COUNTERS_PATH: str = os.path.join(logger.DATA_DIR, "key_counters.bin")
+SHARED_COUNTERS_SLOTS: int = 4096  # 计数器表的槽位数（可容纳的Key数量）
+
+# 多节点Key租约配置（多个代理节点共用一个PostgreSQL数据库时平分每个Key的调用额度）
+KEY_LEASES_ENABLED: bool = False
+KEY_LEASES_NODE_ID: str = ""  # 节点ID，留空时自动生成
+KEY_LEASES_TTL_SECONDS: float = 30.0  # 租约有效期，节点异常退出后其他节点最迟在此时间后分得它的额度
+KEY_LEASES_RENEW_INTERVAL_SECONDS: float = 10.0  # 续约间隔，新节点加入或节点正常退出后其他节点在此时间内重新平分额度
+
+# 优雅关闭配置
+GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS: float = 30.0  # 收到SIGTERM后等待在途请求（包括流式响应）完成的最长时间
+
+# 使用记录批量写入配置
+USAGE_WRITER_FLUSH_INTERVAL_MS: int = 500  # 批量写入的时间间隔（毫秒）
+USAGE_WRITER_BATCH_SIZE: int = 200  # 每批最多写入的记录数，积累到该数量时立即写入
+USAGE_WRITER_MAX_PENDING: int = 100000  # 内存中待写入记录的上限，超出时丢弃最旧的记录
+
+# 上游HTTP客户端连接池配置
+HTTP_CLIENT_MAX_CONNECTIONS: int = 100
+HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS: int = 20
+HTTP_CLIENT_KEEPALIVE_EXPIRY: float = 30.0  # 秒
+HTTP_CLIENT_HTTP2: bool = True
 
 # 配置文件路径（在'gpt_proxy'包的父目录中）
-CONFIG_FILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "config.ini")
+CONFIG_FILE_PATH = os.path.join(logger.DATA_DIR, "config.ini")
+
+
+def _parse_upstream_section(name: str, section: configparser.SectionProxy) -> Optional[Dict[str, Any]]:
+    """
+    解析一个 [Upstream:名称] 部分，格式无效时返回None。
+
+    models为逗号分隔的模型列表（为空表示不限制）；model_map为逗号分隔的 "请求模型=上游模型" 映射。
+    """
+    chat_completions_url = section.get("chat_completions_url", "").strip()
+    if not name or not chat_completions_url:
+        logger.warning(f"[{UPSTREAM_SECTION_PREFIX}{name}] 缺少名称或chat_completions_url，已忽略。")
+        return None
+    models_value = section.get("models", "").strip()
+    model_map = {}
+    for pair in section.get("model_map", "").split(","):
+        if not pair.strip():
+            continue
+        requested_model, separator, upstream_model = pair.partition("=")
+        if not separator or not requested_model.strip() or not upstream_model.strip():
+            logger.warning(f"[{UPSTREAM_SECTION_PREFIX}{name}] 模型映射'{pair.strip()}'格式无效，已忽略。")
+            continue
+        model_map[requested_model.strip()] = upstream_model.strip()
+    return {
+        "name": name,
+        "chat_completions_url": chat_completions_url,
+        "models_url": section.get("models_url", "").strip() or chat_completions_url.rsplit("/chat/completions", 1)[0] + "/models",
+        "weight": max(0, section.getint("weight", 1)),
+        "models": [model.strip() for model in models_value.split(",") if model.strip()] if models_value else None,
+        "model_map": model_map,
+    }
 
 
 def load_app_config():
     """从config.ini文件加载应用配置"""
     global PROXY_API_KEYS, JWT_SECRET_KEY, JWT_ALGORITHM, JWT_ACCESS_TOKEN_EXPIRE_MINUTES, APP_CONFIG_MAX_RETRIES
     global OPENAI_API_ENDPOINT, OPENAI_VALIDATION_ENDPOINT, PROXY_API_KEY_HEADER
+    global UPSTREAMS, UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS, UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS
+    global UPSTREAM_UNHEALTHY_THRESHOLD, UPSTREAM_HEALTHY_THRESHOLD
     global MAX_CALLS_PER_KEY_PER_WINDOW, USAGE_WINDOW_SECONDS, MAX_ACTIVE_KEYS_LIMIT, DB_TYPE, DB_CONNECTION_PARAMS
-    global APP_LOG_LEVEL
+    global APP_LOG_LEVEL, APP_REQUEST_VALIDATION
+    global HTTP_CLIENT_MAX_CONNECTIONS, HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS, HTTP_CLIENT_KEEPALIVE_EXPIRY
+    global HTTP_CLIENT_HTTP2
+    global RETRY_REQUEST_DEADLINE_SECONDS, RETRY_BACKOFF_BASE_SECONDS, RETRY_BACKOFF_MAX_SECONDS
+    global UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT, UPSTREAM_IDLE_TIMEOUT, MODEL_TIMEOUTS
+    global RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS
+    global RESPONSE_CACHE_PERSIST, RESPONSE_CACHE_DETERMINISTIC_ONLY
+    global COALESCING_ENABLED, COALESCING_DETERMINISTIC_ONLY, COALESCING_STREAM_FANOUT
+    global COALESCING_STREAM_REPLAY_MAX_BYTES, COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS
+    global MODELS_CACHE_ENABLED, MODELS_CACHE_TTL_SECONDS, MODELS_CACHE_REFRESH_AHEAD_SECONDS
+    global ADMISSION_MAX_CONCURRENT_REQUESTS, ADMISSION_MAX_QUEUE_SIZE, ADMISSION_MAX_QUEUE_WAIT_SECONDS
+    global ADMISSION_MAX_INFLIGHT_PER_KEY
+    global USAGE_WRITER_FLUSH_INTERVAL_MS, USAGE_WRITER_BATCH_SIZE, USAGE_WRITER_MAX_PENDING
+    global RATE_LIMIT_ROUTING_ENABLED, RATE_LIMIT_MIN_REMAINING_REQUESTS, RATE_LIMIT_MIN_REMAINING_TOKENS
+    global RATE_LIMIT_ROUTING_CANDIDATES, KEY_COOLDOWN_BASE_SECONDS, KEY_COOLDOWN_MAX_SECONDS
+    global KEY_SELECTION_POLICY, KEY_SELECTION_CANDIDATES, KEY_SELECTION_EWMA_ALPHA, KEY_SELECTION_DECAY_SECONDS
+    global KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT
+    global TOKEN_USAGE_STREAM_INCLUDE_USAGE, TOKEN_USAGE_TPM_PER_KEY
+    global CIRCUIT_BREAKER_ENABLED, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS
+    global CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES
+    global KEY_POOL_RESYNC_DEBOUNCE_SECONDS, KEY_POOL_RESYNC_INTERVAL_SECONDS
+    global KEY_POOL_SYNC_POLL_INTERVAL_SECONDS, KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES, KEY_POOL_SYNC_LISTEN
+    global SHARED_COUNTERS_ENABLED, SHARED_COUNTERS_PATH, SHARED_COUNTERS_SLOTS
+    global KEY_LEASES_ENABLED, KEY_LEASES_NODE_ID, KEY_LEASES_TTL_SECONDS, KEY_LEASES_RENEW_INTERVAL_SECONDS
+    global GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS
 
     config_parser = configparser.ConfigParser()
     if not os.path.exists(CONFIG_FILE_PATH):
@@ -117,6 +284,12 @@ def load_app_config():
                 APP_LOG_LEVEL = "info"
             else:
                 logger.info(f"[App] log_level配置已加载: {APP_LOG_LEVEL}")
+
+            # 加载请求校验模式设置
+            APP_REQUEST_VALIDATION = config_parser["App"].getboolean("request_validation", APP_REQUEST_VALIDATION)
+            logger.info(
+                f"[App] request_validation配置已加载: {APP_REQUEST_VALIDATION} ({'完整校验' if APP_REQUEST_VALIDATION else '原样透传'})"
+            )
         else:
             logger.warning(
                 f"在 '{CONFIG_FILE_PATH}' 中未找到[App]部分。将使用默认配置。"
@@ -132,6 +305,31 @@ def load_app_config():
         else:
             logger.warning(f"在 '{CONFIG_FILE_PATH}' 中未找到[OpenAI_Endpoints]部分。将使用默认端点。")
 
+        # 加载多上游配置
+        UPSTREAMS = []
+        for section_name in config_parser.sections():
+            if not section_name.startswith(UPSTREAM_SECTION_PREFIX):
+                continue
+            upstream = _parse_upstream_section(section_name[len(UPSTREAM_SECTION_PREFIX):].strip(), config_parser[section_name])
+            if upstream is not None:
+                UPSTREAMS.append(upstream)
+        if UPSTREAMS:
+            logger.info(f"已加载 {len(UPSTREAMS)} 个上游: {', '.join(upstream['name'] for upstream in UPSTREAMS)}")
+        if "Upstreams" in config_parser:
+            upstreams_section = config_parser["Upstreams"]
+            UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS = upstreams_section.getfloat(
+                "health_check_interval_seconds", UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS
+            )
+            UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS = upstreams_section.getfloat(
+                "health_check_timeout_seconds", UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS
+            )
+            UPSTREAM_UNHEALTHY_THRESHOLD = upstreams_section.getint("unhealthy_threshold", UPSTREAM_UNHEALTHY_THRESHOLD)
+            UPSTREAM_HEALTHY_THRESHOLD = upstreams_section.getint("healthy_threshold", UPSTREAM_HEALTHY_THRESHOLD)
+            logger.info(
+                f"上游健康检查配置: 间隔={UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS}秒, 超时={UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS}秒, "
+                f"不健康阈值={UPSTREAM_UNHEALTHY_THRESHOLD}, 恢复阈值={UPSTREAM_HEALTHY_THRESHOLD}"
+            )
+
         # 加载OpenAI API密钥轮换配置
         if "OpenAI_API_Keys_Config" in config_parser:
             MAX_CALLS_PER_KEY_PER_WINDOW = config_parser["OpenAI_API_Keys_Config"].getint(
@@ -148,6 +346,250 @@ def load_app_config():
             )
         else:
             logger.warning(f"在 '{CONFIG_FILE_PATH}' 中未找到[OpenAI_API_Keys_Config]部分。将使用默认轮换配置。")
+
+        # 加载重试策略配置
+        if "Retry_Policy" in config_parser:
+            retry_section = config_parser["Retry_Policy"]
+            RETRY_REQUEST_DEADLINE_SECONDS = retry_section.getfloat(
+                "request_deadline_seconds", RETRY_REQUEST_DEADLINE_SECONDS
+            )
+            RETRY_BACKOFF_BASE_SECONDS = retry_section.getfloat("backoff_base_seconds", RETRY_BACKOFF_BASE_SECONDS)
+            RETRY_BACKOFF_MAX_SECONDS = retry_section.getfloat("backoff_max_seconds", RETRY_BACKOFF_MAX_SECONDS)
+            UPSTREAM_CONNECT_TIMEOUT = retry_section.getfloat("connect_timeout", UPSTREAM_CONNECT_TIMEOUT)
+            UPSTREAM_READ_TIMEOUT = retry_section.getfloat("read_timeout", UPSTREAM_READ_TIMEOUT)
+            UPSTREAM_IDLE_TIMEOUT = retry_section.getfloat("idle_timeout", UPSTREAM_IDLE_TIMEOUT)
+            logger.info(
+                f"重试策略配置: 总截止时间={RETRY_REQUEST_DEADLINE_SECONDS}秒, 退避基数={RETRY_BACKOFF_BASE_SECONDS}秒, 退避上限={RETRY_BACKOFF_MAX_SECONDS}秒, 超时(连接/读取/空闲)={UPSTREAM_CONNECT_TIMEOUT}/{UPSTREAM_READ_TIMEOUT}/{UPSTREAM_IDLE_TIMEOUT}秒"
+            )
+        else:
+            logger.warning(f"在 '{CONFIG_FILE_PATH}' 中未找到[Retry_Policy]部分。将使用默认重试策略。")
+
+        # 加载按模型覆盖的超时配置，格式: 模型名 = connect,read,idle
+        if "Model_Timeouts" in config_parser:
+            MODEL_TIMEOUTS = {}
+            for model_name, timeout_str in config_parser["Model_Timeouts"].items():
+                try:
+                    connect_timeout, read_timeout, idle_timeout = (float(part.strip()) for part in timeout_str.split(","))
+                except ValueError:
+                    logger.warning(f"[Model_Timeouts] 模型'{model_name}'的超时配置'{timeout_str}'格式无效，已忽略。")
+                    continue
+                MODEL_TIMEOUTS[model_name] = (connect_timeout, read_timeout, idle_timeout)
+            logger.info(f"已加载 {len(MODEL_TIMEOUTS)} 个模型的超时配置。")
+
+        # 加载响应缓存配置
+        if "Response_Cache" in config_parser:
+            cache_section = config_parser["Response_Cache"]
+            RESPONSE_CACHE_ENABLED = cache_section.getboolean("enabled", RESPONSE_CACHE_ENABLED)
+            RESPONSE_CACHE_MAX_ENTRIES = cache_section.getint("max_entries", RESPONSE_CACHE_MAX_ENTRIES)
+            RESPONSE_CACHE_MAX_BYTES = cache_section.getint("max_bytes", RESPONSE_CACHE_MAX_BYTES)
+            RESPONSE_CACHE_TTL_SECONDS = cache_section.getfloat("ttl_seconds", RESPONSE_CACHE_TTL_SECONDS)
+            RESPONSE_CACHE_PERSIST = cache_section.getboolean("persist", RESPONSE_CACHE_PERSIST)
+            RESPONSE_CACHE_DETERMINISTIC_ONLY = cache_section.getboolean(
+                "deterministic_only", RESPONSE_CACHE_DETERMINISTIC_ONLY
+            )
+            logger.info(
+                f"响应缓存配置: 启用={RESPONSE_CACHE_ENABLED}, 最大条目数={RESPONSE_CACHE_MAX_ENTRIES}, 最大字节数={RESPONSE_CACHE_MAX_BYTES}, TTL={RESPONSE_CACHE_TTL_SECONDS}秒, 持久化={RESPONSE_CACHE_PERSIST}, 仅确定性请求={RESPONSE_CACHE_DETERMINISTIC_ONLY}"
+            )
+
+        # 加载在途请求合并配置
+        if "Request_Coalescing" in config_parser:
+            coalescing_section = config_parser["Request_Coalescing"]
+            COALESCING_ENABLED = coalescing_section.getboolean("enabled", COALESCING_ENABLED)
+            COALESCING_DETERMINISTIC_ONLY = coalescing_section.getboolean(
+                "deterministic_only", COALESCING_DETERMINISTIC_ONLY
+            )
+            COALESCING_STREAM_FANOUT = coalescing_section.getboolean("stream_fanout", COALESCING_STREAM_FANOUT)
+            COALESCING_STREAM_REPLAY_MAX_BYTES = coalescing_section.getint(
+                "stream_replay_max_bytes", COALESCING_STREAM_REPLAY_MAX_BYTES
+            )
+            COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS = coalescing_section.getfloat(
+                "stream_subscriber_timeout_seconds", COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS
+            )
+            logger.info(
+                f"在途请求合并配置: 启用={COALESCING_ENABLED}, 仅确定性请求={COALESCING_DETERMINISTIC_ONLY}, 流式扇出={COALESCING_STREAM_FANOUT}, "
+                f"重放上限={COALESCING_STREAM_REPLAY_MAX_BYTES}字节, 订阅者超时={COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS}秒"
+            )
+
+        # 加载模型列表缓存配置
+        if "Models_Cache" in config_parser:
+            models_cache_section = config_parser["Models_Cache"]
+            MODELS_CACHE_ENABLED = models_cache_section.getboolean("enabled", MODELS_CACHE_ENABLED)
+            MODELS_CACHE_TTL_SECONDS = models_cache_section.getfloat("ttl_seconds", MODELS_CACHE_TTL_SECONDS)
+            MODELS_CACHE_REFRESH_AHEAD_SECONDS = models_cache_section.getfloat(
+                "refresh_ahead_seconds", MODELS_CACHE_REFRESH_AHEAD_SECONDS
+            )
+            logger.info(
+                f"模型列表缓存配置: 启用={MODELS_CACHE_ENABLED}, TTL={MODELS_CACHE_TTL_SECONDS}秒, 提前刷新={MODELS_CACHE_REFRESH_AHEAD_SECONDS}秒"
+            )
+
+        # 加载准入控制配置
+        if "Admission_Control" in config_parser:
+            admission_section = config_parser["Admission_Control"]
+            ADMISSION_MAX_CONCURRENT_REQUESTS = admission_section.getint(
+                "max_concurrent_requests", ADMISSION_MAX_CONCURRENT_REQUESTS
+            )
+            ADMISSION_MAX_QUEUE_SIZE = admission_section.getint("max_queue_size", ADMISSION_MAX_QUEUE_SIZE)
+            ADMISSION_MAX_QUEUE_WAIT_SECONDS = admission_section.getfloat(
+                "max_queue_wait_seconds", ADMISSION_MAX_QUEUE_WAIT_SECONDS
+            )
+            ADMISSION_MAX_INFLIGHT_PER_KEY = admission_section.getint(
+                "max_inflight_per_key", ADMISSION_MAX_INFLIGHT_PER_KEY
+            )
+            logger.info(
+                f"准入控制配置: 全局并发上限={ADMISSION_MAX_CONCURRENT_REQUESTS}, 队列长度={ADMISSION_MAX_QUEUE_SIZE}, 最长等待={ADMISSION_MAX_QUEUE_WAIT_SECONDS}秒, 每Key在途上限={ADMISSION_MAX_INFLIGHT_PER_KEY}"
+            )
+
+        # 加载基于上游限流头的Key路由配置
+        if "Rate_Limit_Routing" in config_parser:
+            rate_limit_section = config_parser["Rate_Limit_Routing"]
+            RATE_LIMIT_ROUTING_ENABLED = rate_limit_section.getboolean("enabled", RATE_LIMIT_ROUTING_ENABLED)
+            RATE_LIMIT_MIN_REMAINING_REQUESTS = rate_limit_section.getint(
+                "min_remaining_requests", RATE_LIMIT_MIN_REMAINING_REQUESTS
+            )
+            RATE_LIMIT_MIN_REMAINING_TOKENS = rate_limit_section.getint(
+                "min_remaining_tokens", RATE_LIMIT_MIN_REMAINING_TOKENS
+            )
+            RATE_LIMIT_ROUTING_CANDIDATES = rate_limit_section.getint("candidates", RATE_LIMIT_ROUTING_CANDIDATES)
+            logger.info(
+                f"上游限流头路由配置: 启用={RATE_LIMIT_ROUTING_ENABLED}, 最小剩余请求数={RATE_LIMIT_MIN_REMAINING_REQUESTS}, 最小剩余Token数={RATE_LIMIT_MIN_REMAINING_TOKENS}, 候选Key数={RATE_LIMIT_ROUTING_CANDIDATES}"
+            )
+
+        # 加载Key冷却配置
+        if "Key_Cooldown" in config_parser:
+            KEY_COOLDOWN_BASE_SECONDS = config_parser["Key_Cooldown"].getfloat("base_seconds", KEY_COOLDOWN_BASE_SECONDS)
+            KEY_COOLDOWN_MAX_SECONDS = config_parser["Key_Cooldown"].getfloat("max_seconds", KEY_COOLDOWN_MAX_SECONDS)
+            logger.info(f"Key冷却配置: 初始={KEY_COOLDOWN_BASE_SECONDS}秒, 上限={KEY_COOLDOWN_MAX_SECONDS}秒")
+
+        # 加载Key选取策略配置
+        if "Key_Selection" in config_parser:
+            key_selection_section = config_parser["Key_Selection"]
+            KEY_SELECTION_POLICY = key_selection_section.get("policy", KEY_SELECTION_POLICY).strip().lower()
+            valid_policies = [KEY_SELECTION_POLICY_ROUND_ROBIN, KEY_SELECTION_POLICY_LEAST_LOADED]
+            if KEY_SELECTION_POLICY not in valid_policies:
+                logger.warning(
+                    f"[Key_Selection] policy配置值('{KEY_SELECTION_POLICY}')无效。将使用默认值'{KEY_SELECTION_POLICY_ROUND_ROBIN}'。"
+                )
+                KEY_SELECTION_POLICY = KEY_SELECTION_POLICY_ROUND_ROBIN
+            KEY_SELECTION_CANDIDATES = key_selection_section.getint("candidates", KEY_SELECTION_CANDIDATES)
+            KEY_SELECTION_EWMA_ALPHA = key_selection_section.getfloat("ewma_alpha", KEY_SELECTION_EWMA_ALPHA)
+            KEY_SELECTION_DECAY_SECONDS = key_selection_section.getfloat("decay_seconds", KEY_SELECTION_DECAY_SECONDS)
+            logger.info(
+                f"Key选取策略配置: 策略={KEY_SELECTION_POLICY}, 候选Key数={KEY_SELECTION_CANDIDATES}, EWMA系数={KEY_SELECTION_EWMA_ALPHA}, 衰减时间={KEY_SELECTION_DECAY_SECONDS}秒"
+            )
+
+        # 加载Key可调用模型列表配置
+        if "Key_Models" in config_parser:
+            KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT = config_parser["Key_Models"].getboolean(
+                "learn_from_models_endpoint", KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT
+            )
+            logger.info(f"Key模型列表配置: 从/v1/models学习={KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT}")
+
+        # 加载Token用量统计配置
+        if "Token_Usage" in config_parser:
+            TOKEN_USAGE_STREAM_INCLUDE_USAGE = config_parser["Token_Usage"].getboolean(
+                "stream_include_usage", TOKEN_USAGE_STREAM_INCLUDE_USAGE
+            )
+            TOKEN_USAGE_TPM_PER_KEY = config_parser["Token_Usage"].getint("tpm_per_key", TOKEN_USAGE_TPM_PER_KEY)
+            logger.info(
+                f"Token用量配置: 流式注入include_usage={TOKEN_USAGE_STREAM_INCLUDE_USAGE}, 每Key每分钟Token上限={TOKEN_USAGE_TPM_PER_KEY}"
+            )
+
+        # 加载上游端点熔断配置
+        if "Circuit_Breaker" in config_parser:
+            circuit_breaker_section = config_parser["Circuit_Breaker"]
+            CIRCUIT_BREAKER_ENABLED = circuit_breaker_section.getboolean("enabled", CIRCUIT_BREAKER_ENABLED)
+            CIRCUIT_BREAKER_FAILURE_THRESHOLD = circuit_breaker_section.getint(
+                "failure_threshold", CIRCUIT_BREAKER_FAILURE_THRESHOLD
+            )
+            CIRCUIT_BREAKER_OPEN_SECONDS = circuit_breaker_section.getfloat("open_seconds", CIRCUIT_BREAKER_OPEN_SECONDS)
+            CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES = circuit_breaker_section.getint(
+                "half_open_max_probes", CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES
+            )
+            logger.info(
+                f"上游端点熔断配置: 开启={CIRCUIT_BREAKER_ENABLED}, 失败阈值={CIRCUIT_BREAKER_FAILURE_THRESHOLD}, "
+                f"熔断时间={CIRCUIT_BREAKER_OPEN_SECONDS}秒, 半开探测数={CIRCUIT_BREAKER_HALF_OPEN_MAX_PROBES}"
+            )
+
+        # 加载密钥池同步配置
+        if "Key_Pool" in config_parser:
+            KEY_POOL_RESYNC_DEBOUNCE_SECONDS = config_parser["Key_Pool"].getfloat(
+                "resync_debounce_seconds", KEY_POOL_RESYNC_DEBOUNCE_SECONDS
+            )
+            KEY_POOL_RESYNC_INTERVAL_SECONDS = config_parser["Key_Pool"].getfloat(
+                "resync_interval_seconds", KEY_POOL_RESYNC_INTERVAL_SECONDS
+            )
+            KEY_POOL_SYNC_POLL_INTERVAL_SECONDS = config_parser["Key_Pool"].getfloat(
+                "sync_poll_interval_seconds", KEY_POOL_SYNC_POLL_INTERVAL_SECONDS
+            )
+            KEY_POOL_SYNC_LISTEN = config_parser["Key_Pool"].getboolean("sync_listen", KEY_POOL_SYNC_LISTEN)
+            KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES = config_parser["Key_Pool"].getint(
+                "sync_max_incremental_changes", KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES
+            )
+            logger.info(
+                f"密钥池同步配置: 防抖={KEY_POOL_RESYNC_DEBOUNCE_SECONDS}秒, 定期同步间隔={KEY_POOL_RESYNC_INTERVAL_SECONDS}秒, "
+                f"版本号检查间隔={KEY_POOL_SYNC_POLL_INTERVAL_SECONDS}秒, LISTEN={KEY_POOL_SYNC_LISTEN}, "
+                f"增量更新上限={KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES}条"
+            )
+
+        # 加载多进程共享Key计数器配置
+        if "Shared_Counters" in config_parser:
+            SHARED_COUNTERS_ENABLED = config_parser["Shared_Counters"].getboolean("enabled", SHARED_COUNTERS_ENABLED)
+            SHARED_COUNTERS_PATH = config_parser["Shared_Counters"].get("path", "").strip() or SHARED_COUNTERS_PATH
+            SHARED_COUNTERS_SLOTS = config_parser["Shared_Counters"].getint("slots", SHARED_COUNTERS_SLOTS)
+            logger.info(
+                f"共享Key计数器配置: 启用={SHARED_COUNTERS_ENABLED}, 文件={SHARED_COUNTERS_PATH}, 槽位数={SHARED_COUNTERS_SLOTS}"
+            )
+
+        # 加载多节点Key租约配置
+        if "Key_Leases" in config_parser:
+            key_leases_section = config_parser["Key_Leases"]
+            KEY_LEASES_ENABLED = key_leases_section.getboolean("enabled", KEY_LEASES_ENABLED)
+            KEY_LEASES_NODE_ID = key_leases_section.get("node_id", KEY_LEASES_NODE_ID).strip()
+            KEY_LEASES_TTL_SECONDS = key_leases_section.getfloat("ttl_seconds", KEY_LEASES_TTL_SECONDS)
+            KEY_LEASES_RENEW_INTERVAL_SECONDS = key_leases_section.getfloat(
+                "renew_interval_seconds", KEY_LEASES_RENEW_INTERVAL_SECONDS
+            )
+            logger.info(
+                f"多节点Key租约配置: 启用={KEY_LEASES_ENABLED}, 节点ID={KEY_LEASES_NODE_ID or '自动'}, "
+                f"有效期={KEY_LEASES_TTL_SECONDS}秒, 续约间隔={KEY_LEASES_RENEW_INTERVAL_SECONDS}秒"
+            )
+
+        # 加载优雅关闭配置
+        if "Graceful_Shutdown" in config_parser:
+            GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS = config_parser["Graceful_Shutdown"].getfloat(
+                "drain_timeout_seconds", GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS
+            )
+            logger.info(f"优雅关闭配置: 等待在途请求完成的最长时间={GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS}秒")
+
+        # 加载使用记录批量写入配置
+        if "Usage_Writer" in config_parser:
+            usage_writer_section = config_parser["Usage_Writer"]
+            USAGE_WRITER_FLUSH_INTERVAL_MS = usage_writer_section.getint(
+                "flush_interval_ms", USAGE_WRITER_FLUSH_INTERVAL_MS
+            )
+            USAGE_WRITER_BATCH_SIZE = usage_writer_section.getint("batch_size", USAGE_WRITER_BATCH_SIZE)
+            USAGE_WRITER_MAX_PENDING = usage_writer_section.getint("max_pending", USAGE_WRITER_MAX_PENDING)
+            logger.info(
+                f"使用记录批量写入配置: 间隔={USAGE_WRITER_FLUSH_INTERVAL_MS}ms, 每批={USAGE_WRITER_BATCH_SIZE}, 队列上限={USAGE_WRITER_MAX_PENDING}"
+            )
+
+        # 加载上游HTTP客户端连接池配置
+        if "HTTP_Client" in config_parser:
+            HTTP_CLIENT_MAX_CONNECTIONS = config_parser["HTTP_Client"].getint(
+                "max_connections", HTTP_CLIENT_MAX_CONNECTIONS
+            )
+            HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS = config_parser["HTTP_Client"].getint(
+                "max_keepalive_connections", HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS
+            )
+            HTTP_CLIENT_KEEPALIVE_EXPIRY = config_parser["HTTP_Client"].getfloat(
+                "keepalive_expiry", HTTP_CLIENT_KEEPALIVE_EXPIRY
+            )
+            HTTP_CLIENT_HTTP2 = config_parser["HTTP_Client"].getboolean("http2", HTTP_CLIENT_HTTP2)
+            logger.info(
+                f"HTTP客户端配置: 最大连接数={HTTP_CLIENT_MAX_CONNECTIONS}, 最大keep-alive连接数={HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS}, keep-alive过期={HTTP_CLIENT_KEEPALIVE_EXPIRY}秒, HTTP/2={HTTP_CLIENT_HTTP2}"
+            )
+        else:
+            logger.warning(f"在 '{CONFIG_FILE_PATH}' 中未找到[HTTP_Client]部分。将使用默认连接池配置。")
             
         # 加载数据库配置
         if "Database" in config_parser:
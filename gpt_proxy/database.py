@@ -1,7 +1,7 @@
 """
 数据库连接池和操作模块
 """
-import os
+import json
 import uuid
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any, TypeVar
@@ -9,15 +9,16 @@ from pathlib import Path
 import urllib.parse
 
 from databases import Database
-from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, DateTime, select, func
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, Float, DateTime, LargeBinary, Text, select, func, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import logger
 from .config import DB_TYPE, DB_CONNECTION_PARAMS, MAX_ACTIVE_KEYS_LIMIT
 
 # 数据库路径
-DATA_DIR = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).joinpath("data")
-DATA_DIR.mkdir(exist_ok=True)
+DATA_DIR = Path(logger.DATA_DIR)
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 DATABASE_NAME = str(DATA_DIR.joinpath("gpt_proxy.db"))
 
 # 构建数据库连接URL
@@ -44,6 +45,11 @@ openai_keys = Table(
     Column("last_used_at", DateTime, nullable=True),
     Column("name", String, nullable=True),
     Column("total_requests", Integer, nullable=False, default=0),
+    Column("models", Text, nullable=True),  # 该Key可调用的模型列表（JSON数组），NULL表示不限制
+    Column("total_prompt_tokens", Integer, nullable=True, default=0),
+    Column("total_completion_tokens", Integer, nullable=True, default=0),
+    Column("total_cached_tokens", Integer, nullable=True, default=0),
+    Column("upstream", String, nullable=True),  # 该Key绑定的上游名称，NULL表示可用于任何上游
 )
 
 # 定义API请求日志表
@@ -55,6 +61,56 @@ api_request_logs = Table(
     Column("timestamp", DateTime, nullable=False),
     Column("model", String, nullable=True),
     Column("status", String, nullable=True),
+    Column("prompt_tokens", Integer, nullable=True),  # 上游未返回用量时为NULL
+    Column("completion_tokens", Integer, nullable=True),
+    Column("cached_tokens", Integer, nullable=True),
+)
+
+# 定义响应缓存表（用于持久化精确匹配的响应缓存）
+response_cache = Table(
+    "response_cache",
+    metadata,
+    Column("cache_key", String, primary_key=True),
+    Column("body", LargeBinary, nullable=False),
+    Column("headers", Text, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+)
+
+# 定义密钥池版本表（只有一行）：每次修改openai_keys中影响密钥池的字段时版本号加一，
+# 多个工作进程据此判断是否需要从数据库重新同步内存中的密钥池
+key_pool_state = Table(
+    "key_pool_state",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False, default=0),
+    Column("updated_at", DateTime, nullable=True),
+)
+KEY_POOL_STATE_ROW_ID = 1
+KEY_POOL_NOTIFY_CHANNEL = "gpt_proxy_key_pool"  # PostgreSQL下版本号变化时发送的NOTIFY通道
+
+# 定义密钥池变更记录表：单个Key的修改在版本号加一的同一事务中记录一行（版本号、Key ID、新状态），
+# 其他工作进程据此增量更新内存中的密钥池；缺少某个版本的记录时（已被清理）退回全量同步
+key_pool_changes = Table(
+    "key_pool_changes",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("key_id", String, nullable=False),
+    Column("status", String, nullable=True),  # Key的新状态，KEY_CHANGE_DELETED表示已删除，NULL表示其他字段（名称、模型、上游）变化
+    Column("created_at", DateTime, nullable=False),
+)
+KEY_CHANGE_DELETED = "deleted"
+KEY_POOL_CHANGES_RETENTION = 1000  # 保留最近的变更记录条数
+
+# 定义多节点Key租约表：每个代理节点一行，节点定期续约，未过期的节点平分每个Key的调用额度
+key_leases = Table(
+    "key_leases",
+    metadata,
+    Column("node_id", String, primary_key=True),
+    Column("share", Float, nullable=False, default=1.0),  # 该节点当前使用的额度份额
+    Column("acquired_at", DateTime, nullable=False),
+    Column("renewed_at", DateTime, nullable=False),
+    Column("expires_at", DateTime, nullable=False),
 )
 
 # 创建基类
@@ -86,16 +142,171 @@ async def disconnect_from_db():
     except Exception as e:
         logger.error(f"断开数据库连接失败: {str(e)}")
 
+def _add_missing_columns():
+    """为已存在的表补充后来新增的可空列（create_all不会修改已存在的表）"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"已为表 {table.name} 添加列 {column.name} ({column_type})。")
+
+def _ensure_key_pool_state_row():
+    """插入密钥池版本行（如果不存在）；多个工作进程同时启动时只有一个插入成功"""
+    with engine.begin() as connection:
+        exists = connection.execute(
+            select(key_pool_state.c.id).where(key_pool_state.c.id == KEY_POOL_STATE_ROW_ID)
+        ).first()
+    if exists is not None:
+        return
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                key_pool_state.insert().values(id=KEY_POOL_STATE_ROW_ID, version=0, updated_at=datetime.now())
+            )
+    except IntegrityError:
+        pass
+
 def init_db():
-    """初始化数据库，创建表（如果不存在）"""
+    """初始化数据库，创建表（如果不存在）并补充新增的列"""
     try:
         metadata.create_all(engine)
+        _add_missing_columns()
+        _ensure_key_pool_state_row()
         logger.info(f"数据库已初始化，如果不存在则创建了必要的表。使用数据库类型: {DB_TYPE}")
     except Exception as e:
         logger.error(f"初始化数据库失败: {str(e)}")
         raise
 
-async def add_api_key(api_key: str, name: Optional[str] = None, status: str = "active") -> str:
+def encode_key_models(models: Optional[List[str]]) -> Optional[str]:
+    """将Key的模型列表编码为数据库中保存的JSON文本，None表示不限制"""
+    if models is None:
+        return None
+    return json.dumps(sorted(set(models)), ensure_ascii=False)
+
+def decode_key_models(value: Optional[str]) -> Optional[List[str]]:
+    """解析数据库中保存的模型列表，NULL或无法解析时返回None（不限制）"""
+    if not value:
+        return None
+    try:
+        models = json.loads(value)
+    except ValueError:
+        logger.warning(f"无法解析API Key的模型列表: {value[:100]}")
+        return None
+    return [str(model) for model in models] if isinstance(models, list) else None
+
+def _key_row_to_dict(record) -> Dict[str, Any]:
+    key_data = dict(record)
+    if "models" in key_data:
+        key_data["models"] = decode_key_models(key_data["models"])
+    return key_data
+
+async def get_key_pool_version() -> int:
+    """获取密钥池版本号（按主键读取一行）。"""
+    query = select(key_pool_state.c.version).where(key_pool_state.c.id == KEY_POOL_STATE_ROW_ID)
+    version = await database.fetch_val(query)
+    return int(version or 0)
+
+async def bump_key_pool_version(key_id: Optional[str] = None, status: Optional[str] = None):
+    """
+    密钥池版本号加一，需要在修改Key的同一事务中调用（见_write_api_key），Key的修改和版本号一同提交或回滚。
+
+    给出key_id时同时记录该Key的变更（status为新状态、KEY_CHANGE_DELETED或None，见key_pool_changes），
+    其他进程只需增量更新这个Key；不给出时其他进程全量同步。
+    """
+    now = datetime.now()
+    query = key_pool_state.update().where(
+        key_pool_state.c.id == KEY_POOL_STATE_ROW_ID
+    ).values(version=key_pool_state.c.version + 1, updated_at=now)
+    await database.execute(query)
+    if key_id is not None:
+        version = await get_key_pool_version()
+        await database.execute(
+            key_pool_changes.insert().values(version=version, key_id=key_id, status=status, created_at=now)
+        )
+        await database.execute(
+            key_pool_changes.delete().where(key_pool_changes.c.version <= version - KEY_POOL_CHANGES_RETENTION)
+        )
+
+async def notify_key_pool_changed():
+    """使用PostgreSQL时发送NOTIFY，通知其他工作进程立即同步（在修改Key的事务提交后调用）。"""
+    if DB_TYPE not in ["postgresql", "postgres"]:
+        return
+    try:
+        await database.execute(
+            "SELECT pg_notify(:channel, '')", values={"channel": KEY_POOL_NOTIFY_CHANNEL}
+        )
+    except Exception as e:
+        # 其他进程最迟在下一次定期检查版本号时看到变化
+        logger.error(f"发送密钥池变更通知失败: {str(e)}")
+
+async def _write_api_key(query, key_id: str, status: Optional[str] = None):
+    """在一个事务中执行修改Key的语句并增加密钥池版本号，提交后通知其他工作进程；返回语句的执行结果。"""
+    async with database.transaction():
+        result = await database.execute(query)
+        await bump_key_pool_version(key_id, status)
+    await notify_key_pool_changed()
+    return result
+
+async def get_key_pool_changes(after_version: int, up_to_version: int) -> List[Dict[str, Any]]:
+    """获取版本号在 (after_version, up_to_version] 范围内的密钥池变更记录（按版本号排序）。"""
+    query = select(key_pool_changes.c.version, key_pool_changes.c.key_id, key_pool_changes.c.status).where(
+        key_pool_changes.c.version > after_version, key_pool_changes.c.version <= up_to_version
+    ).order_by(key_pool_changes.c.version)
+    return [dict(record) for record in await database.fetch_all(query)]
+
+async def renew_key_lease(node_id: str, ttl_seconds: float) -> List[str]:
+    """续约节点的Key租约（不存在或已被删除时重新创建），返回所有未过期租约的节点ID（按ID排序）。"""
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    await database.execute(
+        key_leases.update().where(key_leases.c.node_id == node_id).values(renewed_at=now, expires_at=expires_at)
+    )
+    query = select(key_leases.c.node_id).where(key_leases.c.expires_at > now).order_by(key_leases.c.node_id)
+    live_nodes = [record["node_id"] for record in await database.fetch_all(query)]
+    if node_id not in live_nodes:
+        try:
+            await database.execute(
+                key_leases.insert().values(
+                    node_id=node_id, share=1.0, acquired_at=now, renewed_at=now, expires_at=expires_at
+                )
+            )
+        except Exception:
+            # 同一节点ID的其他工作进程刚刚创建了租约
+            await database.execute(
+                key_leases.update().where(key_leases.c.node_id == node_id).values(renewed_at=now, expires_at=expires_at)
+            )
+        live_nodes = sorted(live_nodes + [node_id])
+    return live_nodes
+
+async def update_key_lease_share(node_id: str, share: float):
+    """记录节点当前使用的额度份额（仅用于展示）。"""
+    await database.execute(key_leases.update().where(key_leases.c.node_id == node_id).values(share=share))
+
+async def release_key_lease(node_id: str):
+    """节点退出时删除其租约，其他节点在下一次续约时分得它的额度。"""
+    await database.execute(key_leases.delete().where(key_leases.c.node_id == node_id))
+
+async def delete_expired_key_leases(older_than_seconds: float) -> int:
+    """删除过期时间早于 older_than_seconds 秒之前的租约（异常退出的节点留下的行），返回删除的数量。"""
+    cutoff = datetime.now() - timedelta(seconds=older_than_seconds)
+    count_query = select(func.count()).select_from(key_leases).where(key_leases.c.expires_at < cutoff)
+    count = await database.fetch_val(count_query) or 0
+    if count:
+        await database.execute(key_leases.delete().where(key_leases.c.expires_at < cutoff))
+    return count
+
+async def get_key_leases() -> List[Dict[str, Any]]:
+    """获取所有节点的Key租约。"""
+    results = await database.fetch_all(key_leases.select().order_by(key_leases.c.node_id))
+    return [dict(record) for record in results]
+
+async def add_api_key(
+    api_key: str, name: Optional[str] = None, status: str = "active", upstream: Optional[str] = None
+) -> str:
     """添加一个新的 API Key 到数据库。"""
     key_id = str(uuid.uuid4())
     created_at = datetime.now()
@@ -107,13 +318,14 @@ async def add_api_key(api_key: str, name: Optional[str] = None, status: str = "a
             status=status,
             created_at=created_at,
             name=name,
-            total_requests=0
+            total_requests=0,
+            upstream=upstream,
         )
-        await database.execute(query)
-        return key_id
+        await _write_api_key(query, key_id, status)
     except Exception as e:
         logger.error(f"添加API密钥失败: {str(e)}")
         raise ValueError(f"API密钥 {api_key} 已存在或添加失败。")
+    return key_id
 
 async def get_api_key_by_id(key_id: str) -> Optional[Dict[str, Any]]:
     """根据 ID 获取 API Key。"""
@@ -121,7 +333,7 @@ async def get_api_key_by_id(key_id: str) -> Optional[Dict[str, Any]]:
     result = await database.fetch_one(query)
     if result is None:
         return None
-    return dict(result)
+    return _key_row_to_dict(result)
 
 async def get_api_key_by_key_value(api_key_value: str) -> Optional[Dict[str, Any]]:
     """根据 API Key 的值获取 API Key。"""
@@ -129,13 +341,13 @@ async def get_api_key_by_key_value(api_key_value: str) -> Optional[Dict[str, Any
     result = await database.fetch_one(query)
     if result is None:
         return None
-    return dict(result)
+    return _key_row_to_dict(result)
 
 async def get_all_api_keys() -> List[Dict[str, Any]]:
     """获取所有 API Keys。"""
     query = openai_keys.select().order_by(openai_keys.c.created_at.desc())
     results = await database.fetch_all(query)
-    return [dict(record) for record in results]
+    return [_key_row_to_dict(record) for record in results]
 
 async def get_api_keys_paginated(
     page: int = 1, page_size: int = 10, status: Optional[str] = None
@@ -167,15 +379,32 @@ async def get_api_keys_paginated(
     ).limit(page_size).offset(offset)
     
     results = await database.fetch_all(query)
-    return [dict(record) for record in results], int(total_count)
+    return [_key_row_to_dict(record) for record in results], int(total_count)
 
 async def get_active_api_keys() -> List[Dict[str, Any]]:
-    """获取所有状态为 'active' 的 API Keys，最多返回配置的结果数量（默认200）。"""
-    query = openai_keys.select().where(
+    """
+    获取所有状态为 'active' 的 API Keys（只包含调度所需的id、api_key、name、models和upstream列），最久未使用的排在前面。
+
+    MAX_ACTIVE_KEYS_LIMIT大于0时最多返回该数量，否则返回全部活动Key。
+    """
+    query = select(
+        openai_keys.c.id, openai_keys.c.api_key, openai_keys.c.name, openai_keys.c.models, openai_keys.c.upstream
+    ).where(
         openai_keys.c.status == 'active'
-    ).order_by(openai_keys.c.last_used_at).limit(MAX_ACTIVE_KEYS_LIMIT)
+    ).order_by(openai_keys.c.last_used_at)
+    if MAX_ACTIVE_KEYS_LIMIT > 0:
+        query = query.limit(MAX_ACTIVE_KEYS_LIMIT)
     results = await database.fetch_all(query)
-    return [dict(record) for record in results]
+    return [_key_row_to_dict(record) for record in results]
+
+async def get_api_keys_for_pool(key_ids: List[str]) -> List[Dict[str, Any]]:
+    """获取指定ID的 API Keys（只包含调度所需的列和status），用于增量更新密钥池。"""
+    query = select(
+        openai_keys.c.id, openai_keys.c.api_key, openai_keys.c.name, openai_keys.c.models, openai_keys.c.upstream,
+        openai_keys.c.status,
+    ).where(openai_keys.c.id.in_(key_ids))
+    results = await database.fetch_all(query)
+    return [_key_row_to_dict(record) for record in results]
 
 async def get_inactive_api_keys() -> List[Dict[str, Any]]:
     """获取所有状态为 'inactive' 的 API Keys。"""
@@ -183,14 +412,14 @@ async def get_inactive_api_keys() -> List[Dict[str, Any]]:
         openai_keys.c.status == 'inactive'
     ).order_by(openai_keys.c.last_used_at)
     results = await database.fetch_all(query)
-    return [dict(record) for record in results]
+    return [_key_row_to_dict(record) for record in results]
 
 async def update_api_key_status(key_id: str, status: str) -> bool:
     """更新 API Key 的状态。"""
     query = openai_keys.update().where(
         openai_keys.c.id == key_id
     ).values(status=status)
-    result = await database.execute(query)
+    result = await _write_api_key(query, key_id, status)
     return result is not None
 
 async def update_api_key_last_used_at(key_id: str) -> bool:
@@ -206,13 +435,29 @@ async def update_api_key_name(key_id: str, name: str) -> bool:
     query = openai_keys.update().where(
         openai_keys.c.id == key_id
     ).values(name=name)
-    result = await database.execute(query)
+    result = await _write_api_key(query, key_id)
+    return result is not None
+
+async def update_api_key_models(key_id: str, models: Optional[List[str]]) -> bool:
+    """更新 API Key 可调用的模型列表，None表示不限制。"""
+    query = openai_keys.update().where(
+        openai_keys.c.id == key_id
+    ).values(models=encode_key_models(models))
+    result = await _write_api_key(query, key_id)
+    return result is not None
+
+async def update_api_key_upstream(key_id: str, upstream: Optional[str]) -> bool:
+    """更新 API Key 绑定的上游，None表示可用于任何上游。"""
+    query = openai_keys.update().where(
+        openai_keys.c.id == key_id
+    ).values(upstream=upstream)
+    result = await _write_api_key(query, key_id)
     return result is not None
 
 async def delete_api_key(key_id: str) -> bool:
     """删除 API Key。"""
     query = openai_keys.delete().where(openai_keys.c.id == key_id)
-    result = await database.execute(query)
+    result = await _write_api_key(query, key_id, KEY_CHANGE_DELETED)
     return result is not None
 
 async def increment_api_key_requests(key_id: str) -> bool:
@@ -255,6 +500,14 @@ async def get_api_stats() -> Dict[str, Any]:
         # 获取所有时间的请求总数(从openai_keys表的total_requests字段求和)
         total_all_time_query = select(func.sum(openai_keys.c.total_requests)).select_from(openai_keys)
         total_all_time = await database.fetch_val(total_all_time_query)
+
+        # 获取所有时间的Token总数(从openai_keys表的total_*_tokens字段求和)
+        token_totals_query = select(
+            func.sum(openai_keys.c.total_prompt_tokens).label("prompt_tokens"),
+            func.sum(openai_keys.c.total_completion_tokens).label("completion_tokens"),
+            func.sum(openai_keys.c.total_cached_tokens).label("cached_tokens"),
+        ).select_from(openai_keys)
+        token_totals = dict(await database.fetch_one(token_totals_query) or {})
         
         # 获取最近24小时的请求总数
         cutoff_24h = datetime.now() - timedelta(hours=24)
@@ -298,6 +551,9 @@ async def get_api_stats() -> Dict[str, Any]:
         
         return {
             "grand_total_requests_all_time": int(total_all_time) if total_all_time is not None else 0,
+            "grand_total_prompt_tokens_all_time": int(token_totals.get("prompt_tokens") or 0),
+            "grand_total_completion_tokens_all_time": int(token_totals.get("completion_tokens") or 0),
+            "grand_total_cached_tokens_all_time": int(token_totals.get("cached_tokens") or 0),
             "grand_total_usage_last_24h": int(total_24h) if total_24h is not None else 0,
             "grand_total_usage_last_1h": int(total_1h) if total_1h is not None else 0,
             "grand_total_usage_last_1m": int(total_1m) if total_1m is not None else 0,
@@ -310,6 +566,9 @@ async def get_api_stats() -> Dict[str, Any]:
         logger.error(f"获取API统计数据失败: {str(e)}")
         return {
             "grand_total_requests_all_time": 0,
+            "grand_total_prompt_tokens_all_time": 0,
+            "grand_total_completion_tokens_all_time": 0,
+            "grand_total_cached_tokens_all_time": 0,
             "grand_total_usage_last_24h": 0,
             "grand_total_usage_last_1h": 0,
             "grand_total_usage_last_1m": 0,
@@ -340,5 +599,68 @@ async def clean_old_api_request_logs(days_to_keep: int = 30) -> int:
         logger.error(f"清理旧API请求日志时出错: {str(e)}")
         return 0
 
+async def write_api_usage_batch(
+    log_rows: List[Dict[str, Any]], key_updates: Dict[str, Dict[str, Any]]
+):
+    """
+    在一个事务中批量写入使用记录：多行INSERT请求日志，并对每个Key执行一次聚合UPDATE。
+
+    Args:
+        log_rows: api_request_logs的行（key_id, timestamp, model, status, prompt_tokens, completion_tokens, cached_tokens），id自动生成
+        key_updates: {key_id: {"requests": 请求数增量, "last_used_at": 最后使用时间或None,
+                      "prompt_tokens"/"completion_tokens"/"cached_tokens": Token数增量}}
+    """
+    async with database.transaction():
+        if log_rows:
+            await database.execute(
+                api_request_logs.insert().values([{"id": str(uuid.uuid4()), **row} for row in log_rows])
+            )
+        for key_id, update in key_updates.items():
+            values: Dict[str, Any] = {"total_requests": openai_keys.c.total_requests + update["requests"]}
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                if update.get(field):
+                    column = openai_keys.c[f"total_{field}"]
+                    values[column.name] = func.coalesce(column, 0) + update[field]
+            if update["last_used_at"] is not None:
+                values["last_used_at"] = update["last_used_at"]
+            await database.execute(openai_keys.update().where(openai_keys.c.id == key_id).values(**values))
+
+# 响应缓存相关函数
+async def get_cached_response(cache_key: str) -> Optional[Dict[str, Any]]:
+    """根据缓存键获取持久化的响应缓存"""
+    query = response_cache.select().where(response_cache.c.cache_key == cache_key)
+    result = await database.fetch_one(query)
+    if result is None:
+        return None
+    return dict(result)
+
+async def save_cached_response(cache_key: str, body: bytes, headers: str, expires_at: datetime):
+    """保存（或覆盖）持久化的响应缓存"""
+    async with database.transaction():
+        await database.execute(response_cache.delete().where(response_cache.c.cache_key == cache_key))
+        await database.execute(
+            response_cache.insert().values(
+                cache_key=cache_key,
+                body=body,
+                headers=headers,
+                created_at=datetime.now(),
+                expires_at=expires_at,
+            )
+        )
+
+async def delete_expired_cached_responses() -> int:
+    """删除已过期的持久化响应缓存，返回删除数量"""
+    try:
+        query = response_cache.delete().where(response_cache.c.expires_at <= datetime.now())
+        result = await database.execute(query)
+        return int(result) if result else 0
+    except Exception as e:
+        logger.error(f"清理过期响应缓存时出错: {str(e)}")
+        return 0
+
+async def clear_cached_responses():
+    """清空持久化的响应缓存"""
+    await database.execute(response_cache.delete())
+
 # 模块导入时初始化数据库并创建表（如果不存在）
 init_db()
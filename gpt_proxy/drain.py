@@ -0,0 +1,187 @@
+"""
+优雅关闭模块
+
+跟踪在途的聊天补全请求（流式响应在最后一个数据块发送完成后才结束；/v1/models 等很快完成的请求不计入），
+并在关闭时排空。SIGTERM仍由uvicorn处理，uvicorn开始关闭（停止接受新连接）时：
+
+1. 进入排空状态：就绪检查返回503，已建立的连接上新的 /v1/ 请求直接返回503（Connection: close）；
+2. uvicorn等待在途请求完成期间，排空超过 drain_timeout_seconds 后取消剩余请求（流式响应关闭时仍会记录用量），
+   uvicorn的等待随之结束；
+3. uvicorn执行应用关闭流程，其中的drain()共用同一次排空，然后写入待处理的使用记录并断开数据库。
+
+不是由uvicorn运行（找不到处理SIGTERM的uvicorn服务器）时，排空在应用关闭流程中进行。
+"""
+import asyncio
+import signal
+import time
+from typing import Any, Dict, FrozenSet, Optional, Set
+
+from . import config
+from . import logger
+
+PROXY_PATH_PREFIX = "/v1/"
+DRAINED_PATHS: FrozenSet[str] = frozenset({"/v1/chat/completions"})  # 计入在途请求、关闭时需要等待的路径
+
+
+class DrainController:
+    """在途请求计数、就绪状态和SIGTERM排空"""
+
+    def __init__(self, drain_timeout_seconds: float):
+        self.drain_timeout_seconds = drain_timeout_seconds
+        self.ready = False  # 应用启动完成后为True
+        self.draining = False
+        self.draining_since: Optional[float] = None
+        self.in_flight = 0
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+        self._idle: Optional[asyncio.Event] = None
+        self._drain_task: Optional["asyncio.Task[bool]"] = None
+
+        self.rejected = 0  # 排空期间拒绝的新请求数
+        self.cancelled = 0  # 排空超时后取消的请求数
+
+    def _idle_event(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if self.in_flight == 0:
+                self._idle.set()
+        return self._idle
+
+    def request_started(self):
+        self.in_flight += 1
+        self._idle_event().clear()
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+
+    def request_finished(self):
+        self.in_flight -= 1
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.discard(task)
+        if self.in_flight <= 0:
+            self.in_flight = 0
+            self._idle_event().set()
+
+    def begin(self):
+        """进入排空状态（可重复调用）"""
+        if not self.draining:
+            self.draining = True
+            self.draining_since = time.monotonic()
+            logger.info(f"开始排空：不再接受新的代理请求，等待 {self.in_flight} 个在途请求完成。")
+
+    async def drain(self) -> bool:
+        """进入排空状态并等待在途请求完成，超时后取消剩余请求；返回是否在超时前全部完成。并发调用共享同一次排空"""
+        return await asyncio.shield(self.start_drain())
+
+    def start_drain(self) -> "asyncio.Task[bool]":
+        """立即进入排空状态并在后台等待在途请求（可重复调用），返回排空任务"""
+        self.begin()
+        if self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self._drain())
+        return self._drain_task
+
+    async def _drain(self) -> bool:
+        self.begin()
+        if self.in_flight == 0:
+            return True
+        remaining = self.drain_timeout_seconds - (time.monotonic() - self.draining_since)
+        if remaining > 0:
+            try:
+                await asyncio.wait_for(self._idle_event().wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        if self.in_flight == 0:
+            logger.info("在途请求已全部完成。")
+            return True
+        logger.warning(f"排空超时（{self.drain_timeout_seconds}秒），取消 {len(self._tasks)} 个仍未完成的请求。")
+        for task in list(self._tasks):
+            task.cancel()
+            self.cancelled += 1
+        try:
+            await asyncio.wait_for(self._idle_event().wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+        return False
+
+    # --- 接入uvicorn的关闭流程 ---
+
+    def attach_to_server(self):
+        """
+        在应用启动时调用：uvicorn开始关闭（收到SIGTERM或SIGINT后停止接受新连接）时在后台开始排空。
+
+        uvicorn在启动应用之前就已用Server.handle_exit接管信号，这里通过该处理函数找到Server实例并包装其shutdown，
+        信号处理本身不变。
+        """
+        if self.drain_timeout_seconds <= 0:
+            return
+        try:
+            from uvicorn.server import Server
+        except ImportError:
+            Server = None
+        server = getattr(signal.getsignal(signal.SIGTERM), "__self__", None)
+        if Server is None or not isinstance(server, Server):
+            logger.warning("未找到处理SIGTERM的uvicorn服务器，将在应用关闭流程中排空在途请求。")
+            return
+        original_shutdown = server.shutdown
+
+        async def shutdown(*args, **kwargs):
+            self.start_drain()
+            await original_shutdown(*args, **kwargs)
+
+        server.shutdown = shutdown
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready and not self.draining,
+            "draining": self.draining,
+            "draining_for_seconds": (
+                round(time.monotonic() - self.draining_since, 3) if self.draining_since is not None else None
+            ),
+            "in_flight": self.in_flight,
+            "drain_timeout_seconds": self.drain_timeout_seconds,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+        }
+
+
+class DrainMiddleware:
+    """ASGI中间件：统计在途的聊天补全请求，排空期间拒绝新的代理请求"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROXY_PATH_PREFIX):
+            await self.app(scope, receive, send)
+            return
+        if controller.draining:
+            controller.rejected += 1
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"retry-after", b"1"),
+                        (b"connection", b"close"),
+                    ],
+                }
+            )
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": '{"detail":"服务正在关闭，请稍后重试。"}'.encode("utf-8"),
+                }
+            )
+            return
+        if scope["path"] not in DRAINED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        controller.request_started()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.request_finished()
+
+
+controller = DrainController(drain_timeout_seconds=config.GRACEFUL_SHUTDOWN_DRAIN_TIMEOUT_SECONDS)
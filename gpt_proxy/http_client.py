@@ -0,0 +1,69 @@
+"""
+上游HTTP客户端模块
+
+在应用范围内共享一个httpx.AsyncClient，复用TCP/TLS连接（keep-alive）并可选启用HTTP/2多路复用，
+避免每个请求都重新握手。客户端在main.py的startup事件中创建，在shutdown事件中关闭。
+"""
+from typing import Optional
+
+import httpx
+
+from . import config
+from . import logger
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _is_http2_available() -> bool:
+    """检查是否安装了HTTP/2支持所需的h2包"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    """根据配置创建带连接池的httpx.AsyncClient"""
+    use_http2 = config.HTTP_CLIENT_HTTP2
+    if use_http2 and not _is_http2_available():
+        logger.warning("配置启用了HTTP/2，但未安装'h2'包（pip install httpx[http2]）。将回退到HTTP/1.1。")
+        use_http2 = False
+
+    limits = httpx.Limits(
+        max_connections=config.HTTP_CLIENT_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_CLIENT_KEEPALIVE_EXPIRY,
+    )
+    logger.info(
+        f"创建共享上游HTTP客户端: 最大连接数={config.HTTP_CLIENT_MAX_CONNECTIONS}, "
+        f"最大keep-alive连接数={config.HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS}, "
+        f"keep-alive过期={config.HTTP_CLIENT_KEEPALIVE_EXPIRY}秒, HTTP/2={use_http2}"
+    )
+    return httpx.AsyncClient(limits=limits, http2=use_http2)
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """初始化共享的上游HTTP客户端（应用启动时调用）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _create_http_client()
+    return _http_client
+
+
+async def close_http_client():
+    """关闭共享的上游HTTP客户端（应用关闭时调用）"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("已关闭共享上游HTTP客户端。")
+    _http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的上游HTTP客户端，若尚未初始化则按需创建"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        logger.warning("共享上游HTTP客户端尚未初始化，将按需创建。")
+        _http_client = _create_http_client()
+    return _http_client
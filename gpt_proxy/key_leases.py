@@ -0,0 +1,140 @@
+"""
+多节点Key租约模块
+
+多个代理节点（副本）在负载均衡器后共用同一组Key时，每个节点都按完整的上限调用每个Key，合计流量会超出Key的限额。
+开启租约模式后，每个节点在数据库的key_leases表中持有一个有效期为 ttl_seconds 的租约，并每隔 renew_interval_seconds 续约：
+
+- 续约只执行一次按主键的UPDATE和一次读取未过期节点ID的查询；
+- 本节点的份额为 1/未过期节点数，调度器按份额缩放每个Key的调用次数上限和TPM上限（key_scheduler.set_capacity_share）；
+- 新节点加入或节点正常退出（删除租约）后，其他节点在一个续约间隔内重新平分额度；节点异常退出后其租约在有效期后失效。
+
+新节点加入到其他节点下一次续约之间，各节点份额之和可能短暂超过1（不超过一个续约间隔）。
+续约失败时保持当前份额，并在之后的续约中重试。
+"""
+import asyncio
+import os
+import socket
+from typing import Any, Dict, List, Optional
+
+from . import config
+from . import database as db
+from . import logger
+from . import key_scheduler
+
+
+class KeyLeaseManager:
+    """定期续约本节点的Key租约，并按未过期节点数设置调度器的额度份额"""
+
+    def __init__(
+        self,
+        enabled: bool,
+        node_id: str,
+        ttl_seconds: float,
+        renew_interval_seconds: float,
+        scheduler: Optional[key_scheduler.KeyScheduler] = None,
+    ):
+        self.enabled = enabled
+        self.scheduler = scheduler if scheduler is not None else key_scheduler.scheduler  # 按份额缩放额度的调度器
+        self.node_id = node_id
+        self.ttl_seconds = ttl_seconds
+        self.renew_interval_seconds = renew_interval_seconds
+        self.live_nodes: List[str] = []
+        self._renew_task: Optional["asyncio.Task[None]"] = None
+
+        self.renewals = 0
+        self.failed_renewals = 0
+        self.rebalances = 0
+
+    @property
+    def share(self) -> float:
+        return self.scheduler.capacity_share
+
+    def _default_node_id(self) -> str:
+        # 开启共享Key计数器时同一台机器上的工作进程共用计数，也共用一个租约
+        if self.scheduler.shared_counters is not None:
+            return socket.gethostname()
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    async def renew(self) -> bool:
+        """续约并按未过期节点数重新计算份额，返回份额是否发生变化"""
+        try:
+            live_nodes = await db.renew_key_lease(self.node_id, self.ttl_seconds)
+        except Exception as e:
+            self.failed_renewals += 1
+            logger.error(f"续约Key租约失败（节点 {self.node_id}），保持当前份额 {self.share:.4f}: {e}")
+            return False
+        self.renewals += 1
+        self.live_nodes = live_nodes
+        share = 1.0 / len(live_nodes)
+        if share == self.share:
+            return False
+        logger.info(
+            f"Key租约节点数变为 {len(live_nodes)}，本节点 {self.node_id} 的额度份额从 {self.share:.4f} 调整为 {share:.4f}。"
+        )
+        self.scheduler.set_capacity_share(share)
+        self.rebalances += 1
+        try:
+            await db.update_key_lease_share(self.node_id, share)
+        except Exception as e:
+            logger.warning(f"记录Key租约份额失败: {e}")
+        return True
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.renew_interval_seconds)
+            await self.renew()
+
+    async def start(self):
+        """获取租约并启动定期续约；在开始处理请求之前调用，使节点从一开始就按份额调度"""
+        if not self.enabled:
+            return
+        if db.DB_TYPE not in ["postgresql", "postgres"]:
+            logger.warning("Key租约模式用于多个节点共用PostgreSQL数据库，当前数据库只能由本机的节点共用。")
+        if self.scheduler.base_capacity <= 0 and self.scheduler.base_tokens_per_minute <= 0:
+            logger.warning("未配置每Key调用次数上限或TPM上限，Key租约份额不会影响调度。")
+        if not self.node_id:
+            self.node_id = self._default_node_id()
+        try:
+            removed = await db.delete_expired_key_leases(self.ttl_seconds)
+            if removed:
+                logger.info(f"已删除 {removed} 个过期的Key租约。")
+        except Exception as e:
+            logger.warning(f"删除过期的Key租约失败: {e}")
+        await self.renew()
+        logger.info(f"已获取Key租约（节点 {self.node_id}），当前 {len(self.live_nodes)} 个节点，额度份额 {self.share:.4f}。")
+        if self._renew_task is None or self._renew_task.done():
+            self._renew_task = asyncio.ensure_future(self._renew_loop())
+
+    async def stop(self):
+        """停止续约并删除本节点的租约"""
+        if self._renew_task is not None and not self._renew_task.done():
+            self._renew_task.cancel()
+        self._renew_task = None
+        if not self.enabled or not self.node_id:
+            return
+        try:
+            await db.release_key_lease(self.node_id)
+            logger.info(f"已释放Key租约（节点 {self.node_id}）。")
+        except Exception as e:
+            logger.warning(f"释放Key租约失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "node_id": self.node_id,
+            "share": round(self.share, 4),
+            "live_nodes": self.live_nodes,
+            "ttl_seconds": self.ttl_seconds,
+            "renew_interval_seconds": self.renew_interval_seconds,
+            "renewals": self.renewals,
+            "failed_renewals": self.failed_renewals,
+            "rebalances": self.rebalances,
+        }
+
+
+manager = KeyLeaseManager(
+    enabled=config.KEY_LEASES_ENABLED,
+    node_id=config.KEY_LEASES_NODE_ID,
+    ttl_seconds=config.KEY_LEASES_TTL_SECONDS,
+    renew_interval_seconds=config.KEY_LEASES_RENEW_INTERVAL_SECONDS,
+)
@@ -0,0 +1,109 @@
+"""
+API Key可调用模型列表模块
+
+每个Key可以在数据库中保存可调用的模型列表（openai_keys.models，NULL表示不限制），密钥池按模型只在能调用
+所请求模型的Key中选取。上游返回model_not_found时只换Key重试，不将Key设为无效。
+开启learn_from_models_endpoint后，根据每个Key的/v1/models响应自动更新其模型列表。
+"""
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+import httpx
+
+from . import config
+from . import database as db
+from . import http_client
+from . import key_scheduler
+from . import logger
+from . import retry_policy
+from . import upstreams
+
+# 正在学习模型列表的Key，同一个Key同时只发起一次请求
+_learn_tasks: Dict[str, "asyncio.Task[Optional[List[str]]]"] = {}
+
+
+def is_model_not_found(status_code: int, body: bytes) -> bool:
+    """上游的403/404错误是否表示该Key不能调用所请求的模型（而不是Key本身无效）"""
+    if status_code not in (403, 404):
+        return False
+    try:
+        error = json.loads(body).get("error") or {}
+    except (ValueError, AttributeError):
+        return False
+    if not isinstance(error, dict):
+        return False
+    if error.get("code") == "model_not_found":
+        return True
+    message = str(error.get("message") or "").lower()
+    return "model" in message and ("does not exist" in message or "does not have access" in message)
+
+
+def parse_models_response(body: bytes) -> Optional[List[str]]:
+    """从/v1/models响应体中解析模型ID列表，格式不正确或列表为空时返回None"""
+    try:
+        data = json.loads(body).get("data")
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(data, list):
+        return None
+    models = [str(item["id"]) for item in data if isinstance(item, dict) and item.get("id")]
+    return models or None
+
+
+async def store_key_models(key_id: str, models: Optional[List[str]]) -> bool:
+    """保存Key的模型列表并更新密钥池"""
+    success = await db.update_api_key_models(key_id, models)
+    if success:
+        key_scheduler.scheduler.set_key_models(key_id, models)
+    return success
+
+
+async def learn(key_id: str, api_key: str) -> Optional[List[str]]:
+    """使用该Key请求其绑定上游的/v1/models，保存并返回其可调用的模型列表；失败时返回None"""
+    model_timeouts = retry_policy.get_model_timeouts(None)
+    try:
+        response = await http_client.get_http_client().get(
+            upstreams.pool.for_key(key_id).models_url,
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=httpx.Timeout(model_timeouts.read, connect=model_timeouts.connect),
+        )
+    except httpx.RequestError as e:
+        logger.warning(f"获取Key ID {key_id} 的模型列表时发生错误: {e}")
+        return None
+    if response.status_code != 200:
+        logger.warning(f"获取Key ID {key_id} 的模型列表失败: {response.status_code}")
+        return None
+
+    models = parse_models_response(response.content)
+    if models is None:
+        logger.warning(f"Key ID {key_id} 的/v1/models响应中没有模型列表，保持原有设置。")
+        return None
+    await store_key_models(key_id, models)
+    logger.info(f"已从/v1/models更新Key ID {key_id} 的模型列表，共 {len(models)} 个模型。")
+    return models
+
+
+def schedule_learn(key_id: str, api_key: str):
+    """开启学习时在后台更新Key的模型列表，同一个Key已有学习任务时不重复发起"""
+    if not config.KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT:
+        return
+    task = _learn_tasks.get(key_id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.ensure_future(learn(key_id, api_key))
+    _learn_tasks[key_id] = task
+    task.add_done_callback(lambda _: _learn_tasks.pop(key_id, None) if _learn_tasks.get(key_id) is task else None)
+
+
+async def remember_models_response(key_id: str, body: bytes):
+    """开启学习时，用代理/v1/models得到的响应更新该Key的模型列表（与池中已有列表相同时不写数据库）"""
+    if not config.KEY_MODELS_LEARN_FROM_MODELS_ENDPOINT:
+        return
+    models = parse_models_response(body)
+    if models is None or key_scheduler.scheduler.models_of(key_id) == frozenset(models):
+        return
+    try:
+        await store_key_models(key_id, models)
+    except Exception as e:
+        logger.error(f"保存Key ID {key_id} 的模型列表时发生错误: {e}")
@@ -0,0 +1,181 @@
+"""
+多进程密钥池同步模块
+
+使用 uvicorn --workers N 时每个工作进程都有自己的内存密钥池，一个进程添加、删除或停用Key后其他进程看不到。
+数据库中保存一个密钥池版本号，修改openai_keys中影响密钥池的字段时，在同一事务中将版本号加一并记录变更的Key ID和新状态
+（见database._write_api_key、bump_key_pool_version和key_pool_changes），其他进程不会看到没有对应版本号的修改：
+
+- 每个进程按 sync_poll_interval_seconds 读取版本号（按主键读取一行），版本号变化时读取期间的变更记录，
+  逐个Key增量更新密钥池（停用和删除直接移出，激活和其他字段变化只读取这些Key的行），
+  因此所有进程在一个检查间隔内收敛到相同的密钥集合、状态、模型列表和绑定上游；
+- 变更超过 sync_max_incremental_changes 条（批量修改）或缺少某个版本的记录（已被清理）时才从数据库全量同步；
+- 使用PostgreSQL时还会在独立连接上 LISTEN 版本号变化通知，修改后立即同步，定期检查只作为兜底。
+
+修改Key的进程自身已经增量更新了密钥池，下一次检查时重复应用自己的变更记录（结果相同）。
+各进程按自己的流量计数限流状态，跨进程共享的计数不在此模块中处理。
+"""
+import asyncio
+from typing import Any, Dict, Optional
+
+from . import config
+from . import database as db
+from . import logger
+from . import utils
+
+
+class KeyPoolSync:
+    """定期检查（以及PostgreSQL下LISTEN）数据库中的密钥池版本号，变化时增量或全量同步内存密钥池"""
+
+    def __init__(self, poll_interval_seconds: float, listen: bool, max_incremental_changes: int):
+        self.poll_interval_seconds = poll_interval_seconds
+        self.listen = listen and db.DB_TYPE in ["postgresql", "postgres"]
+        self.max_incremental_changes = max_incremental_changes
+        self.version: Optional[int] = None  # 本进程密钥池对应的版本号
+
+        self._check_requested = False
+        self._check_task: Optional["asyncio.Task[None]"] = None
+        self._poll_task: Optional["asyncio.Task[None]"] = None
+        self._listen_task: Optional["asyncio.Task[None]"] = None
+        self._listening = False
+
+        self.checks = 0
+        self.resyncs = 0
+        self.incremental_updates = 0  # 按变更记录增量更新的次数
+        self.keys_updated = 0  # 增量更新中应用的变更记录数
+        self.notifications = 0
+        self.failed_checks = 0
+
+    async def check(self) -> bool:
+        """读取版本号，与本进程的版本号不同时增量（或全量）同步密钥池，返回是否进行了同步"""
+        self.checks += 1
+        version = await db.get_key_pool_version()
+        if version == self.version:
+            return False
+        # 先读取版本号再同步：同步期间发生的修改会使版本号继续增加，在下一次检查时同步
+        if self.version is not None and await self._apply_changes(self.version, version):
+            self.version = version
+            return True
+        await utils.update_openai_key_cycle(fresh=True)
+        if self.version is not None:
+            self.resyncs += 1
+            logger.info(f"密钥池版本号从 {self.version} 变为 {version}，已从数据库重新同步。")
+        self.version = version
+        return True
+
+    async def _apply_changes(self, from_version: int, to_version: int) -> bool:
+        """按 (from_version, to_version] 之间的变更记录逐个Key更新密钥池；需要全量同步时返回False且不做修改"""
+        if not 0 < to_version - from_version <= self.max_incremental_changes:
+            return False
+        changes = await db.get_key_pool_changes(from_version, to_version)
+        if [change["version"] for change in changes] != list(range(from_version + 1, to_version + 1)):
+            return False  # 批量修改没有逐条记录，或记录已被清理
+
+        # 激活和其他字段变化需要Key的当前行（一次查询读取所有这些Key），停用和删除直接移出
+        reload_ids = {
+            change["key_id"] for change in changes if change["status"] in (None, config.KEY_STATUS_ACTIVE)
+        }
+        rows = {str(row["id"]): row for row in await db.get_api_keys_for_pool(list(reload_ids))} if reload_ids else {}
+        for change in changes:
+            key_id = str(change["key_id"])
+            row = rows.get(key_id) if key_id in reload_ids else None
+            if row is not None and row["status"] == config.KEY_STATUS_ACTIVE:
+                utils.add_key_to_pool(row)
+            else:
+                utils.remove_key_from_pool(key_id)
+        self.incremental_updates += 1
+        self.keys_updated += len(changes)
+        logger.info(f"密钥池版本号从 {from_version} 变为 {to_version}，已增量更新 {len(changes)} 条Key变更。")
+        return True
+
+    def request_check(self):
+        """安排一次检查；正在检查时收到的请求会在当前检查结束后再检查一次"""
+        self._check_requested = True
+        if self._check_task is None or self._check_task.done():
+            self._check_task = asyncio.ensure_future(self._run_checks())
+
+    async def _run_checks(self):
+        while self._check_requested:
+            self._check_requested = False
+            try:
+                await self.check()
+            except Exception as e:
+                self.failed_checks += 1
+                logger.error(f"检查密钥池版本号失败: {e}")
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval_seconds)
+            self.request_check()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.notifications += 1
+        self.request_check()
+
+    async def _listen_loop(self):
+        """在独立的asyncpg连接上LISTEN版本号变化通知，连接断开后重新连接"""
+        import asyncpg
+
+        retry_seconds = max(self.poll_interval_seconds, 1.0)
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(db.DATABASE_URL)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _connection: closed.set())
+                await connection.add_listener(db.KEY_POOL_NOTIFY_CHANNEL, self._on_notification)
+                self._listening = True
+                logger.info(f"已LISTEN密钥池版本号变化通知（通道 {db.KEY_POOL_NOTIFY_CHANNEL}）。")
+                # 连接建立前的修改没有收到通知，补做一次检查
+                self.request_check()
+                await closed.wait()
+                logger.warning("密钥池版本号通知连接已断开，将重新连接。")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"LISTEN密钥池版本号变化通知失败: {e}")
+            finally:
+                self._listening = False
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(retry_seconds)
+
+    async def start(self):
+        """在首次从数据库加载密钥池之前调用：记录当前版本号并启动后台检查；检查间隔不大于0时不启动"""
+        if self.poll_interval_seconds <= 0:
+            return
+        try:
+            self.version = await db.get_key_pool_version()
+        except Exception as e:
+            logger.error(f"读取密钥池版本号失败: {e}")
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.ensure_future(self._poll_loop())
+        if self.listen and (self._listen_task is None or self._listen_task.done()):
+            self._listen_task = asyncio.ensure_future(self._listen_loop())
+
+    def stop(self):
+        for task in (self._poll_task, self._listen_task, self._check_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._poll_task = None
+        self._listen_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "poll_interval_seconds": self.poll_interval_seconds,
+            "listening": self._listening,
+            "checks": self.checks,
+            "resyncs": self.resyncs,
+            "max_incremental_changes": self.max_incremental_changes,
+            "incremental_updates": self.incremental_updates,
+            "keys_updated": self.keys_updated,
+            "notifications": self.notifications,
+            "failed_checks": self.failed_checks,
+        }
+
+
+sync = KeyPoolSync(
+    poll_interval_seconds=config.KEY_POOL_SYNC_POLL_INTERVAL_SECONDS,
+    listen=config.KEY_POOL_SYNC_LISTEN,
+    max_incremental_changes=config.KEY_POOL_SYNC_MAX_INCREMENTAL_CHANGES,
+)
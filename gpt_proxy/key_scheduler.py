@@ -0,0 +1,767 @@
+"""
+API Key调度模块
+
+为每个活动Key维护一个内存中的令牌桶：容量为 max_calls_per_key_per_window，
+在 usage_window_seconds 内匀速补满。有令牌的Key放在就绪队列中按轮询顺序选取，
+令牌耗尽的Key按下一个令牌到达的时间放入最小堆，到期后重新回到就绪队列，因此选取一个Key是O(1)（均摊）的。
+所有Key都耗尽时可以查询最早有Key恢复的时间，用于排队等待或返回Retry-After。
+
+同时记录上游每次响应的 x-ratelimit-* 头：剩余请求数或Token数低于阈值的Key在重置前被移出就绪队列，
+选取时在就绪队列前端的若干个候选Key中优先使用剩余额度比例最高的Key。
+
+配置了每Key每分钟Token上限（TPM）时，每个Key还有一个以Token计的令牌桶：请求结束后按上游返回的实际用量扣减，
+额度用尽的Key同样放入最小堆等待恢复，剩余TPM额度比例也计入候选Key的剩余额度。
+
+每个Key还记录延迟、首字节时间和错误率的指数加权移动平均值以及在途请求数。配置了每Key在途请求上限时，
+达到上限的Key被移出就绪队列，在其请求结束（release）时放回，选取时不需要逐个跳过已满的Key。least_loaded策略在候选Key中
+选择 (在途请求数+1) x 延迟 代价最低的Key（按错误率和剩余额度加权），即power-of-two-choices；
+统计随时间衰减回全局平均值，避免慢Key恢复后一直得不到请求。
+
+池中保存全部活动Key，每个Key只用一个带__slots__的KeyBucket记录调度所需的字段（不保留数据库行），
+因此内存占用随Key数量线性增长，选取开销与Key数量无关。
+
+Key可以限定可调用的模型和绑定的上游：可调用模型集合和上游都相同的Key组成一个KeyGroup，每组有独立的就绪队列，
+并按（模型, 上游）索引可用的组，选取时只考虑能在所选上游调用所请求模型的Key（按各组可用Key数量加权选择组）。
+未绑定上游的Key可用于任何上游。
+
+多个工作进程运行时可以使用共享Key计数器（shared_counters）：选中的Key还需通过所有进程的全局请求数和TPM额度检查，
+全局额度用尽的Key按额度恢复时间移出就绪队列；未使用共享计数器时只按进程内的令牌桶限流。
+多节点租约模式下（key_leases），每个Key的调用次数上限和TPM上限按本节点分得的份额缩放。
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import re
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, FrozenSet, Iterable, List, Mapping, Optional, Tuple
+
+from . import config
+
+if TYPE_CHECKING:
+    from .shared_counters import SharedKeyCounters
+
+_DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNIT_SECONDS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_reset_duration(value: str) -> Optional[float]:
+    """解析上游重置时间（例如 "1s"、"6m0s"、"20ms"、"0.5"），返回秒数，无法解析时返回None"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNIT_SECONDS[unit] for number, unit in parts)
+
+
+def _parse_int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class KeyBucket:
+    """单个Key的令牌桶状态及上游返回的限流状态"""
+
+    __slots__ = (
+        "key_id",
+        "api_key",
+        "name",
+        "group",
+        "tokens",
+        "updated_at",
+        "exhausted",
+        "queued",
+        "blocked_until",
+        "remaining_requests",
+        "limit_requests",
+        "requests_reset_at",
+        "remaining_tokens",
+        "limit_tokens",
+        "tokens_reset_at",
+        "tpm_budget",
+        "tpm_updated_at",
+        "cooldown_strikes",
+        "in_flight",
+        "latency_ewma",
+        "ttft_ewma",
+        "error_rate",
+        "observed_at",
+    )
+
+    def __init__(self, key_id: str, api_key: str, name: Optional[str], tokens: float, now: float):
+        self.key_id = key_id
+        self.api_key = api_key
+        self.name = name
+        self.tokens = tokens
+        self.updated_at = now
+        self.exhausted = False  # 令牌耗尽、被上游限流或处于冷却期，等待最小堆中的恢复时间
+        self.queued = False  # 是否在就绪队列中
+        self.blocked_until = 0.0  # 上游限流或冷却解除的时间（time.monotonic()）
+        self.remaining_requests: Optional[int] = None
+        self.limit_requests: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.remaining_tokens: Optional[int] = None
+        self.limit_tokens: Optional[int] = None
+        self.tokens_reset_at = 0.0
+        self.tpm_budget = 0.0  # 本地TPM令牌桶中剩余的Token数，可能因单次请求用量过大而为负
+        self.tpm_updated_at = now
+        self.cooldown_strikes = 0  # 连续进入冷却的次数，用于指数退避
+        self.in_flight = 0  # 已选取但尚未结束的请求数
+        self.latency_ewma: Optional[float] = None  # 响应延迟（秒），流式请求为首个事件到达的时间
+        self.ttft_ewma: Optional[float] = None  # 流式请求首字节时间（秒）
+        self.error_rate = 0.0  # 上游错误率（0~1）
+        self.observed_at = now  # 最近一次记录请求结果的时间，用于统计衰减
+        self.group: Optional[KeyGroup] = None
+
+
+class KeyGroup:
+    """可调用模型集合和绑定的上游都相同的一组Key，拥有独立的就绪队列"""
+
+    __slots__ = ("models", "upstream", "ready", "size", "exhausted_count")
+
+    def __init__(self, models: Optional[FrozenSet[str]], upstream: Optional[str] = None):
+        self.models = models  # None表示不限制模型
+        self.upstream = upstream  # None表示未绑定上游
+        self.ready: Deque[KeyBucket] = deque()
+        self.size = 0
+        self.exhausted_count = 0
+
+    def allows(self, model: Optional[str], upstream: Optional[str] = None) -> bool:
+        if self.upstream is not None and upstream is not None and self.upstream != upstream:
+            return False
+        return self.models is None or model is None or model in self.models
+
+
+class KeyScheduler:
+    """
+    基于令牌桶和上游限流头的Key调度器（即内存中的活动Key池），capacity不大于0时不限制调用次数。
+
+    Key的增加、删除和状态变化都是O(1)的增量操作，不会重置轮询位置；每次变化都会增加版本号。
+    就绪队列和最小堆中保存的是KeyBucket对象，已删除的Key留下的条目在取出时按对象身份识别并丢弃；
+    Key的模型集合变化时会换成一个新的KeyBucket对象（保留全部状态）移到对应的组，旧条目同样被丢弃。
+    """
+
+    # 按模型缓存的可用组列表的最大数量，避免客户端传入任意模型名导致缓存无限增长
+    MAX_CACHED_MODELS = 1024
+
+    def __init__(
+        self,
+        capacity: int,
+        window_seconds: float,
+        min_remaining_requests: int = 1,
+        min_remaining_tokens: int = 1,
+        candidates: int = 1,
+        cooldown_base_seconds: float = 1.0,
+        cooldown_max_seconds: float = 300.0,
+        policy: str = config.KEY_SELECTION_POLICY_ROUND_ROBIN,
+        ewma_alpha: float = 0.3,
+        decay_seconds: float = 30.0,
+        tokens_per_minute: int = 0,
+        max_in_flight_per_key: int = 0,
+    ):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.base_capacity = capacity  # 未按租约份额缩放的上限
+        self.base_tokens_per_minute = tokens_per_minute
+        self.capacity_share = 1.0
+        self.refill_rate = capacity / window_seconds if capacity > 0 and window_seconds > 0 else 0.0
+        self.tokens_per_minute = tokens_per_minute
+        self.tpm_refill_rate = tokens_per_minute / 60.0 if tokens_per_minute > 0 else 0.0
+        self.max_in_flight_per_key = max_in_flight_per_key  # 每个Key的在途请求数上限，0表示不限制
+        self.min_remaining_requests = min_remaining_requests
+        self.min_remaining_tokens = min_remaining_tokens
+        self.candidates = max(1, candidates)
+        self.cooldown_base_seconds = cooldown_base_seconds
+        self.cooldown_max_seconds = cooldown_max_seconds
+        self.policy = policy
+        self.ewma_alpha = ewma_alpha
+        self.decay_seconds = decay_seconds
+        self.latency_prior: Optional[float] = None  # 所有Key的平均延迟，作为没有统计的Key的估计值
+        self.version = 0  # Key集合每次变化时递增
+        self._buckets: Dict[str, KeyBucket] = {}
+        self._groups: Dict[Tuple[Optional[str], Optional[FrozenSet[str]]], KeyGroup] = {}  # (上游, 模型集合) -> 组
+        self._groups_by_model: Dict[Tuple[Optional[str], Optional[str]], List[KeyGroup]] = {}  # 组集合变化时清空
+        self._exhausted: List[Tuple[float, int, KeyBucket]] = []  # (恢复时间, 序号, bucket) 最小堆
+        self._exhausted_count = 0  # 当前处于不可用状态的Key数量
+        self._heap_sequence = itertools.count()
+        self.throttled_picks = 0  # 因所有Key不可用而未能选出Key的次数
+        self.upstream_blocks = 0  # 因上游剩余额度不足而移出就绪队列的次数
+        self.cooldowns = 0  # 因限流或临时错误进入冷却的次数
+        self.shared_counters: Optional["SharedKeyCounters"] = None  # 多进程共享的每Key计数器
+        self.shared_blocks = 0  # 因其他进程已用完全局额度而移出就绪队列的次数
+        self.saturated_parks = 0  # 因在途请求达到上限而移出就绪队列的次数
+        self._released: Optional[asyncio.Event] = None  # 等待Key在途名额的请求在release时被唤醒
+
+    def set_capacity_share(self, share: float):
+        """
+        按本节点分得的份额（0~1）缩放每个Key的调用次数上限和TPM上限，上限至少为1。
+
+        份额减少时已积累的令牌截断到新的上限；不可用的Key按新的补充速度重新计算恢复时间。
+        """
+        share = min(1.0, max(0.0, share))
+        if share == self.capacity_share:
+            return
+        self.capacity_share = share
+        if self.base_capacity > 0:
+            self.capacity = max(1.0, self.base_capacity * share)
+            self.refill_rate = self.capacity / self.window_seconds if self.window_seconds > 0 else 0.0
+        if self.base_tokens_per_minute > 0:
+            self.tokens_per_minute = max(1.0, self.base_tokens_per_minute * share)
+            self.tpm_refill_rate = self.tokens_per_minute / 60.0
+        now = time.monotonic()
+        for bucket in self._buckets.values():
+            self._refill(bucket, now)
+            bucket.tokens = min(bucket.tokens, float(self.capacity))
+            if self.tokens_per_minute > 0:
+                bucket.tpm_budget = self._tpm_budget(bucket, now)
+                bucket.tpm_updated_at = now
+            if bucket.exhausted:
+                self._mark_exhausted(bucket)
+
+    def use_shared_counters(self, counters: Optional["SharedKeyCounters"]):
+        """使用多进程共享的每Key计数器检查全局额度，None表示只使用进程内的令牌桶"""
+        self.shared_counters = counters
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def __contains__(self, key_id: str) -> bool:
+        return key_id in self._buckets
+
+    def models_of(self, key_id: str) -> Optional[FrozenSet[str]]:
+        """返回池中Key可调用的模型集合，不限制或Key不在池中时返回None"""
+        bucket = self._buckets.get(key_id)
+        return bucket.group.models if bucket is not None else None
+
+    def upstream_of(self, key_id: str) -> Optional[str]:
+        """返回池中Key绑定的上游名称，未绑定或Key不在池中时返回None"""
+        bucket = self._buckets.get(key_id)
+        return bucket.group.upstream if bucket is not None else None
+
+    def eligible_count(self, model: Optional[str], upstream: Optional[str] = None) -> int:
+        """能在指定上游调用指定模型的Key数量（model和upstream为None时不限制）"""
+        return sum(group.size for group in self._eligible_groups(model, upstream))
+
+    def add_key(self, key_config: Dict[str, Any]) -> bool:
+        """
+        将Key加入池中，新Key排在所在组轮询队列的末尾，返回是否为新增。
+
+        Key已存在时只更新api_key、name以及（key_config中包含models或upstream时）可调用的模型列表和绑定的上游。
+        """
+        key_id = str(key_config["id"])
+        bucket = self._buckets.get(key_id)
+        if bucket is not None:
+            bucket.api_key = key_config["api_key"]
+            bucket.name = key_config.get("name")
+            if "models" in key_config or "upstream" in key_config:
+                models = key_config["models"] if "models" in key_config else bucket.group.models
+                upstream = key_config["upstream"] if "upstream" in key_config else bucket.group.upstream
+                self._move(bucket, self._group_for(models, upstream))
+            return False
+        bucket = KeyBucket(key_id, key_config["api_key"], key_config.get("name"), float(self.capacity), time.monotonic())
+        bucket.tpm_budget = float(self.tokens_per_minute)
+        self._buckets[key_id] = bucket
+        self._attach(bucket, self._group_for(key_config.get("models"), key_config.get("upstream")))
+        self.version += 1
+        return True
+
+    def remove_key(self, key_id: str) -> bool:
+        """将Key移出池，返回是否存在；队列和堆中的旧条目在取出时丢弃"""
+        bucket = self._buckets.pop(key_id, None)
+        if bucket is None:
+            return False
+        if bucket.exhausted:
+            self._exhausted_count -= 1
+        self._detach(bucket)
+        self.version += 1
+        return True
+
+    def set_key_models(self, key_id: str, models: Optional[List[str]]) -> bool:
+        """更新Key可调用的模型列表（None表示不限制），返回是否发生变化"""
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return False
+        return self._move(bucket, self._group_for(models, bucket.group.upstream))
+
+    def set_key_upstream(self, key_id: str, upstream: Optional[str]) -> bool:
+        """更新Key绑定的上游（None表示不绑定），返回是否发生变化"""
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return False
+        return self._move(bucket, self._group_for(bucket.group.models, upstream))
+
+    def _move(self, bucket: KeyBucket, group: KeyGroup) -> bool:
+        """将Key移到另一个组，返回是否发生变化"""
+        if bucket.group is group:
+            return False
+
+        # 换成新的KeyBucket对象，旧对象在就绪队列和最小堆中留下的条目按身份识别后丢弃
+        moved = KeyBucket.__new__(KeyBucket)
+        for slot in KeyBucket.__slots__:
+            setattr(moved, slot, getattr(bucket, slot))
+        if bucket.exhausted:
+            self._exhausted_count -= 1
+        self._detach(bucket)
+        moved.exhausted = False
+        self._buckets[bucket.key_id] = moved
+        self._attach(moved, group)
+        self.version += 1
+        return True
+
+    def _group_for(self, models: Optional[Iterable[str]], upstream: Optional[str] = None) -> KeyGroup:
+        group_key = (upstream, frozenset(models) if models is not None else None)
+        group = self._groups.get(group_key)
+        if group is None:
+            group = KeyGroup(group_key[1], upstream)
+            self._groups[group_key] = group
+            self._groups_by_model.clear()
+        return group
+
+    def _drop_if_empty(self, group: KeyGroup):
+        group_key = (group.upstream, group.models)
+        if group.size == 0 and self._groups.get(group_key) is group:
+            del self._groups[group_key]
+            self._groups_by_model.clear()
+
+    def _attach(self, bucket: KeyBucket, group: KeyGroup):
+        # bucket.exhausted为False时的新Key或换组的Key；换组前处于不可用状态的Key按原恢复时间重新放入最小堆
+        bucket.group = group
+        group.size += 1
+        if self._ready_at(bucket) > time.monotonic():
+            bucket.queued = False
+            self._mark_exhausted(bucket)
+        else:
+            bucket.queued = True
+            group.ready.append(bucket)
+
+    def _detach(self, bucket: KeyBucket):
+        group = bucket.group
+        group.size -= 1
+        if bucket.exhausted:
+            group.exhausted_count -= 1
+        self._drop_if_empty(group)
+
+    def _eligible_groups(self, model: Optional[str], upstream: Optional[str] = None) -> List[KeyGroup]:
+        groups = self._groups_by_model.get((model, upstream))
+        if groups is None:
+            groups = [group for group in self._groups.values() if group.allows(model, upstream)]
+            if len(self._groups_by_model) < self.MAX_CACHED_MODELS:
+                self._groups_by_model[(model, upstream)] = groups
+        return groups
+
+    def set_keys(self, key_configs: List[Dict[str, Any]]):
+        """与完整的活动Key列表同步：增加新Key、移除已不存在的Key，其余Key保留状态和轮询位置"""
+        active_ids = set()
+        for key_config in key_configs:
+            active_ids.add(str(key_config["id"]))
+            self.add_key(key_config)
+        for key_id in [key_id for key_id in self._buckets if key_id not in active_ids]:
+            self.remove_key(key_id)
+
+    def _is_live(self, bucket: KeyBucket) -> bool:
+        return self._buckets.get(bucket.key_id) is bucket
+
+    def acquire(self, model: Optional[str] = None, upstream: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        选取一个能在upstream调用model的可用Key并消耗一个令牌，返回其配置（id、api_key、name），没有可用Key时返回None。
+
+        按可用Key数量加权选择一个组，按轮询顺序取该组就绪队列前端的若干个候选Key，round_robin策略使用上游剩余额度比例
+        最高的一个，least_loaded策略使用负载代价最低的一个，其余候选放回队首。选中的Key在途请求数加一，请求结束后需调用release；
+        在途请求数达到上限的Key移出就绪队列，直到release。
+        """
+        now = time.monotonic()
+        self._promote(now)
+
+        groups = self._eligible_groups(model, upstream)
+        if len(groups) > 1:
+            weights = [group.size - group.exhausted_count for group in groups]
+            if sum(weights) > 0:
+                first = random.choices(groups, weights=weights)[0]
+                groups = [first] + [group for group in groups if group is not first]
+
+        while True:
+            candidates: List[KeyBucket] = []
+            for group in groups:
+                candidates = self._take_candidates(group)
+                if candidates:
+                    break
+            else:
+                if groups:
+                    self.throttled_picks += 1
+                return None
+
+            if self.policy == config.KEY_SELECTION_POLICY_LEAST_LOADED:
+                chosen = min(candidates, key=lambda candidate: self._load_cost(candidate, now))
+            else:
+                chosen = max(candidates, key=lambda candidate: self._headroom(candidate, now))
+            for bucket in reversed(candidates):
+                if bucket is not chosen:
+                    group.ready.appendleft(bucket)
+
+            if self.shared_counters is None:
+                break
+            wait = self.shared_counters.try_acquire(chosen.key_id, self.capacity, self.tokens_per_minute)
+            if not wait:
+                break  # 全局额度充足（已计入本次请求），或该Key无法使用共享计数
+            # 其他进程已用完该Key的全局额度，在额度恢复前不再选取
+            chosen.queued = False
+            self._block(chosen, now + wait)
+            self.shared_blocks += 1
+
+        chosen.in_flight += 1
+
+        if chosen.remaining_requests is not None:
+            chosen.remaining_requests -= 1  # 在下一个上游响应到达前先乐观地扣减
+        if self.capacity > 0:
+            self._refill(chosen, now)
+            chosen.tokens -= 1
+            if chosen.tokens < 1:
+                chosen.queued = False
+                self._mark_exhausted(chosen)
+                return self._key_config(chosen)
+        if self._is_saturated(chosen):
+            chosen.queued = False
+            self.saturated_parks += 1
+        else:
+            group.ready.append(chosen)
+        return self._key_config(chosen)
+
+    def _is_saturated(self, bucket: KeyBucket) -> bool:
+        return self.max_in_flight_per_key > 0 and bucket.in_flight >= self.max_in_flight_per_key
+
+    def peek(self, model: Optional[str] = None, upstream: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        返回一个能在upstream调用model且当前可用的Key配置，没有时返回None。
+
+        不消耗令牌、不增加在途请求数、不改变轮询位置，用于不计入请求统计的后台调用（例如刷新模型列表缓存）。
+        """
+        self._promote(time.monotonic())
+        for group in self._eligible_groups(model, upstream):
+            for bucket in group.ready:
+                if not bucket.exhausted and self._is_live(bucket):
+                    return self._key_config(bucket)
+        return None
+
+    def _take_candidates(self, group: KeyGroup) -> List[KeyBucket]:
+        candidates: List[KeyBucket] = []
+        while group.ready:
+            bucket = group.ready.popleft()
+            if bucket.exhausted or not self._is_live(bucket):
+                # 已删除或已换组的Key，或在就绪队列中被限流/冷却的Key（已经在最小堆中等待恢复）
+                bucket.queued = False
+                continue
+            if self._is_saturated(bucket):
+                # 在途请求已满（例如额度恢复后回到就绪队列的Key），移出就绪队列，release时放回
+                bucket.queued = False
+                self.saturated_parks += 1
+                continue
+            candidates.append(bucket)
+            if len(candidates) >= self.candidates:
+                break
+        return candidates
+
+    @staticmethod
+    def _key_config(bucket: KeyBucket) -> Dict[str, Any]:
+        return {"id": bucket.key_id, "api_key": bucket.api_key, "name": bucket.name}
+
+    def update_rate_limits(self, key_id: str, headers: Mapping[str, str]):
+        """
+        根据上游响应的 x-ratelimit-* 头更新Key的剩余额度。
+
+        剩余请求数或Token数低于阈值时，该Key在对应的重置时间之前不会被选取。
+        """
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return
+        now = time.monotonic()
+
+        remaining_requests = _parse_int_header(headers, "x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            bucket.remaining_requests = remaining_requests
+            bucket.limit_requests = _parse_int_header(headers, "x-ratelimit-limit-requests") or bucket.limit_requests
+            reset_seconds = parse_reset_duration(headers.get("x-ratelimit-reset-requests", ""))
+            bucket.requests_reset_at = now + reset_seconds if reset_seconds is not None else 0.0
+
+        remaining_tokens = _parse_int_header(headers, "x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            bucket.remaining_tokens = remaining_tokens
+            bucket.limit_tokens = _parse_int_header(headers, "x-ratelimit-limit-tokens") or bucket.limit_tokens
+            reset_seconds = parse_reset_duration(headers.get("x-ratelimit-reset-tokens", ""))
+            bucket.tokens_reset_at = now + reset_seconds if reset_seconds is not None else 0.0
+
+        blocked_until = 0.0
+        if bucket.remaining_requests is not None and bucket.remaining_requests < self.min_remaining_requests:
+            blocked_until = bucket.requests_reset_at
+        if bucket.remaining_tokens is not None and bucket.remaining_tokens < self.min_remaining_tokens:
+            blocked_until = max(blocked_until, bucket.tokens_reset_at)
+        if blocked_until > max(now, bucket.blocked_until):
+            self._block(bucket, blocked_until)
+            self.upstream_blocks += 1
+
+    def cooldown(self, key_id: str, retry_after_seconds: Optional[float] = None) -> float:
+        """
+        将Key放入内存中的冷却期（不修改数据库状态），到期后自动回到就绪队列，返回冷却秒数。
+
+        冷却时间按连续冷却次数指数增长（不超过上限），并且不短于上游给出的Retry-After。
+        """
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return 0.0
+        backoff = min(self.cooldown_max_seconds, self.cooldown_base_seconds * (2**bucket.cooldown_strikes))
+        bucket.cooldown_strikes += 1
+        duration = max(backoff, retry_after_seconds or 0.0)
+        now = time.monotonic()
+        if now + duration > bucket.blocked_until:
+            self._block(bucket, now + duration)
+        self.cooldowns += 1
+        return duration
+
+    def release(self, key_id: str):
+        """acquire选中的Key的请求结束（包括流式转发结束）；因在途请求已满移出就绪队列的Key放回队尾"""
+        bucket = self._buckets.get(key_id)
+        if bucket is None or bucket.in_flight <= 0:
+            return
+        bucket.in_flight -= 1
+        if not bucket.queued and not bucket.exhausted and not self._is_saturated(bucket):
+            bucket.queued = True
+            bucket.group.ready.append(bucket)
+        if self._released is not None:
+            self._released.set()
+            self._released = None
+
+    def released_event(self) -> asyncio.Event:
+        """返回在下一次release时被设置的事件，所有Key的在途请求都已满时用于等待名额"""
+        if self._released is None:
+            self._released = asyncio.Event()
+        return self._released
+
+    def in_flight_by_key(self) -> Dict[str, int]:
+        """在途请求数不为0的Key及其在途请求数"""
+        return {key_id: bucket.in_flight for key_id, bucket in self._buckets.items() if bucket.in_flight > 0}
+
+    def record_success(self, key_id: str, latency_seconds: Optional[float] = None, ttft_seconds: Optional[float] = None):
+        """Key调用成功后重置其冷却退避，并记录延迟和首字节时间"""
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return
+        bucket.cooldown_strikes = 0
+        if ttft_seconds is not None:
+            bucket.ttft_ewma = self._ewma(bucket.ttft_ewma, ttft_seconds)
+        self._observe(bucket, time.monotonic(), 0.0, latency_seconds)
+        if latency_seconds is not None:
+            self.latency_prior = self._ewma(self.latency_prior, latency_seconds)
+
+    def record_tokens(self, key_id: str, tokens: int):
+        """从Key的TPM额度中扣减一次请求实际消耗的Token数，额度用尽的Key在恢复前不会被选取"""
+        if self.tokens_per_minute <= 0 or tokens <= 0:
+            return
+        if self.shared_counters is not None:
+            self.shared_counters.add_tokens(key_id, tokens)
+        bucket = self._buckets.get(key_id)
+        if bucket is None:
+            return
+        now = time.monotonic()
+        bucket.tpm_budget = self._tpm_budget(bucket, now) - tokens
+        bucket.tpm_updated_at = now
+        if bucket.tpm_budget < 1:
+            self._mark_exhausted(bucket)
+
+    def record_failure(self, key_id: str):
+        """Key调用发生上游错误（5xx、429、连接/超时等），提高其错误率"""
+        bucket = self._buckets.get(key_id)
+        if bucket is not None:
+            self._observe(bucket, time.monotonic(), 1.0)
+
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        return sample if current is None else current + self.ewma_alpha * (sample - current)
+
+    def _observe(self, bucket: KeyBucket, now: float, error: float, latency_seconds: Optional[float] = None):
+        # 先把已有统计衰减到当前时间，再并入新的样本
+        bucket.error_rate = self._ewma(self._decayed_error_rate(bucket, now), error)
+        if latency_seconds is not None:
+            latency = self._decayed_latency(bucket, now) if bucket.latency_ewma is not None else None
+            bucket.latency_ewma = self._ewma(latency, latency_seconds)
+        elif bucket.latency_ewma is not None:
+            bucket.latency_ewma = self._decayed_latency(bucket, now)
+        bucket.observed_at = now
+
+    def _decay_factor(self, bucket: KeyBucket, now: float) -> float:
+        if self.decay_seconds <= 0:
+            return 1.0
+        return math.exp(-(now - bucket.observed_at) / self.decay_seconds)
+
+    def _decayed_latency(self, bucket: KeyBucket, now: float) -> Optional[float]:
+        """Key的延迟估计：距离上次记录越久越接近全局平均值，没有统计时使用全局平均值"""
+        if bucket.latency_ewma is None or self.latency_prior is None:
+            return bucket.latency_ewma if bucket.latency_ewma is not None else self.latency_prior
+        return self.latency_prior + (bucket.latency_ewma - self.latency_prior) * self._decay_factor(bucket, now)
+
+    def _decayed_error_rate(self, bucket: KeyBucket, now: float) -> float:
+        return bucket.error_rate * self._decay_factor(bucket, now)
+
+    def _load_cost(self, bucket: KeyBucket, now: float) -> float:
+        """least_loaded策略的负载代价：(在途请求数+1) x 延迟，错误率越高、剩余额度越少代价越高"""
+        latency = self._decayed_latency(bucket, now) or 1.0
+        cost = (bucket.in_flight + 1) * latency
+        cost /= max(0.05, 1.0 - self._decayed_error_rate(bucket, now))
+        return cost / max(0.05, self._headroom(bucket, now))
+
+    def _block(self, bucket: KeyBucket, blocked_until: float):
+        bucket.blocked_until = blocked_until
+        self._mark_exhausted(bucket)
+
+    def _mark_exhausted(self, bucket: KeyBucket):
+        # 每次恢复时间可能推迟时都压入新的堆条目，旧条目在取出时按恢复时间校验
+        if not bucket.exhausted:
+            bucket.exhausted = True
+            self._exhausted_count += 1
+            bucket.group.exhausted_count += 1
+        heapq.heappush(self._exhausted, (self._ready_at(bucket), next(self._heap_sequence), bucket))
+
+    def next_available_in(self, model: Optional[str] = None, upstream: Optional[str] = None) -> Optional[float]:
+        """能在upstream调用model的Key都不可用时，返回最早有Key恢复的剩余秒数；否则返回None"""
+        groups = self._eligible_groups(model, upstream)
+        if not groups or any(group.exhausted_count < group.size for group in groups):
+            return None
+        while self._exhausted and not (self._exhausted[0][2].exhausted and self._is_live(self._exhausted[0][2])):
+            heapq.heappop(self._exhausted)
+        if not self._exhausted:
+            return None
+        if len(groups) == len(self._groups):
+            ready_at = self._exhausted[0][0]
+        else:
+            # 只有部分组可用时扫描最小堆（仅在这些组的Key全部不可用时发生）
+            ready_at = min(
+                (entry[0] for entry in self._exhausted
+                 if entry[2].exhausted and self._is_live(entry[2]) and entry[2].group in groups),
+                default=None,
+            )
+            if ready_at is None:
+                return None
+        return max(0.0, ready_at - time.monotonic())
+
+    def _promote(self, now: float):
+        # 将已经恢复的Key移回就绪队列；恢复时间被推迟的旧堆条目直接丢弃（已有新的条目）
+        while self._exhausted and self._exhausted[0][0] <= now:
+            _, _, bucket = heapq.heappop(self._exhausted)
+            if not bucket.exhausted or not self._is_live(bucket) or self._ready_at(bucket) > now:
+                continue
+            bucket.exhausted = False
+            self._exhausted_count -= 1
+            bucket.group.exhausted_count -= 1
+            if not bucket.queued:
+                bucket.queued = True
+                bucket.group.ready.append(bucket)
+
+    def _refill(self, bucket: KeyBucket, now: float):
+        if self.refill_rate > 0:
+            bucket.tokens = min(float(self.capacity), bucket.tokens + (now - bucket.updated_at) * self.refill_rate)
+        bucket.updated_at = now
+
+    def _tpm_budget(self, bucket: KeyBucket, now: float) -> float:
+        return min(float(self.tokens_per_minute), bucket.tpm_budget + (now - bucket.tpm_updated_at) * self.tpm_refill_rate)
+
+    def _ready_at(self, bucket: KeyBucket) -> float:
+        """Key恢复可用的时间：上游限流解除、令牌桶至少有一个令牌且TPM额度至少有一个Token"""
+        ready_at = bucket.blocked_until
+        if self.capacity > 0 and bucket.tokens < 1:
+            if self.refill_rate <= 0:
+                return float("inf")
+            ready_at = max(ready_at, bucket.updated_at + (1 - bucket.tokens) / self.refill_rate)
+        if self.tokens_per_minute > 0 and bucket.tpm_budget < 1:
+            ready_at = max(ready_at, bucket.tpm_updated_at + (1 - bucket.tpm_budget) / self.tpm_refill_rate)
+        return ready_at
+
+    def _headroom(self, bucket: KeyBucket, now: float) -> float:
+        """上游剩余额度比例（0~1，未知或已过重置时间时视为1），配置了TPM上限时同时考虑本地TPM剩余额度比例"""
+        headroom = 1.0
+        if bucket.remaining_requests is not None and bucket.limit_requests and now < bucket.requests_reset_at:
+            headroom = min(headroom, bucket.remaining_requests / bucket.limit_requests)
+        if bucket.remaining_tokens is not None and bucket.limit_tokens and now < bucket.tokens_reset_at:
+            headroom = min(headroom, bucket.remaining_tokens / bucket.limit_tokens)
+        if self.tokens_per_minute > 0:
+            headroom = min(headroom, max(0.0, self._tpm_budget(bucket, now) / self.tokens_per_minute))
+        return headroom
+
+    def stats(self, max_keys: Optional[int] = None) -> Dict[str, Any]:
+        """返回调度器统计信息，max_keys限制逐个列出的Key数量（Key很多时避免生成过大的响应）"""
+        now = time.monotonic()
+        keys = {}
+        for key_id, bucket in itertools.islice(self._buckets.items(), max_keys):
+            tokens = bucket.tokens
+            if self.refill_rate > 0:
+                tokens = min(float(self.capacity), tokens + (now - bucket.updated_at) * self.refill_rate)
+            latency = self._decayed_latency(bucket, now) if bucket.latency_ewma is not None else None
+            keys[key_id] = {
+                "tokens": round(tokens, 2) if self.capacity > 0 else None,
+                "tpm_budget": round(self._tpm_budget(bucket, now)) if self.tokens_per_minute > 0 else None,
+                "exhausted": bucket.exhausted,
+                "upstream_remaining_requests": bucket.remaining_requests,
+                "upstream_remaining_tokens": bucket.remaining_tokens,
+                "upstream_headroom": round(self._headroom(bucket, now), 4),
+                "blocked_for_seconds": round(max(0.0, bucket.blocked_until - now), 3),
+                "cooldown_strikes": bucket.cooldown_strikes,
+                "in_flight": bucket.in_flight,
+                "latency_ewma_ms": round(latency * 1000, 1) if latency is not None else None,
+                "ttft_ewma_ms": round(bucket.ttft_ewma * 1000, 1) if bucket.ttft_ewma is not None else None,
+                "error_rate": round(self._decayed_error_rate(bucket, now), 4),
+                "models": sorted(bucket.group.models) if bucket.group.models is not None else None,
+                "upstream": bucket.group.upstream,
+            }
+            if self.shared_counters is not None:
+                shared_usage = self.shared_counters.usage(key_id)
+                keys[key_id]["shared_requests_in_window"] = shared_usage[0] if shared_usage is not None else None
+                keys[key_id]["shared_tokens_in_last_minute"] = shared_usage[1] if shared_usage is not None else None
+        next_available_in = self.next_available_in()
+        return {
+            "policy": self.policy,
+            "capacity_per_window": round(self.capacity, 2),
+            "capacity_share": round(self.capacity_share, 4),
+            "refill_per_second": round(self.refill_rate, 4),
+            "tokens_per_minute": round(self.tokens_per_minute),
+            "version": self.version,
+            "active_keys": len(self._buckets),
+            "ready_keys": len(self._buckets) - self._exhausted_count,
+            "exhausted_keys": self._exhausted_count,
+            "model_groups": len(self._groups),
+            "throttled_picks": self.throttled_picks,
+            "upstream_blocks": self.upstream_blocks,
+            "cooldowns": self.cooldowns,
+            "shared_blocks": self.shared_blocks,
+            "max_in_flight_per_key": self.max_in_flight_per_key,
+            "saturated_parks": self.saturated_parks,
+            "shared_counters": self.shared_counters.stats() if self.shared_counters is not None else None,
+            "next_available_in_seconds": round(next_available_in, 3) if next_available_in is not None else None,
+            "keys": keys,
+        }
+
+
+scheduler = KeyScheduler(
+    capacity=config.MAX_CALLS_PER_KEY_PER_WINDOW,
+    window_seconds=config.USAGE_WINDOW_SECONDS,
+    min_remaining_requests=config.RATE_LIMIT_MIN_REMAINING_REQUESTS,
+    min_remaining_tokens=config.RATE_LIMIT_MIN_REMAINING_TOKENS,
+    candidates=(
+        config.KEY_SELECTION_CANDIDATES
+        if config.KEY_SELECTION_POLICY == config.KEY_SELECTION_POLICY_LEAST_LOADED
+        else config.RATE_LIMIT_ROUTING_CANDIDATES
+    ),
+    cooldown_base_seconds=config.KEY_COOLDOWN_BASE_SECONDS,
+    cooldown_max_seconds=config.KEY_COOLDOWN_MAX_SECONDS,
+    policy=config.KEY_SELECTION_POLICY,
+    ewma_alpha=config.KEY_SELECTION_EWMA_ALPHA,
+    decay_seconds=config.KEY_SELECTION_DECAY_SECONDS,
+    tokens_per_minute=config.TOKEN_USAGE_TPM_PER_KEY,
+    max_in_flight_per_key=config.ADMISSION_MAX_INFLIGHT_PER_KEY,
+)
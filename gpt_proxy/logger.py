@@ -20,9 +20,15 @@ LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s - %(message)s"
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 
+# 数据目录（配置文件、SQLite数据库、日志等），默认为项目根目录下的data，可通过环境变量GPT_PROXY_DATA_DIR指定
+DATA_DIR = os.environ.get("GPT_PROXY_DATA_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"
+)
+
+
 # 确保日志目录存在
 def ensure_log_dir():
-    log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "logs")
+    log_dir = os.path.join(DATA_DIR, "logs")
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
     return log_dir
@@ -10,6 +10,14 @@ from datetime import timedelta
 from . import schemas
 from . import config
 from . import utils
+from . import http_client
+from . import usage_writer
+from . import upstreams
+from . import key_pool_sync
+from . import key_scheduler
+from . import shared_counters
+from . import key_leases
+from . import drain
 from .routers import chat, admin
 from . import logger
 from . import database as db
@@ -19,6 +27,7 @@ from . import database as db
 app = FastAPI()
 app.include_router(chat.router)
 app.include_router(admin.router)
+app.add_middleware(drain.DrainMiddleware)
 
 # 获取目录路径
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -103,18 +112,78 @@ async def startup_event():
     
     logger.info("应用启动：正在从数据库更新OpenAI密钥循环。")
     utils.api_key_usage.clear()
+    await key_pool_sync.sync.start()
+    if config.SHARED_COUNTERS_ENABLED and shared_counters.counters.open():
+        logger.info("应用启动：使用多进程共享的Key计数器检查每Key的全局调用次数和TPM额度。")
+        key_scheduler.scheduler.use_shared_counters(shared_counters.counters)
+    await key_leases.manager.start()
     await utils.update_openai_key_cycle()
+    utils.start_key_pool_resync_loop()
+
+    if config.RESPONSE_CACHE_ENABLED and config.RESPONSE_CACHE_PERSIST:
+        expired_count = await db.delete_expired_cached_responses()
+        logger.info(f"应用启动：已清理 {expired_count} 条过期的持久化响应缓存。")
+
+    logger.info("应用启动：初始化共享上游HTTP客户端。")
+    await http_client.init_http_client()
+
+    if config.UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS > 0:
+        logger.info(f"应用启动：启动 {len(upstreams.pool.upstreams)} 个上游的定期健康检查。")
+    upstreams.pool.start_health_checks()
+
+    logger.info("应用启动：启动使用记录批量写入任务。")
+    usage_writer.writer.start()
 
     logger.info("应用启动：代理API密钥已在配置模块导入时加载。")
 
+    drain.controller.attach_to_server()
+    drain.controller.ready = True
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """应用关闭：断开数据库连接"""
+    """应用关闭：等待在途请求完成，关闭上游HTTP客户端，写入待处理的使用记录后断开数据库连接"""
+    # uvicorn关闭时已在后台开始排空，这里等待同一次排空结束；其他方式关闭时在这里排空
+    await drain.controller.drain()
+
+    utils.stop_key_pool_resync_loop()
+    key_pool_sync.sync.stop()
+    upstreams.pool.stop_health_checks()
+
+    logger.info("应用关闭：关闭共享上游HTTP客户端。")
+    await http_client.close_http_client()
+
+    logger.info(f"应用关闭：写入 {usage_writer.writer.pending_count()} 条待处理的使用记录。")
+    await usage_writer.writer.stop()
+
+    await key_leases.manager.stop()
+    key_scheduler.scheduler.use_shared_counters(None)
+    shared_counters.counters.close()
+
     logger.info("应用关闭：断开数据库连接。")
     await db.disconnect_from_db()
 
 
+# --- 健康检查 ---
+
+
+@app.get("/health/live", tags=["Health"])
+async def liveness():
+    """存活检查：进程能够处理请求时总是返回200（排空期间也是），同时返回排空状态和在途请求数"""
+    return {"status": "draining" if drain.controller.draining else "alive", **drain.controller.stats()}
+
+
+@app.get("/health/ready", tags=["Health"])
+async def readiness():
+    """就绪检查：启动完成、数据库已连接且未在排空时返回200，否则返回503，负载均衡器据此停止转发新请求"""
+    stats = drain.controller.stats()
+    if drain.controller.draining:
+        return JSONResponse(status_code=503, content={"status": "draining", **stats})
+    if not drain.controller.ready or not db.database.is_connected:
+        return JSONResponse(status_code=503, content={"status": "starting", **stats})
+    return {"status": "ready", **stats}
+
+
 # --- 辅助函数 ---
 
 
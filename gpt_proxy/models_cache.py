@@ -0,0 +1,174 @@
+"""
+/v1/models 模型列表缓存
+
+在进程内缓存上游返回的模型列表，接近过期时在后台刷新（stale-while-revalidate），过期后同步刷新，
+刷新失败时继续使用旧数据。刷新时向每个可用的上游各发起一次调用并合并模型列表，
+使用的Key不占用调用额度和在途名额，且不计入请求使用统计。
+"""
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+import httpx
+
+from . import config
+from . import http_client
+from . import key_models
+from . import key_scheduler
+from . import logger
+from . import retry_policy
+from . import utils
+from . import upstreams
+
+# 缓存模型列表时保留的上游响应头
+CACHED_RESPONSE_HEADERS = ("content-type",)
+
+
+class ModelsListEntry(NamedTuple):
+    """缓存的模型列表响应"""
+
+    body: bytes
+    headers: Dict[str, str]
+    etag: str
+    fetched_at: float  # time.monotonic() 时间戳
+
+
+_entry: Optional[ModelsListEntry] = None
+_refresh_task: Optional["asyncio.Task[bool]"] = None
+
+
+def build_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """检查请求的If-None-Match头是否与当前ETag匹配（支持多个值、'*'及弱校验前缀W/）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+
+def update(body: bytes, upstream_headers: Mapping[str, str]) -> ModelsListEntry:
+    """用新的上游响应更新缓存"""
+    global _entry
+    headers = {name: upstream_headers[name] for name in CACHED_RESPONSE_HEADERS if name in upstream_headers}
+    _entry = ModelsListEntry(body=body, headers=headers, etag=build_etag(body), fetched_at=time.monotonic())
+    return _entry
+
+
+def invalidate():
+    global _entry
+    _entry = None
+
+
+def merge_models_lists(upstream_bodies: List[Tuple[upstreams.Upstream, bytes]]) -> bytes:
+    """
+    合并多个上游的/v1/models响应：按模型ID去重（按上游配置顺序，先出现的优先），
+    只保留各上游提供的模型（models配置），并加入model_map中目标模型存在的模型别名。
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for upstream, body in upstream_bodies:
+        try:
+            data = json.loads(body).get("data")
+        except (ValueError, AttributeError):
+            continue
+        if not isinstance(data, list):
+            continue
+        items = {str(item["id"]): item for item in data if isinstance(item, dict) and item.get("id")}
+        for alias, target in upstream.model_map.items():
+            if target in items and alias not in items:
+                items[alias] = {**items[target], "id": alias}
+        for model_id, item in items.items():
+            if upstream.serves(model_id):
+                merged.setdefault(model_id, item)
+    return json.dumps({"object": "list", "data": list(merged.values())}).encode("utf-8")
+
+
+async def _fetch_upstream_models(upstream: upstreams.Upstream) -> Optional[httpx.Response]:
+    """使用一个可用的Key请求上游的模型列表（不占用Key的调用额度和在途名额），失败时返回None"""
+    key_config = key_scheduler.scheduler.peek(upstream=upstream.name)
+    if key_config is None:
+        logger.warning(f"刷新上游 {upstream.name} 的模型列表失败：无可用OpenAI API Key。")
+        return None
+
+    model_timeouts = retry_policy.get_model_timeouts(None)
+    try:
+        response = await http_client.get_http_client().get(
+            upstream.models_url,
+            headers={"Authorization": f"Bearer {key_config['api_key']}"},
+            timeout=httpx.Timeout(model_timeouts.read, connect=model_timeouts.connect),
+        )
+    except Exception as e:
+        logger.warning(f"刷新上游 {upstream.name} 的模型列表时发生错误 (Key ID: {key_config['id']}): {e}")
+        return None
+    if response.status_code != 200:
+        logger.warning(f"刷新上游 {upstream.name} 的模型列表失败 (Key ID: {key_config['id']}): {response.status_code}")
+        return None
+
+    try:
+        await key_models.remember_models_response(str(key_config["id"]), response.content)
+    except Exception as e:
+        logger.error(f"根据模型列表更新Key ID {key_config['id']} 的可调用模型时发生错误: {e}")
+    return response
+
+
+async def _refresh() -> bool:
+    """从每个可用的上游获取模型列表，合并后更新缓存；不记录API Key使用情况"""
+    if key_scheduler.scheduler.size() == 0:
+        await utils.update_openai_key_cycle()
+    available = [upstream for upstream in upstreams.pool.upstreams if upstream.is_available()]
+    if not available:
+        logger.warning("刷新模型列表缓存失败：没有可用的上游（健康检查失败或熔断中）。")
+        return False
+
+    responses = await asyncio.gather(*(_fetch_upstream_models(upstream) for upstream in available))
+    fetched = [(upstream, response) for upstream, response in zip(available, responses) if response is not None]
+    if not fetched:
+        return False
+
+    upstream, response = fetched[0]
+    if len(upstreams.pool.upstreams) == 1 and upstream.models is None and not upstream.model_map:
+        # 只有一个上游且不需要过滤或映射模型时原样缓存上游的响应
+        update(response.content, response.headers)
+    else:
+        update(
+            merge_models_lists([(upstream, response.content) for upstream, response in fetched]),
+            {"content-type": "application/json"},
+        )
+    logger.info(f"模型列表缓存已刷新（{len(fetched)}/{len(available)} 个可用上游）。")
+    return True
+
+
+def _start_refresh() -> "asyncio.Task[bool]":
+    """启动刷新任务；已有刷新在进行时复用同一个任务"""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.ensure_future(_refresh())
+    return _refresh_task
+
+
+async def get_models_list() -> Optional[ModelsListEntry]:
+    """
+    获取缓存的模型列表。
+
+    缓存新鲜时直接返回；进入提前刷新窗口时返回缓存并在后台刷新；
+    已过期或为空时等待刷新完成，刷新失败则返回旧数据（可能为None）。
+    """
+    entry = _entry
+    if entry is not None:
+        age = time.monotonic() - entry.fetched_at
+        if age < config.MODELS_CACHE_TTL_SECONDS:
+            if age >= config.MODELS_CACHE_TTL_SECONDS - config.MODELS_CACHE_REFRESH_AHEAD_SECONDS:
+                _start_refresh()
+            return entry
+
+    await asyncio.shield(_start_refresh())
+    return _entry
@@ -0,0 +1,196 @@
+"""
+非流式聊天补全的精确匹配响应缓存
+
+以请求体规范化后的哈希为键，在内存中按条目数和字节数限制并使用LRU淘汰和TTL过期，
+可选持久化到数据库的response_cache表，使重启后缓存仍然有效。命中时跳过密钥选择和上游调用。
+
+只描述单次上游调用的响应头（请求ID、处理耗时、当时的限流余量）不写入缓存，命中时响应带 x-proxy-cache: HIT。
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+
+from starlette.datastructures import Headers
+
+from . import config
+from . import database as db
+from . import logger
+
+# 只属于单次上游调用的响应头，缓存命中时重放会误导客户端
+PER_REQUEST_HEADERS = ("x-request-id", "openai-processing-ms")
+PER_REQUEST_HEADER_PREFIXES = ("x-ratelimit-",)
+
+
+class CachedResponse(NamedTuple):
+    """缓存的上游响应"""
+
+    body: bytes
+    headers: Dict[str, str]
+    expires_at: float  # time.time() 时间戳
+
+
+class ResponseCache:
+    """按条目数和字节数限制的LRU内存缓存，支持TTL过期"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, cache_key: str) -> Optional[CachedResponse]:
+        """从内存中获取未过期的缓存条目，并将其标记为最近使用"""
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._remove(cache_key)
+            return None
+        self._entries.move_to_end(cache_key)
+        return entry
+
+    def put(self, cache_key: str, entry: CachedResponse) -> bool:
+        """写入缓存条目，必要时淘汰最久未使用的条目；单个条目超过字节上限时不缓存"""
+        if len(entry.body) > self.max_bytes:
+            return False
+        if cache_key in self._entries:
+            self._remove(cache_key)
+        self._entries[cache_key] = entry
+        self._total_bytes += len(entry.body)
+        while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self._total_bytes = 0
+
+    def _remove(self, cache_key: str):
+        entry = self._entries.pop(cache_key)
+        self._total_bytes -= len(entry.body)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": config.RESPONSE_CACHE_ENABLED,
+            "persist": config.RESPONSE_CACHE_PERSIST,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+memory_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=config.RESPONSE_CACHE_MAX_BYTES,
+    ttl_seconds=config.RESPONSE_CACHE_TTL_SECONDS,
+)
+
+
+def is_bypass_requested(request_headers: Headers) -> bool:
+    """客户端通过 Cache-Control: no-cache 或 no-store 请求绕过缓存"""
+    cache_control = request_headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+
+def build_cache_key(raw_body: bytes) -> Optional[str]:
+    """
+    计算请求体的规范化哈希作为缓存键；请求不可缓存时返回None。
+
+    配置 deterministic_only = true 时只缓存 temperature=0 且 n 不大于1 的请求。
+    """
+    try:
+        payload = json.loads(raw_body)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict) or payload.get("stream") is True:
+        return None
+    if config.RESPONSE_CACHE_DETERMINISTIC_ONLY:
+        if payload.get("temperature") != 0 or payload.get("n") not in (None, 1):
+            return None
+
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def cacheable_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """去掉只属于单次上游调用的响应头（头部名称为小写）"""
+    return {
+        name: value
+        for name, value in headers.items()
+        if name not in PER_REQUEST_HEADERS and not name.startswith(PER_REQUEST_HEADER_PREFIXES)
+    }
+
+
+async def lookup(cache_key: str) -> Optional[CachedResponse]:
+    """先查内存，未命中且启用持久化时再查数据库，并更新命中/未命中计数"""
+    entry = memory_cache.get(cache_key)
+    if entry is None and config.RESPONSE_CACHE_PERSIST:
+        try:
+            row = await db.get_cached_response(cache_key)
+        except Exception as e:
+            logger.error(f"读取持久化响应缓存失败: {e}")
+            row = None
+        if row is not None and row["expires_at"] > datetime.now():
+            entry = CachedResponse(
+                body=bytes(row["body"]),
+                headers=cacheable_headers(json.loads(row["headers"])) if row["headers"] else {},
+                expires_at=row["expires_at"].timestamp(),
+            )
+            memory_cache.put(cache_key, entry)
+
+    if entry is None:
+        memory_cache.misses += 1
+    else:
+        memory_cache.hits += 1
+    return entry
+
+
+def store(cache_key: str, body: bytes, headers: Dict[str, str]) -> CachedResponse:
+    """将成功的上游响应写入内存缓存（不保存只属于本次上游调用的响应头）"""
+    entry = CachedResponse(
+        body=body, headers=cacheable_headers(headers), expires_at=time.time() + memory_cache.ttl_seconds
+    )
+    if memory_cache.put(cache_key, entry):
+        memory_cache.stores += 1
+    return entry
+
+
+async def persist(cache_key: str, entry: CachedResponse):
+    """将缓存条目持久化到数据库（在响应发送后作为后台任务执行）"""
+    try:
+        await db.save_cached_response(
+            cache_key, entry.body, json.dumps(entry.headers), datetime.fromtimestamp(entry.expires_at)
+        )
+    except Exception as e:
+        logger.error(f"持久化响应缓存失败: {e}")
+
+
+async def clear():
+    """清空内存缓存及持久化的缓存表"""
+    memory_cache.clear()
+    if config.RESPONSE_CACHE_PERSIST:
+        await db.clear_cached_responses()
+
+
+def get_stats() -> Dict[str, Any]:
+    return memory_cache.stats()
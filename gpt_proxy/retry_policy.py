@@ -0,0 +1,122 @@
+"""
+重试策略模块
+
+负责对上游失败进行分类（密钥问题、上游问题、客户端问题），计算带抖动的指数退避时间，
+维护在多次尝试间共享的请求总截止时间，并按模型提供连接/读取/空闲超时设置。
+"""
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Mapping, NamedTuple, Optional
+
+import httpx
+
+from . import config
+
+# 失败分类
+FAULT_KEY = "key"  # 密钥问题：换下一个Key立即重试
+FAULT_UPSTREAM = "upstream"  # 上游问题：退避后重试
+FAULT_CLIENT = "client"  # 客户端问题：重试无意义，直接返回给客户端
+
+# 由密钥本身导致的状态码（认证失败、额度不足、无权限、限流）
+KEY_FAULT_STATUS_CODES = {401, 402, 403, 429}
+# 由客户端请求本身导致的状态码；404只有在上游表示该Key不能调用所请求的模型（model_not_found）时才属于密钥问题，
+# 其他404（路径错误、部署不存在等）换Key重试同样会失败
+CLIENT_FAULT_STATUS_CODES = {400, 404, 405, 409, 413, 415, 422}
+
+
+class ModelTimeouts(NamedTuple):
+    """单个模型的上游超时设置（秒）"""
+
+    connect: float
+    read: float
+    idle: float
+
+
+def classify_status_code(status_code: int, model_not_found: bool = False) -> str:
+    """根据上游响应状态码对失败进行分类；model_not_found表示上游错误为该Key不能调用所请求的模型（见key_models.is_model_not_found）"""
+    if model_not_found or status_code in KEY_FAULT_STATUS_CODES:
+        return FAULT_KEY
+    if status_code in CLIENT_FAULT_STATUS_CODES:
+        return FAULT_CLIENT
+    return FAULT_UPSTREAM
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """解析上游的 retry-after-ms 或 Retry-After 头（秒数或HTTP日期），返回秒数，不存在或无法解析时返回None"""
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def compute_backoff_seconds(attempt: int) -> float:
+    """计算第attempt次（从0开始）失败后的退避时间，使用full jitter指数退避"""
+    backoff_cap = min(config.RETRY_BACKOFF_MAX_SECONDS, config.RETRY_BACKOFF_BASE_SECONDS * (2**attempt))
+    return random.uniform(0, backoff_cap)
+
+
+def get_model_timeouts(model: Optional[str]) -> ModelTimeouts:
+    """
+    获取指定模型的超时设置。
+
+    优先精确匹配[Model_Timeouts]中的模型名，其次匹配以'*'结尾的最长前缀，否则使用默认超时。
+    """
+    if model:
+        if model in config.MODEL_TIMEOUTS:
+            return ModelTimeouts(*config.MODEL_TIMEOUTS[model])
+        best_prefix = None
+        for pattern in config.MODEL_TIMEOUTS:
+            if pattern.endswith("*") and model.startswith(pattern[:-1]):
+                if best_prefix is None or len(pattern) > len(best_prefix):
+                    best_prefix = pattern
+        if best_prefix is not None:
+            return ModelTimeouts(*config.MODEL_TIMEOUTS[best_prefix])
+    return ModelTimeouts(
+        config.UPSTREAM_CONNECT_TIMEOUT, config.UPSTREAM_READ_TIMEOUT, config.UPSTREAM_IDLE_TIMEOUT
+    )
+
+
+class RequestDeadline:
+    """在同一请求的所有尝试间共享的总截止时间"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """剩余时间（秒），不小于0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def build_timeout(self, timeouts: ModelTimeouts, is_stream: bool) -> httpx.Timeout:
+        """
+        构建单次尝试的httpx超时，连接和读取时间不超过剩余截止时间。
+
+        流式请求的读取超时取read和idle中较大者，首个事件和空闲间隔由调用方分别限制。
+        """
+        remaining = self.remaining()
+        connect_timeout = min(timeouts.connect, remaining)
+        if is_stream:
+            read_timeout = max(timeouts.read, timeouts.idle)
+        else:
+            read_timeout = min(timeouts.read, remaining)
+        return httpx.Timeout(connect=connect_timeout, read=read_timeout, write=connect_timeout, pool=connect_timeout)
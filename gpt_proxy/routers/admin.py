@@ -1,5 +1,4 @@
 from datetime import datetime
-import httpx
 
 from fastapi import APIRouter, HTTPException, Depends
 
@@ -9,6 +8,17 @@ from .. import utils
 from .. import database as db
 from .. import dependencies
 from .. import logger
+from .. import http_client
+from .. import response_cache
+from .. import single_flight
+from .. import admission
+from .. import usage_writer
+from .. import key_scheduler
+from .. import key_models
+from .. import circuit_breaker
+from .. import upstreams
+from .. import key_pool_sync
+from .. import key_leases
 
 router = APIRouter(
     prefix="/api",
@@ -28,116 +38,23 @@ async def revalidate_all_inactive_keys(current_user: dict = Depends(dependencies
 
     # 使用客户端测试每个API密钥
     validation_results = []
-    async with httpx.AsyncClient() as client:
-        for key in inactive_keys:
-            key_id = key["id"]
-            key_name = key.get("name", "无名称")
-            key_value = key["api_key"]
-            key_suffix = key_value[-4:] if key_value else "N/A"  # 用于展示密钥末尾，保持隐私
-            try:
-                # 使用聊天接口验证API密钥
-                chat_payload = {
-                    "model": "gpt-4.1-mini",
-                    "messages": [{"role": "user", "content": "Hello"}],
-                    "max_tokens": 10,
-                    "temperature": 0.1,
-                }
-
-                resp = await client.post(
-                    config.OPENAI_API_ENDPOINT,
-                    headers={"Authorization": f"Bearer {key_value}", "Content-Type": "application/json"},
-                    json=chat_payload,
-                    timeout=15.0,
-                )
-
-                if resp.status_code == 200:
-                    # 密钥有效，将其设置为活动状态
-                    await db.update_api_key_status(key_id, config.KEY_STATUS_ACTIVE)
-                    # 记录成功的验证请求
-                    await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status="validation_success")
-                    logger.info(
-                        f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 使用聊天接口重新验证成功。状态已更新为 '{config.KEY_STATUS_ACTIVE}'。"
-                    )
-                    validation_results.append(
-                        {
-                            "key_id": key_id,
-                            "name": key_name,
-                            "suffix": key_suffix,
-                            "success": True,
-                            "new_status": config.KEY_STATUS_ACTIVE,
-                            "validation_method": "chat_interface",
-                        }
-                    )
-                else:
-                    # 密钥无效
-                    try:
-                        error_detail = resp.json().get("error", {}).get("message", "未知错误")
-                    except:
-                        error_detail = f"HTTP {resp.status_code}"
-                    
-                    # 记录失败的验证请求
-                    await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status=f"validation_failed_{resp.status_code}")
-
-                    logger.warning(
-                        f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 验证失败，状态码 {resp.status_code}。错误: {error_detail}"
-                    )
-                    validation_results.append(
-                        {
-                            "key_id": key_id,
-                            "name": key_name,
-                            "suffix": key_suffix,
-                            "success": False,
-                            "status_code": resp.status_code,
-                            "error": error_detail,
-                            "validation_method": "chat_interface",
-                        }
-                    )
-            except Exception as e:
-                # 记录异常的验证请求
-                await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status="validation_error")
-                
-                logger.error(f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 重新验证请求错误: {e}")
-                validation_results.append(
-                    {
-                        "key_id": key_id,
-                        "name": key_name,
-                        "suffix": key_suffix,
-                        "success": False,
-                        "error": str(e),
-                        "validation_method": "chat_interface",
-                    }
-                )
-
-    # 更新OpenAI密钥循环以反映新的有效密钥
-    await utils.update_openai_key_cycle()
-    return {"message": f"验证了 {len(inactive_keys)} 个无效的密钥", "results": validation_results}
-
-
-@router.post("/validate_key/{key_id}", tags=["Admin API Keys Management"])
-async def validate_single_key(key_id: str, current_user: dict = Depends(dependencies.get_current_admin_user)):
-    """验证单个API Key的有效性 - 使用聊天接口验证"""
-    # 获取指定的密钥
-    key = await db.get_api_key_by_id(key_id)
-    if not key:
-        raise HTTPException(status_code=404, detail=f"未找到ID为 {key_id} 的API Key")
-    
-    key_name = key.get("name", "无名称")
-    key_value = key["api_key"]
-    key_suffix = key_value[-4:] if key_value else "N/A"
-    logger.info(f"开始验证密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix})")
-
-    try:
-        async with httpx.AsyncClient() as client:
+    client = http_client.get_http_client()
+    for key in inactive_keys:
+        key_id = key["id"]
+        key_name = key.get("name", "无名称")
+        key_value = key["api_key"]
+        key_suffix = key_value[-4:] if key_value else "N/A"  # 用于展示密钥末尾，保持隐私
+        try:
             # 使用聊天接口验证API密钥
             chat_payload = {
-                "model": "gpt-4o-mini",
+                "model": "gpt-4.1-mini",
                 "messages": [{"role": "user", "content": "Hello"}],
                 "max_tokens": 10,
                 "temperature": 0.1,
             }
 
             resp = await client.post(
-                config.OPENAI_API_ENDPOINT,
+                upstreams.pool.resolve(key.get("upstream")).chat_completions_url,
                 headers={"Authorization": f"Bearer {key_value}", "Content-Type": "application/json"},
                 json=chat_payload,
                 timeout=15.0,
@@ -146,52 +63,146 @@ async def validate_single_key(key_id: str, current_user: dict = Depends(dependen
             if resp.status_code == 200:
                 # 密钥有效，将其设置为活动状态
                 await db.update_api_key_status(key_id, config.KEY_STATUS_ACTIVE)
+                utils.add_key_to_pool(key)
+                key_models.schedule_learn(key_id, key_value)
                 # 记录成功的验证请求
-                await utils.record_api_key_usage(key_id, model="gpt-4o-mini", status="validation_success")
+                await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status="validation_success")
                 logger.info(
-                    f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 验证成功。状态已更新为 '{config.KEY_STATUS_ACTIVE}'。"
+                    f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 使用聊天接口重新验证成功。状态已更新为 '{config.KEY_STATUS_ACTIVE}'。"
+                )
+                validation_results.append(
+                    {
+                        "key_id": key_id,
+                        "name": key_name,
+                        "suffix": key_suffix,
+                        "success": True,
+                        "new_status": config.KEY_STATUS_ACTIVE,
+                        "validation_method": "chat_interface",
+                    }
                 )
-                # 更新OpenAI密钥循环以反映新的有效密钥
-                await utils.update_openai_key_cycle()
-                
-                return {
-                    "success": True,
-                    "message": "API Key验证成功，状态已更新为有效",
-                    "key_id": key_id,
-                    "name": key_name,
-                    "suffix": key_suffix,
-                    "new_status": config.KEY_STATUS_ACTIVE,
-                    "validation_method": "chat_interface",
-                }
             else:
-                # 密钥无效，确保状态为无效
-                if key["status"] != config.KEY_STATUS_INACTIVE:
-                    await db.update_api_key_status(key_id, config.KEY_STATUS_INACTIVE)
-                    await utils.update_openai_key_cycle()
-                
+                # 密钥无效
                 try:
                     error_detail = resp.json().get("error", {}).get("message", "未知错误")
                 except:
                     error_detail = f"HTTP {resp.status_code}"
-
-                # 记录失败的验证请求
-                await utils.record_api_key_usage(key_id, model="gpt-4o-mini", status=f"validation_failed_{resp.status_code}")
                 
+                # 记录失败的验证请求
+                await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status=f"validation_failed_{resp.status_code}")
+
                 logger.warning(
                     f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 验证失败，状态码 {resp.status_code}。错误: {error_detail}"
                 )
-                
-                return {
-                    "success": False,
-                    "message": f"API Key验证失败: {error_detail}",
+                validation_results.append(
+                    {
+                        "key_id": key_id,
+                        "name": key_name,
+                        "suffix": key_suffix,
+                        "success": False,
+                        "status_code": resp.status_code,
+                        "error": error_detail,
+                        "validation_method": "chat_interface",
+                    }
+                )
+        except Exception as e:
+            # 记录异常的验证请求
+            await utils.record_api_key_usage(key_id, model="gpt-4.1-mini", status="validation_error")
+            
+            logger.error(f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 重新验证请求错误: {e}")
+            validation_results.append(
+                {
                     "key_id": key_id,
                     "name": key_name,
                     "suffix": key_suffix,
-                    "status_code": resp.status_code,
-                    "error": error_detail,
+                    "success": False,
+                    "error": str(e),
                     "validation_method": "chat_interface",
                 }
-                
+            )
+
+    return {"message": f"验证了 {len(inactive_keys)} 个无效的密钥", "results": validation_results}
+
+
+@router.post("/validate_key/{key_id}", tags=["Admin API Keys Management"])
+async def validate_single_key(key_id: str, current_user: dict = Depends(dependencies.get_current_admin_user)):
+    """验证单个API Key的有效性 - 使用聊天接口验证"""
+    # 获取指定的密钥
+    key = await db.get_api_key_by_id(key_id)
+    if not key:
+        raise HTTPException(status_code=404, detail=f"未找到ID为 {key_id} 的API Key")
+    
+    key_name = key.get("name", "无名称")
+    key_value = key["api_key"]
+    key_suffix = key_value[-4:] if key_value else "N/A"
+    logger.info(f"开始验证密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix})")
+
+    try:
+        client = http_client.get_http_client()
+        # 使用聊天接口验证API密钥
+        chat_payload = {
+            "model": "gpt-4o-mini",
+            "messages": [{"role": "user", "content": "Hello"}],
+            "max_tokens": 10,
+            "temperature": 0.1,
+        }
+
+        resp = await client.post(
+            upstreams.pool.resolve(key.get("upstream")).chat_completions_url,
+            headers={"Authorization": f"Bearer {key_value}", "Content-Type": "application/json"},
+            json=chat_payload,
+            timeout=15.0,
+        )
+
+        if resp.status_code == 200:
+            # 密钥有效，将其设置为活动状态
+            await db.update_api_key_status(key_id, config.KEY_STATUS_ACTIVE)
+            # 记录成功的验证请求
+            await utils.record_api_key_usage(key_id, model="gpt-4o-mini", status="validation_success")
+            logger.info(
+                f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 验证成功。状态已更新为 '{config.KEY_STATUS_ACTIVE}'。"
+            )
+            # 将新的有效密钥加入密钥池
+            utils.add_key_to_pool(key)
+            key_models.schedule_learn(key_id, key_value)
+            
+            return {
+                "success": True,
+                "message": "API Key验证成功，状态已更新为有效",
+                "key_id": key_id,
+                "name": key_name,
+                "suffix": key_suffix,
+                "new_status": config.KEY_STATUS_ACTIVE,
+                "validation_method": "chat_interface",
+            }
+        else:
+            # 只有认证失败/无权限（401/403）说明密钥无效；限流和上游错误不改变密钥状态
+            if resp.status_code in (401, 403) and key["status"] != config.KEY_STATUS_INACTIVE:
+                await db.update_api_key_status(key_id, config.KEY_STATUS_INACTIVE)
+                utils.remove_key_from_pool(key_id)
+            
+            try:
+                error_detail = resp.json().get("error", {}).get("message", "未知错误")
+            except:
+                error_detail = f"HTTP {resp.status_code}"
+
+            # 记录失败的验证请求
+            await utils.record_api_key_usage(key_id, model="gpt-4o-mini", status=f"validation_failed_{resp.status_code}")
+            
+            logger.warning(
+                f"密钥ID {key_id} (名称: {key_name}, 后缀: {key_suffix}) 验证失败，状态码 {resp.status_code}。错误: {error_detail}"
+            )
+            
+            return {
+                "success": False,
+                "message": f"API Key验证失败: {error_detail}",
+                "key_id": key_id,
+                "name": key_name,
+                "suffix": key_suffix,
+                "status_code": resp.status_code,
+                "error": error_detail,
+                "validation_method": "chat_interface",
+            }
+            
     except Exception as e:
         # 记录异常的验证请求
         await utils.record_api_key_usage(key_id, model="gpt-4o-mini", status="validation_error")
@@ -215,6 +226,9 @@ async def get_api_key_stats_endpoint():
     
     global_stats_data = schemas.GlobalStats(
         grand_total_requests_all_time=stats_data["grand_total_requests_all_time"],
+        grand_total_prompt_tokens_all_time=stats_data["grand_total_prompt_tokens_all_time"],
+        grand_total_completion_tokens_all_time=stats_data["grand_total_completion_tokens_all_time"],
+        grand_total_cached_tokens_all_time=stats_data["grand_total_cached_tokens_all_time"],
         grand_total_usage_last_1m=stats_data["grand_total_usage_last_1m"],
         grand_total_usage_last_1h=stats_data["grand_total_usage_last_1h"],
         grand_total_usage_last_24h=stats_data["grand_total_usage_last_24h"],
@@ -227,6 +241,18 @@ async def get_api_key_stats_endpoint():
     return schemas.GlobalStatsResponse(global_stats=global_stats_data)
 
 
+@router.get("/keys/ttft", tags=["Admin API Keys Management"])
+async def get_api_key_ttft_endpoint():
+    """获取每个API Key最近的流式请求首字节时间（TTFT）统计"""
+    return {"ttft": utils.get_api_key_ttft_stats()}
+
+
+@router.get("/keys/scheduler", tags=["Admin API Keys Management"])
+async def get_key_scheduler_stats(max_keys: int = 1000):
+    """获取Key调度器的令牌桶状态（每个Key剩余的调用额度、最早恢复时间），最多列出max_keys个Key"""
+    return key_scheduler.scheduler.stats(max_keys=max(0, max_keys))
+
+
 @router.get("/keys", response_model=schemas.CategorizedOpenAIKeys)
 async def get_all_openai_keys_endpoint():
     all_keys_from_db = await db.get_all_api_keys()
@@ -250,6 +276,11 @@ async def get_all_openai_keys_endpoint():
             created_at=created_at_value,
             last_used_at=last_used_at_value,
             total_requests=key_data.get("total_requests", 0),
+            total_prompt_tokens=key_data.get("total_prompt_tokens") or 0,
+            total_completion_tokens=key_data.get("total_completion_tokens") or 0,
+            total_cached_tokens=key_data.get("total_cached_tokens") or 0,
+            models=key_data.get("models"),
+            upstream=key_data.get("upstream"),
         )
         if key_data["status"] == config.KEY_STATUS_ACTIVE:
             valid_keys.append(key_display)
@@ -286,6 +317,11 @@ async def get_paginated_openai_keys_endpoint(page_params: schemas.PageParams = D
                 created_at=created_at_value,
                 last_used_at=last_used_at_value,
                 total_requests=key_data.get("total_requests", 0),
+                total_prompt_tokens=key_data.get("total_prompt_tokens") or 0,
+                total_completion_tokens=key_data.get("total_completion_tokens") or 0,
+                total_cached_tokens=key_data.get("total_cached_tokens") or 0,
+                models=key_data.get("models"),
+                upstream=key_data.get("upstream"),
             )
         )
 
@@ -302,9 +338,12 @@ async def get_paginated_openai_keys_endpoint(page_params: schemas.PageParams = D
 async def add_openai_key_endpoint(payload: schemas.NewOpenAIKeyPayload):
     new_key_value = payload.api_key.strip()
     key_name = payload.name.strip() if payload.name else None
+    upstream_name = payload.upstream.strip() if payload.upstream else None
 
     if not new_key_value.startswith("sk-"):
         raise HTTPException(status_code=400, detail="无效的OpenAI API密钥格式。必须以'sk-'开头。")
+    if upstream_name is not None and upstreams.pool.get(upstream_name) is None:
+        raise HTTPException(status_code=400, detail=f"未配置名为'{upstream_name}'的上游。")
 
     existing_key_by_val = await db.get_api_key_by_key_value(new_key_value)
     if existing_key_by_val:
@@ -314,12 +353,15 @@ async def add_openai_key_endpoint(payload: schemas.NewOpenAIKeyPayload):
         )
 
     try:
-        key_id = await db.add_api_key(api_key=new_key_value, name=key_name, status=config.KEY_STATUS_ACTIVE)
-        await utils.update_openai_key_cycle()
+        key_id = await db.add_api_key(
+            api_key=new_key_value, name=key_name, status=config.KEY_STATUS_ACTIVE, upstream=upstream_name
+        )
 
         added_key_data = await db.get_api_key_by_id(key_id)
         if not added_key_data:
             raise HTTPException(status_code=500, detail="添加后无法检索密钥。")
+        utils.add_key_to_pool(added_key_data)
+        key_models.schedule_learn(key_id, new_key_value)
 
         # 对于可能是datetime的字段，转换为字符串
         created_at_value = added_key_data.get("created_at")
@@ -338,6 +380,11 @@ async def add_openai_key_endpoint(payload: schemas.NewOpenAIKeyPayload):
             created_at=created_at_value,
             last_used_at=last_used_at_value,
             total_requests=added_key_data.get("total_requests", 0),
+            total_prompt_tokens=added_key_data.get("total_prompt_tokens") or 0,
+            total_completion_tokens=added_key_data.get("total_completion_tokens") or 0,
+            total_cached_tokens=added_key_data.get("total_cached_tokens") or 0,
+            models=added_key_data.get("models"),
+            upstream=added_key_data.get("upstream"),
         )
     except ValueError as e:
         raise HTTPException(status_code=409, detail=str(e))
@@ -364,13 +411,13 @@ async def create_api_keys_bulk(
 
         try:
             key_id = await db.add_api_key(api_key, name=name)
+            utils.add_key_to_pool({"id": key_id, "api_key": api_key, "name": name, "total_requests": 0})
+            key_models.schedule_learn(key_id, api_key)
             results.append({"key": api_key[-4:], "id": key_id, "name": name, "success": True})
         except ValueError as e:
             logger.error(f"添加API密钥时出错: {e}")
             results.append({"key": api_key[-4:], "error": str(e), "success": False})
 
-    # 更新OpenAI密钥循环
-    await utils.update_openai_key_cycle()
     return {"message": f"处理了 {len(results)} 个API密钥", "results": results}
 
 
@@ -393,9 +440,10 @@ async def delete_api_key(key_id: str, current_user: dict = Depends(dependencies.
     if key_id in utils.api_key_usage:
         del utils.api_key_usage[key_id]
         logger.info(f"已移除已删除密钥ID '{key_id}' 的使用跟踪。")
+    utils.api_key_ttft.pop(key_id, None)
 
-    # 更新OpenAI密钥循环
-    await utils.update_openai_key_cycle()
+    # 将密钥移出密钥池
+    utils.remove_key_from_pool(key_id)
     return {"message": f"API密钥ID '{key_id}' 删除成功。"}
 
 
@@ -425,8 +473,8 @@ async def update_api_key_status(
 
     logger.info(f"API密钥ID '{key_id}' (名称: {key_to_update.get('name', 'N/A')}) 状态已更新为 '{new_status}'。")
 
-    # 更新OpenAI密钥循环
-    await utils.update_openai_key_cycle()
+    # 按新状态增量更新密钥池
+    utils.apply_key_status_to_pool(key_to_update, new_status)
     return {"message": f"API密钥ID '{key_id}' 状态已更新为 '{new_status}'。"}
 
 
@@ -450,9 +498,76 @@ async def update_api_key_name(
         raise HTTPException(status_code=500, detail=f"无法更新ID为'{key_id}'的API密钥名称。")
 
     logger.info(f"API密钥ID '{key_id}' (旧名称: {key_to_update.get('name', 'N/A')}) 名称已更新为 '{new_name}'。")
+    if key_to_update["status"] == config.KEY_STATUS_ACTIVE:
+        utils.add_key_to_pool({**key_to_update, "name": new_name})
     return {"message": f"API密钥ID '{key_id}' 的名称已更新为 '{new_name}'。"}
 
 
+@router.put("/keys/{key_id}/models", tags=["Admin API Keys Management"])
+async def update_api_key_models(
+    key_id: str,
+    models_update: schemas.APIKeyModelsUpdate,
+    current_user: dict = Depends(dependencies.get_current_admin_user),
+):
+    """更新API密钥可调用的模型列表（models为null表示不限制）"""
+    key_to_update = await db.get_api_key_by_id(key_id)
+    if not key_to_update:
+        raise HTTPException(status_code=404, detail=f"未找到ID为'{key_id}'的API密钥。")
+
+    new_models = None
+    if models_update.models is not None:
+        new_models = sorted({model.strip() for model in models_update.models if model.strip()})
+        if not new_models:
+            raise HTTPException(status_code=400, detail="模型列表不能为空，不限制模型请传入null。")
+
+    success = await key_models.store_key_models(key_id, new_models)
+    if not success:
+        raise HTTPException(status_code=500, detail=f"无法更新ID为'{key_id}'的API密钥模型列表。")
+
+    logger.info(f"API密钥ID '{key_id}' (名称: {key_to_update.get('name', 'N/A')}) 模型列表已更新为 {new_models if new_models is not None else '不限制'}。")
+    return {"message": f"API密钥ID '{key_id}' 的模型列表已更新。", "models": new_models}
+
+
+@router.put("/keys/{key_id}/upstream", tags=["Admin API Keys Management"])
+async def update_api_key_upstream(
+    key_id: str,
+    upstream_update: schemas.APIKeyUpstreamUpdate,
+    current_user: dict = Depends(dependencies.get_current_admin_user),
+):
+    """更新API密钥绑定的上游（upstream为null表示不绑定，可用于任意上游）"""
+    key_to_update = await db.get_api_key_by_id(key_id)
+    if not key_to_update:
+        raise HTTPException(status_code=404, detail=f"未找到ID为'{key_id}'的API密钥。")
+
+    new_upstream = upstream_update.upstream.strip() if upstream_update.upstream else None
+    if new_upstream is not None and upstreams.pool.get(new_upstream) is None:
+        raise HTTPException(status_code=400, detail=f"未配置名为'{new_upstream}'的上游。")
+
+    success = await db.update_api_key_upstream(key_id, new_upstream)
+    if not success:
+        raise HTTPException(status_code=500, detail=f"无法更新ID为'{key_id}'的API密钥绑定的上游。")
+    key_scheduler.scheduler.set_key_upstream(key_id, new_upstream)
+    # 不同上游提供的模型不同，重新获取该Key可调用的模型列表
+    if key_to_update["status"] == config.KEY_STATUS_ACTIVE:
+        key_models.schedule_learn(key_id, key_to_update["api_key"])
+
+    logger.info(f"API密钥ID '{key_id}' (名称: {key_to_update.get('name', 'N/A')}) 绑定的上游已更新为 {new_upstream or '不绑定'}。")
+    return {"message": f"API密钥ID '{key_id}' 绑定的上游已更新。", "upstream": new_upstream}
+
+
+@router.post("/keys/{key_id}/models/learn", tags=["Admin API Keys Management"])
+async def learn_api_key_models(key_id: str, current_user: dict = Depends(dependencies.get_current_admin_user)):
+    """使用该API密钥请求上游/v1/models，保存其可调用的模型列表"""
+    key = await db.get_api_key_by_id(key_id)
+    if not key:
+        raise HTTPException(status_code=404, detail=f"未找到ID为'{key_id}'的API密钥。")
+
+    models = await key_models.learn(key_id, key["api_key"])
+    if models is None:
+        raise HTTPException(status_code=502, detail=f"无法从上游获取ID为'{key_id}'的API密钥的模型列表。")
+    return {"message": f"API密钥ID '{key_id}' 的模型列表已更新，共 {len(models)} 个模型。", "models": models}
+
+
 @router.post("/keys/reset_all_keys", tags=["Admin API Keys Management"])
 async def reset_all_inactive_keys_to_active(current_user: dict = Depends(dependencies.get_current_admin_user)):
     """将所有状态为'inactive'的密钥重置为'active'"""
@@ -464,6 +579,7 @@ async def reset_all_inactive_keys_to_active(current_user: dict = Depends(depende
         try:
             success = await db.update_api_key_status(key_id, config.KEY_STATUS_ACTIVE)
             if success:
+                utils.add_key_to_pool(key)
                 results.append({"key_id": key_id, "name": key.get("name"), "success": True})
                 logger.info(
                     f"已将密钥ID {key_id} (名称: {key.get('name', 'N/A')}) 从 '{config.KEY_STATUS_INACTIVE}' 重置为 '{config.KEY_STATUS_ACTIVE}'。"
@@ -474,8 +590,6 @@ async def reset_all_inactive_keys_to_active(current_user: dict = Depends(depende
         except Exception as e:
             results.append({"key_id": key_id, "name": key.get("name"), "success": False, "error": str(e)})
 
-    # 更新OpenAI密钥循环
-    await utils.update_openai_key_cycle()
     return {"message": f"尝试重置 {len(inactive_keys)} 个无效密钥为有效状态", "results": results}
 
 
@@ -491,6 +605,7 @@ async def cleanup_usage_tracking_data(current_user: dict = Depends(dependencies.
         if kid_to_clean in utils.api_key_usage:
             del utils.api_key_usage[kid_to_clean]
             logger.info(f"已清理已删除密钥ID的过期使用数据: {kid_to_clean}")
+        utils.api_key_ttft.pop(kid_to_clean, None)
 
     return {"message": f"清理了 {len(to_cleanup)} 个不存在的密钥的使用情况数据", "cleaned_key_ids": list(to_cleanup)}
 
@@ -509,3 +624,59 @@ async def cleanup_api_request_logs(
         "deleted_count": deleted_count,
         "retention_days": days_to_keep
     }
+
+
+@router.get("/cache/stats", response_model=schemas.ResponseCacheStats, tags=["Admin Response Cache"])
+async def get_response_cache_stats():
+    """获取响应缓存的命中/未命中计数和容量使用情况"""
+    return schemas.ResponseCacheStats(**response_cache.get_stats())
+
+
+@router.post("/cache/clear", tags=["Admin Response Cache"])
+async def clear_response_cache(current_user: dict = Depends(dependencies.get_current_admin_user)):
+    """清空响应缓存（包括持久化的缓存表）"""
+    await response_cache.clear()
+    logger.info("响应缓存已清空。")
+    return {"message": "响应缓存已清空"}
+
+
+@router.get("/coalescing/stats", tags=["Admin Request Coalescing"])
+async def get_request_coalescing_stats():
+    """获取在途请求合并的统计数据"""
+    return single_flight.get_stats()
+
+
+@router.get("/admission/stats", tags=["Admin Admission Control"])
+async def get_admission_stats():
+    """获取准入控制的统计数据（在途请求数、队列深度、等待时间、拒绝次数）"""
+    return admission.controller.stats()
+
+
+@router.get("/circuit_breaker/stats", tags=["Admin Circuit Breaker"])
+async def get_circuit_breaker_stats():
+    """获取每个上游端点的熔断状态（closed/open/half_open）、连续失败次数和快速失败次数"""
+    return circuit_breaker.breakers.stats()
+
+
+@router.get("/upstreams/stats", tags=["Admin Upstreams"])
+async def get_upstreams_stats():
+    """获取每个上游的权重、健康检查结果、熔断状态、可用Key数量和被选择次数"""
+    return upstreams.pool.stats()
+
+
+@router.get("/key_pool_sync/stats", tags=["Admin API Keys Management"])
+async def get_key_pool_sync_stats():
+    """获取多进程密钥池同步的统计数据（本进程的密钥池版本号、检查次数、同步次数、收到的通知数）"""
+    return key_pool_sync.sync.stats()
+
+
+@router.get("/key_leases/stats", tags=["Admin API Keys Management"])
+async def get_key_leases_stats():
+    """获取多节点Key租约的状态（本节点ID、额度份额、未过期的节点）以及数据库中所有节点的租约"""
+    return {**key_leases.manager.stats(), "leases": await db.get_key_leases()}
+
+
+@router.get("/usage_writer/stats", tags=["Admin Usage Writer"])
+async def get_usage_writer_stats():
+    """获取使用记录批量写入队列的统计数据（待写入数量、队列延迟、写入次数）"""
+    return usage_writer.writer.stats()
@@ -1,8 +1,13 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
-from typing import Optional, Dict, Any
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response
+from starlette.background import BackgroundTask
+from pydantic import ValidationError
+from typing import Optional, Dict, Any, AsyncIterator
 import httpx
 import asyncio
+import json
+import time
 
 from .. import schemas
 from .. import config
@@ -10,278 +15,610 @@ from .. import utils
 from .. import database as db
 from .. import dependencies
 from .. import logger
+from .. import http_client
+from .. import retry_policy
+from .. import response_cache
+from .. import single_flight
+from .. import models_cache
+from .. import admission
+from .. import key_scheduler
+from .. import key_models
+from .. import token_usage
+from .. import circuit_breaker
+from .. import upstreams
+from .. import streaming
 
 router = APIRouter()
 
+# 原样透传给客户端的上游响应头
+PASSTHROUGH_RESPONSE_HEADERS = ("content-type", "x-request-id", "openai-processing-ms", "openai-version")
+PASSTHROUGH_RESPONSE_HEADER_PREFIXES = ("x-ratelimit-",)
+
+
+def _build_passthrough_headers(upstream_headers: httpx.Headers) -> Dict[str, str]:
+    """从上游响应头中挑选需要透传给客户端的头部"""
+    passthrough_headers = {}
+    for name, value in upstream_headers.items():
+        lower_name = name.lower()
+        if lower_name in PASSTHROUGH_RESPONSE_HEADERS or lower_name.startswith(PASSTHROUGH_RESPONSE_HEADER_PREFIXES):
+            passthrough_headers[lower_name] = value
+    return passthrough_headers
+
+
+def _build_passthrough_response(upstream_response: httpx.Response) -> Response:
+    """将上游响应体字节、状态码和相关头部原样返回，避免JSON解码后再重新编码"""
+    return Response(
+        content=upstream_response.content,
+        status_code=upstream_response.status_code,
+        headers=_build_passthrough_headers(upstream_response.headers),
+    )
+
+
+async def _read_chat_request_body(request: Request) -> tuple[bytes, Optional[str], bool]:
+    """
+    读取聊天请求体，返回 (上游请求体, model, is_stream)。
+
+    默认原样透传请求体，只快速扫描model和stream字段；
+    配置 request_validation = true 时进行完整的Pydantic校验并重新序列化。
+    """
+    raw_body = await request.body()
+
+    if config.APP_REQUEST_VALIDATION:
+        try:
+            request_data = schemas.OpenAIChatRequest.model_validate_json(raw_body)
+        except ValidationError as e:
+            raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+        payload = request_data.model_dump(exclude_none=True)
+        return json.dumps(payload).encode("utf-8"), payload.get("model"), bool(payload.get("stream", False))
+
+    try:
+        model, is_stream = utils.sniff_chat_request_fields(raw_body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"请求体不是有效的JSON对象: {e}")
+    return raw_body, model, is_stream
+
+
+async def _read_first_sse_event(byte_iterator: AsyncIterator[bytes]) -> bytes:
+    """
+    从上游流中读取数据直到收到第一个完整的SSE事件，返回已读取的全部字节。
+
+    上游在首个事件前结束流，或首个事件为错误事件时抛出HTTPException，由重试循环切换Key。
+    """
+    buffer = b""
+    async for chunk in byte_iterator:
+        buffer += chunk
+        if b"\n\n" in buffer or b"\r\n\r\n" in buffer:
+            break
+    else:
+        raise HTTPException(status_code=502, detail="上游流在返回第一个事件前已结束。")
+
+    first_event = buffer.replace(b"\r\n", b"\n").split(b"\n\n", 1)[0]
+    for line in first_event.split(b"\n"):
+        if line.startswith(b"data:"):
+            try:
+                event_data = json.loads(line[5:])
+            except ValueError:
+                continue
+            if isinstance(event_data, dict) and "error" in event_data:
+                raise HTTPException(status_code=502, detail=f"上游流返回错误事件: {line[5:].decode('utf-8', errors='replace')}")
+    return buffer
+
+
+class _UpstreamStreamRelay:
+    """
+    向客户端转发已确认健康的上游流，相邻数据块间隔超过空闲超时则中断。
+
+    只保留流的最后一段字节；关闭时（响应发送结束后，即使响应体从未被迭代）释放Key的在途名额，
+    从保留的字节中读取最后的usage数据块，连同本次使用记录一起写入，并关闭上游响应。
+    """
+
+    def __init__(
+        self,
+        upstream_response: httpx.Response,
+        byte_iterator: AsyncIterator[bytes],
+        first_event: bytes,
+        key_id: str,
+        key_short: str,
+        idle_timeout: float,
+        request_model: Optional[str],
+    ):
+        self.upstream_response = upstream_response
+        self.byte_iterator = byte_iterator
+        self.first_event = first_event
+        self.key_id = key_id
+        self.key_short = key_short
+        self.idle_timeout = idle_timeout
+        self.request_model = request_model
+        self.tail = first_event[-token_usage.STREAM_TAIL_BYTES:]
+
+    async def iter_bytes(self) -> AsyncIterator[bytes]:
+        idle_timeout = self.idle_timeout
+        try:
+            yield self.first_event
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        self.byte_iterator.__anext__(), timeout=idle_timeout if idle_timeout > 0 else None
+                    )
+                except StopAsyncIteration:
+                    break
+                self.tail = (self.tail + chunk)[-token_usage.STREAM_TAIL_BYTES:]
+                yield chunk
+            logger.info(f"流式请求数据接收完毕，使用Key ID: {self.key_id} (后缀: {self.key_short})。")
+        except asyncio.TimeoutError:  # 响应已开始，无法再切换Key
+            logger.error(f"流式传输空闲超过 {idle_timeout} 秒，已中断。Key ID: {self.key_id} (后缀: {self.key_short})")
+            raise
+        except httpx.RequestError as e_req:
+            logger.error(f"流式传输中断，Key ID: {self.key_id} (后缀: {self.key_short}): {str(e_req)}")
+            raise
+
+    async def aclose(self):
+        key_scheduler.scheduler.release(self.key_id)
+        try:
+            # 记录API Key使用情况（由后台任务批量写入数据库）
+            await utils.record_api_key_usage(
+                self.key_id,
+                model=self.request_model,
+                status="success",
+                touch_last_used=True,
+                usage=token_usage.parse_usage(self.tail),
+            )
+        finally:
+            await self.upstream_response.aclose()
+
+
+async def _next_key_with_capacity(
+    model: Optional[str], upstream: Optional[str], deadline: retry_policy.RequestDeadline
+) -> Optional[Dict[str, Any]]:
+    """
+    获取下一个能在upstream调用model且仍有调用额度和在途名额的Key（调度器已占用该Key的一个在途名额，结束后需release）；
+    没有这样的活动Key时返回None。
+
+    这些Key的调用额度都已耗尽时等待最早恢复的Key（超过最大等待时间则返回503和Retry-After）；
+    在途请求都已达上限时等待任意Key释放名额。每次等待都不超过请求剩余的截止时间，截止时间已到时返回504。
+    """
+    while True:
+        key_config = await utils.get_next_openai_key_config(model, upstream)
+        if key_config is not None:
+            return key_config
+        if key_scheduler.scheduler.eligible_count(model, upstream) == 0:
+            return None
+        if deadline.expired():
+            logger.warning(f"等待可用的API Key超过总截止时间 {config.RETRY_REQUEST_DEADLINE_SECONDS} 秒。")
+            raise admission.AdmissionRejected(
+                status_code=504,
+                detail=f"请求超过总截止时间({config.RETRY_REQUEST_DEADLINE_SECONDS}秒)，等待可用的API Key超时。",
+            )
+
+        wait_seconds = key_scheduler.scheduler.next_available_in(model, upstream)
+        if wait_seconds is not None:
+            await admission.controller.wait_for_key_budget(wait_seconds, deadline.remaining())
+        else:
+            await admission.controller.wait_for_key_capacity(deadline.remaining())
+
+
+async def _handle_key_error_status(
+    key_id: str, key_name: str, status_code: int, upstream_headers: httpx.Headers, source: str
+):
+    """401/403将Key持久地设为无效；429使Key在内存中冷却（遵循Retry-After），到期后自动恢复"""
+    if status_code in (401, 403):
+        await db.update_api_key_status(key_id, config.KEY_STATUS_INACTIVE)
+        logger.info(f"Key ID {key_id} (名称: {key_name}) 因{source}API错误{status_code}被设为'{config.KEY_STATUS_INACTIVE}'。")
+        utils.remove_key_from_pool(key_id)
+    elif status_code == 429:
+        cooldown_seconds = key_scheduler.scheduler.cooldown(key_id, retry_policy.parse_retry_after(upstream_headers))
+        logger.info(f"Key ID {key_id} (名称: {key_name}) 因{source}API错误429进入冷却，{cooldown_seconds:.1f} 秒后自动恢复。")
+
 
 @router.post("/v1/chat/completions", tags=["Chat Completions"])
-async def chat_completions_proxy(
-    request_data: schemas.OpenAIChatRequest, proxy_api_key: str = Depends(dependencies.verify_proxy_api_key)
-):
+async def chat_completions_proxy(request: Request, proxy_api_key: str = Depends(dependencies.verify_proxy_api_key)):
     """代理OpenAI Chat Completions API请求，实现API Key轮询和重试机制"""
+    request_body, request_model, is_stream = await _read_chat_request_body(request)
+    if is_stream and config.TOKEN_USAGE_STREAM_INCLUDE_USAGE:
+        # 让上游在流的最后返回一个包含Token用量的数据块
+        try:
+            request_body = token_usage.inject_stream_include_usage(request_body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"请求体不是有效的JSON对象: {e}")
+
+    # 响应缓存：命中时跳过密钥选择和上游调用
+    cache_key: Optional[str] = None
+    if config.RESPONSE_CACHE_ENABLED and not is_stream:
+        if response_cache.is_bypass_requested(request.headers):
+            response_cache.memory_cache.bypasses += 1
+        else:
+            cache_key = response_cache.build_cache_key(request_body)
+            if cache_key is not None:
+                cached_entry = await response_cache.lookup(cache_key)
+                if cached_entry is not None:
+                    logger.debug(f"响应缓存命中: {cache_key[:16]}")
+                    return Response(content=cached_entry.body, headers={**cached_entry.headers, "x-proxy-cache": "HIT"})
+
+    def forward_request():
+        return _forward_chat_request(request_body, request_model, is_stream, cache_key)
+
+    # 合并相同的在途请求：重复的调用方等待首个请求的结果，而不是各自调用上游
+    if config.COALESCING_ENABLED:
+        flight_key = single_flight.build_flight_key(request_body, is_stream)
+        if flight_key is not None:
+            if not is_stream:
+                response, shared = await single_flight.request_flights.do(flight_key, forward_request)
+                return single_flight.clone_response(response) if shared else response
+            if config.COALESCING_STREAM_FANOUT:
+                return await single_flight.stream_fanout.subscribe(flight_key, forward_request)
+
+    return await forward_request()
+
+
+async def _forward_chat_request(
+    request_body: bytes, request_model: Optional[str], is_stream: bool, cache_key: Optional[str]
+) -> Response:
+    """在准入控制下转发聊天请求；全局并发名额保持到响应（包括流式转发）结束"""
+    ticket = await admission.controller.admit()
+    try:
+        response = await _forward_chat_request_with_retries(request_body, request_model, is_stream, cache_key)
+    except BaseException:
+        ticket.release()
+        raise
+    if isinstance(response, streaming.ClosingStreamingResponse):
+        response.call_on_close(ticket.release)
+    else:
+        ticket.release()
+    return response
+
+
+async def _forward_chat_request_with_retries(
+    request_body: bytes, request_model: Optional[str], is_stream: bool, cache_key: Optional[str]
+) -> Response:
+    """使用API Key轮询和重试策略将聊天请求转发到上游，返回给客户端的响应"""
     headers = {
         "Content-Type": "application/json",
     }
+    deadline = retry_policy.RequestDeadline(config.RETRY_REQUEST_DEADLINE_SECONDS)
+    model_timeouts = retry_policy.get_model_timeouts(request_model)
+
+    # 池中有Key但没有上游能用这些Key提供所请求的模型时直接返回，不向上游发起注定失败的请求
+    if request_model and utils.get_active_key_count() > 0 and not upstreams.pool.serves(request_model):
+        raise HTTPException(status_code=404, detail=f"没有可调用模型'{request_model}'的API Key。")
+
+    client = http_client.get_http_client()  # 共享的上游HTTP客户端
+    failed_upstreams = set()  # 本次请求中发生传输错误或网关错误的上游，重试时优先换一个上游
+    for attempt in range(config.APP_CONFIG_MAX_RETRIES):
+        if deadline.expired():
+            logger.warning(f"请求已超过总截止时间 {config.RETRY_REQUEST_DEADLINE_SECONDS} 秒，共尝试 {attempt} 次。")
+            raise HTTPException(
+                status_code=504, detail=f"请求超过总截止时间({config.RETRY_REQUEST_DEADLINE_SECONDS}秒)，已尝试{attempt}次。"
+            )
+        # 在健康且未熔断的上游中按权重选择一个，都不可用时快速失败，不再消耗重试次数和Key
+        upstream = upstreams.pool.select(request_model, avoid=failed_upstreams)
+        breaker = upstream.breaker
+        upstream_model = upstream.upstream_model(request_model)
+        upstream_body = upstream.map_request_body(request_body, request_model)
+
+        current_key_config: Optional[Dict[str, Any]] = None
+        model_not_found = False  # 上游表示该Key不能调用所请求的模型，换Key重试
+        key_slot_handed_off = False  # 流式转发成功后由流式响应关闭时释放Key的在途名额
+        try:
+            current_key_config = await _next_key_with_capacity(upstream_model, upstream.name, deadline)
+            if current_key_config is None:
+                # 无可用API Key
+                logger.info(f"尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}: 无可用OpenAI API Key。")
+                if attempt == 0:
+                    raise HTTPException(status_code=503, detail="无可用OpenAI API Key，请添加或激活。")
+                raise HTTPException(status_code=503, detail="此尝试未能获取到可用的API Key。")
+
+            current_api_key = current_key_config["api_key"]
+            key_id_for_db = current_key_config["id"]
+
+            headers["Authorization"] = f"Bearer {current_api_key}"  # 设置当前API Key
+            key_short = utils.mask_api_key_for_display(current_api_key)
+            _name_from_config = current_key_config.get("name")
+            key_name_for_log = _name_from_config if _name_from_config else key_short
+
+            if attempt >0:
+                logger.info(
+                    f"重试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES} 使用上游: {upstream.name}, 密钥ID: {key_id_for_db} (后缀: {key_short})"
+                )
 
-    payload = request_data.model_dump(exclude_none=True)
-    is_stream = payload.get("stream", False)
-
-    async with httpx.AsyncClient() as client:  # 主HTTP客户端
-        for attempt in range(config.APP_CONFIG_MAX_RETRIES):
-            current_key_config: Optional[Dict[str, Any]] = None
-            try:
-                current_key_config = await utils.get_next_openai_key_config()
-                if current_key_config is None:
-                    # 无可用API Key
-                    logger.info(f"尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}: 无可用OpenAI API Key。")
-                    if attempt == 0:
-                        raise HTTPException(status_code=503, detail="无可用OpenAI API Key，请添加或激活。")
-                    raise HTTPException(status_code=503, detail="此尝试未能获取到可用的API Key。")
-
-                current_api_key = current_key_config["api_key"]
-                key_id_for_db = current_key_config["id"]
-
-                headers["Authorization"] = f"Bearer {current_api_key}"  # 设置当前API Key
-                key_short = utils.mask_api_key_for_display(current_api_key)
-                _name_from_config = current_key_config.get("name")
-                key_name_for_log = _name_from_config if _name_from_config else key_short
-
-                if attempt >0:
+            attempt_timeout = deadline.build_timeout(model_timeouts, is_stream)
+            upstream.begin_request()  # 熔断器半开时在发送前才占用探测名额
+            if is_stream:
+                # 先打开上游流并等待状态行和第一个SSE事件，确认流健康后才开始向客户端响应，
+                # 这样401/429/连接错误等仍可在重试循环中切换到下一个Key
+                stream_started_at = time.monotonic()
+                upstream_request = client.build_request(
+                    "POST", upstream.chat_completions_url, content=upstream_body, headers=headers, timeout=attempt_timeout
+                )
+                response = await client.send(upstream_request, stream=True)
+                if breaker is not None:
+                    breaker.record_status(response.status_code)
+                if config.RATE_LIMIT_ROUTING_ENABLED:
+                    key_scheduler.scheduler.update_rate_limits(str(key_id_for_db), response.headers)
+                if response.status_code == 200:
+                    byte_iterator = response.aiter_bytes()
+                    try:
+                        first_event = await asyncio.wait_for(
+                            _read_first_sse_event(byte_iterator), timeout=min(model_timeouts.read, deadline.remaining())
+                        )
+                    except asyncio.TimeoutError:
+                        await response.aclose()
+                        raise httpx.ReadTimeout("等待第一个SSE事件超时", request=upstream_request)
+                    except BaseException:
+                        await response.aclose()
+                        raise
+
+                    ttft_seconds = time.monotonic() - stream_started_at
+                    utils.record_api_key_ttft(str(key_id_for_db), ttft_seconds)
                     logger.info(
-                        f"重试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES} 使用密钥ID: {key_id_for_db} (后缀: {key_short})"
+                        f"流式请求成功启动，使用Key ID: {key_id_for_db} (后缀: {key_short})，首字节时间: {ttft_seconds * 1000:.0f}ms。"
                     )
-
-                if is_stream:
-                    # 流式响应的异步生成器
-                    async def stream_openai_response_generator(
-                        target_url: str,
-                        request_payload: dict,
-                        request_headers: dict,
-                        key_id: int,
-                        key_name_log: str,
-                        key_short_log: str,
-                    ):
-                        str_key_id = str(key_id)
-                        # 为流式请求创建独立的HTTP客户端
-                        async with httpx.AsyncClient() as stream_client:
-                            try:
-                                # 发起流式请求
-                                async with stream_client.stream(
-                                    "POST", target_url, json=request_payload, headers=request_headers, timeout=30.0
-                                ) as response:
-                                    if response.status_code == 200:
-                                        logger.info(
-                                            f"流式请求成功启动，使用Key ID: {str_key_id} (后缀: {key_short_log})。"
-                                        )
-                                        # 记录API Key使用情况 - 使用异步方法
-                                        await utils.record_api_key_usage(str_key_id, model=request_payload.get("model"), status="success")
-                                        await db.update_api_key_last_used_at(str_key_id)
-
-                                        async for chunk in response.aiter_bytes():
-                                            yield chunk
-                                        logger.info(
-                                            f"流式请求数据接收完毕，使用Key ID: {str_key_id} (后缀: {key_short_log})。"
-                                        )
-                                    else:
-                                        # 处理流式请求错误
-                                        error_content = await response.aread()
-                                        error_text = (
-                                            error_content.decode("utf-8", errors="replace")
-                                            if isinstance(error_content, bytes)
-                                            else str(error_content)
-                                        )
-                                        logger.error(
-                                            f"流式请求初始化错误，Key ID: {str_key_id} (后缀: {key_short_log}): {response.status_code} - {error_text}"
-                                        )
-                                        if response.status_code in [401, 403, 429]:  # 特定错误码，禁用Key
-                                            await db.update_api_key_status(str_key_id, config.KEY_STATUS_INACTIVE)
-                                            logger.info(
-                                                f"Key ID {str_key_id} (名称: {key_name_log}) 因API错误{response.status_code}被设为'{config.KEY_STATUS_INACTIVE}'。"
-                                            )
-                                            await utils.update_openai_key_cycle()
-                                        # 抛出异常，由主重试循环捕获
-                                        raise HTTPException(status_code=response.status_code, detail=error_text)
-
-                            except httpx.RequestError as e_req:  # 网络请求错误
-                                logger.error(
-                                    f"流式请求发生httpx.RequestError，Key ID: {str_key_id} (后缀: {key_short_log}): {str(e_req)}"
-                                )
-                                raise e_req  # 重新抛出，由主重试循环处理
-
-                            except Exception as e_gen:  # 其他通用异常
-                                logger.error(
-                                    f"流式处理中发生通用异常，Key ID: {str_key_id} (后缀: {key_short_log}): {str(e_gen)}"
-                                )
-                                raise  # 重新抛出
-
-                    generator_instance = stream_openai_response_generator(
-                        target_url=config.OPENAI_API_ENDPOINT,
-                        request_payload=payload,
-                        request_headers=headers,
-                        key_id=key_id_for_db,
-                        key_name_log=key_name_for_log,
-                        key_short_log=key_short,
+                    key_scheduler.scheduler.record_success(
+                        str(key_id_for_db), latency_seconds=ttft_seconds, ttft_seconds=ttft_seconds
                     )
 
-                    return StreamingResponse(generator_instance, media_type="text/event-stream")
-
-                else:  # 非流式请求
-                    response = await client.post(
-                        config.OPENAI_API_ENDPOINT, json=payload, headers=headers, timeout=30.0
+                    # 使用记录在流结束时写入（需要读取流最后的Token用量）
+                    key_slot_handed_off = True
+                    relay = _UpstreamStreamRelay(
+                        response,
+                        byte_iterator,
+                        first_event,
+                        str(key_id_for_db),
+                        key_short,
+                        model_timeouts.idle,
+                        request_model,
                     )
-                    if response.status_code == 200:
-                        await utils.record_api_key_usage(str(key_id_for_db), model=payload.get("model"), status="success")
-                        # 使用异步数据库操作
-                        await db.update_api_key_last_used_at(str(key_id_for_db))
-                        logger.info(
-                            f"非流式请求成功，使用Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})."
-                        )
-                        return response.json()
-                    else:
-                        error_content = response.text
-                        logger.error(
-                            f"非流式请求错误，Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short}): {response.status_code}"
-                        )
-                        if response.status_code in [401, 403, 429] and key_id_for_db:
-                            # 使用异步方法更新状态
-                            await db.update_api_key_status(str(key_id_for_db), config.KEY_STATUS_INACTIVE)
-                            logger.info(
-                                f"Key ID {key_id_for_db} (名称: {key_name_for_log}) 因API错误{response.status_code}被设为'{config.KEY_STATUS_INACTIVE}'。"
-                            )
-                            await utils.update_openai_key_cycle()
-                        raise HTTPException(status_code=response.status_code, detail=error_content)
+                    streaming_response = streaming.ClosingStreamingResponse(
+                        relay.iter_bytes(),
+                        media_type="text/event-stream",
+                        headers=_build_passthrough_headers(response.headers),
+                    )
+                    streaming_response.call_on_close(relay.aclose)
+                    return streaming_response
 
-            except httpx.RequestError as e:  # OpenAI连接或请求错误
-                key_id_for_db_error = current_key_config.get("id") if current_key_config else None
-                key_name_for_error_log = key_name_for_log if current_key_config else "N/A"
-                key_short_for_error = key_short if current_key_config else "N/A"
+                # 读取错误响应体后关闭上游流
+                await response.aread()
+                await response.aclose()
 
-                log_key_id_display = key_id_for_db_error if key_id_for_db_error is not None else "N/A"
-                logger.error(
-                    f"RequestError (Key ID: {log_key_id_display}, 名称: {key_name_for_error_log}, 后缀: {key_short_for_error}): {e}"
+            else:  # 非流式请求
+                request_started_at = time.monotonic()
+                response = await client.post(
+                    upstream.chat_completions_url, content=upstream_body, headers=headers, timeout=attempt_timeout
                 )
-                if key_id_for_db_error:  # 如果获取到了Key，则禁用
-                    # 使用异步方法更新状态
-                    await db.update_api_key_status(str(key_id_for_db_error), config.KEY_STATUS_INACTIVE)
+                if breaker is not None:
+                    breaker.record_status(response.status_code)
+                if config.RATE_LIMIT_ROUTING_ENABLED:
+                    key_scheduler.scheduler.update_rate_limits(str(key_id_for_db), response.headers)
+                if response.status_code == 200:
+                    key_scheduler.scheduler.record_success(
+                        str(key_id_for_db), latency_seconds=time.monotonic() - request_started_at
+                    )
+                    await utils.record_api_key_usage(
+                        str(key_id_for_db),
+                        model=request_model,
+                        status="success",
+                        touch_last_used=True,
+                        usage=token_usage.parse_usage(response.content),
+                    )
                     logger.info(
-                        f"Key ID {key_id_for_db_error} (名称: {key_name_for_error_log}) 因RequestError被设为'{config.KEY_STATUS_INACTIVE}'。"
+                        f"非流式请求成功，使用Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})."
                     )
-                    await utils.update_openai_key_cycle()
-                if attempt < config.APP_CONFIG_MAX_RETRIES - 1:
-                    await asyncio.sleep(0.1)
-                    continue  # 继续尝试下一个Key
-                else:  # 所有尝试失败
-                    raise HTTPException(status_code=500, detail=f"连接OpenAI多次尝试失败: {e}")
-
-            except HTTPException as e:  # 其他HTTP异常
-                key_id_display = current_key_config.get("id") if current_key_config else "N/A"
-                logger.error(
-                    f"OpenAI调用期间发生HTTPException (Key ID: {key_id_display}, 尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}): {e.status_code} - {e.detail}"
+                    passthrough_response = _build_passthrough_response(response)
+                    if cache_key is not None:
+                        cached_entry = response_cache.store(
+                            cache_key, response.content, _build_passthrough_headers(response.headers)
+                        )
+                        passthrough_response.headers["x-proxy-cache"] = "MISS"
+                        if config.RESPONSE_CACHE_PERSIST:
+                            # 响应发送后再写入数据库，不阻塞当前请求
+                            passthrough_response.background = BackgroundTask(
+                                response_cache.persist, cache_key, cached_entry
+                            )
+                    return passthrough_response
+
+            # 上游返回错误状态码（流式与非流式共用）
+            error_content = response.text
+            logger.error(
+                f"{'流式' if is_stream else '非流式'}请求错误，Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short}): {response.status_code} - {error_content}"
+            )
+            model_not_found = key_models.is_model_not_found(response.status_code, response.content)
+            if model_not_found:
+                # 该Key不能调用所请求的模型：不将Key设为无效，换其他Key重试，并（开启时）重新学习其模型列表
+                logger.warning(f"Key ID {key_id_for_db} (名称: {key_name_for_log}) 不能调用模型 '{request_model}'，将换Key重试。")
+                key_models.schedule_learn(str(key_id_for_db), current_api_key)
+                raise HTTPException(status_code=response.status_code, detail=error_content)
+            if retry_policy.classify_status_code(response.status_code) == retry_policy.FAULT_CLIENT:
+                # 客户端请求本身有误，换Key重试无意义，原样返回上游错误
+                return _build_passthrough_response(response)
+            if key_id_for_db:
+                await _handle_key_error_status(
+                    str(key_id_for_db), key_name_for_log, response.status_code, response.headers, source=""
                 )
-
-                # 如果是初次尝试就因无可用Key而失败(503)，则直接抛出
-                if e.status_code == 503 and "无可用OpenAI API Key" in e.detail and attempt == 0:
-                    raise
-
-                if attempt < config.APP_CONFIG_MAX_RETRIES - 1:
-                    await asyncio.sleep(0.1)
-                    continue  # 继续尝试
-                else:  # 所有尝试失败或遇到不可重试的错误
-                    raise
-
-        raise HTTPException(status_code=500, detail=f"所有{config.APP_CONFIG_MAX_RETRIES}次尝试均失败。")
+            raise HTTPException(status_code=response.status_code, detail=error_content)
+
+        except httpx.RequestError as e:  # OpenAI连接或请求错误
+            key_id_for_db_error = current_key_config.get("id") if current_key_config else None
+            key_name_for_error_log = key_name_for_log if current_key_config else "N/A"
+            key_short_for_error = key_short if current_key_config else "N/A"
+
+            log_key_id_display = key_id_for_db_error if key_id_for_db_error is not None else "N/A"
+            logger.error(
+                f"RequestError (Key ID: {log_key_id_display}, 名称: {key_name_for_error_log}, 后缀: {key_short_for_error}): {e}"
+            )
+            # 传输错误归因于上游端点而不是Key：计入熔断器，不冷却或停用当前Key
+            if breaker is not None:
+                breaker.record_failure()
+            failed_upstreams.add(upstream.name)
+            if attempt == config.APP_CONFIG_MAX_RETRIES - 1:  # 所有尝试失败
+                raise HTTPException(status_code=500, detail=f"连接OpenAI多次尝试失败: {e}")
+            fault = retry_policy.FAULT_UPSTREAM
+
+        except HTTPException as e:  # 其他HTTP异常
+            key_id_display = current_key_config.get("id") if current_key_config else "N/A"
+            logger.error(
+                f"OpenAI调用期间发生HTTPException (Key ID: {key_id_display}, 尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}): {e.status_code} - {e.detail}"
+            )
+
+            # 准入控制拒绝（等待Key名额超时或超过截止时间）直接返回给客户端
+            if isinstance(e, admission.AdmissionRejected):
+                raise
+
+            # 上游错误状态码或流式首个事件错误，计入该Key的错误率（发送前熔断器未放行不是Key的问题）
+            if current_key_config is not None and not isinstance(e, circuit_breaker.CircuitOpen):
+                key_scheduler.scheduler.record_failure(str(current_key_config["id"]))
+            if e.status_code in circuit_breaker.ENDPOINT_FAULT_STATUS_CODES:
+                failed_upstreams.add(upstream.name)
+
+            # 如果是初次尝试就因无可用Key而失败(503)，则直接抛出
+            if e.status_code == 503 and "无可用OpenAI API Key" in e.detail and attempt == 0:
+                raise
+
+            if attempt == config.APP_CONFIG_MAX_RETRIES - 1:  # 所有尝试失败
+                raise
+            fault = retry_policy.classify_status_code(e.status_code, model_not_found)
+
+        finally:
+            if current_key_config is not None and not key_slot_handed_off:
+                key_scheduler.scheduler.release(str(current_key_config["id"]))
+
+        # 密钥问题换下一个Key立即重试；上游问题按带抖动的指数退避等待，且不超过剩余截止时间
+        if fault == retry_policy.FAULT_UPSTREAM:
+            await asyncio.sleep(min(retry_policy.compute_backoff_seconds(attempt), deadline.remaining()))
+
+    raise HTTPException(status_code=500, detail=f"所有{config.APP_CONFIG_MAX_RETRIES}次尝试均失败。")
 
 
 @router.get("/v1/models", tags=["Models"])
-async def list_models(proxy_api_key: str = Depends(dependencies.verify_proxy_api_key)):
-    """代理OpenAI List Models API请求，使用与聊天完成相同的API Key轮询机制"""
+async def list_models(request: Request, proxy_api_key: str = Depends(dependencies.verify_proxy_api_key)):
+    """代理OpenAI List Models API请求，优先使用进程内缓存并支持ETag/304"""
+    if not config.MODELS_CACHE_ENABLED:
+        return await _fetch_models_with_retries()
+
+    entry = await models_cache.get_models_list()
+    if entry is None:
+        # 缓存为空且刷新失败，回退到带Key轮询和重试的上游请求
+        response = await _fetch_models_with_retries()
+        if response.status_code != 200:
+            return response
+        entry = models_cache.update(response.body, response.headers)
+
+    if models_cache.etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers={"etag": entry.etag})
+    return Response(content=entry.body, headers={**entry.headers, "etag": entry.etag})
+
+
+async def _fetch_models_with_retries() -> Response:
+    """使用与聊天完成相同的API Key轮询机制请求上游模型列表（按配置顺序使用第一个可用的上游）"""
     headers = {
         "Content-Type": "application/json",
     }
-
-    async with httpx.AsyncClient() as client:
-        for attempt in range(config.APP_CONFIG_MAX_RETRIES):
-            current_key_config: Optional[Dict[str, Any]] = None
-            try:
-                current_key_config = await utils.get_next_openai_key_config()
-                if current_key_config is None:
-                    if attempt == 0:  # 初始无可用Key
-                        raise HTTPException(status_code=503, detail="Models API无可用OpenAI Key，请添加或激活。")
-                    raise HTTPException(status_code=503, detail="Models API此尝试未能获取到可用的API Key。")
-
-                current_api_key = current_key_config["api_key"]
-                key_id_for_db = current_key_config["id"]
-
-                headers["Authorization"] = f"Bearer {current_api_key}"
-                key_short = utils.mask_api_key_for_display(current_api_key)
-                _name_from_config = current_key_config.get("name")
-                key_name_for_log = _name_from_config if _name_from_config else key_short
-
+    deadline = retry_policy.RequestDeadline(config.RETRY_REQUEST_DEADLINE_SECONDS)
+    model_timeouts = retry_policy.get_model_timeouts(None)
+
+    client = http_client.get_http_client()
+    failed_upstreams = set()
+    for attempt in range(config.APP_CONFIG_MAX_RETRIES):
+        if deadline.expired():
+            raise HTTPException(
+                status_code=504, detail=f"Models API请求超过总截止时间({config.RETRY_REQUEST_DEADLINE_SECONDS}秒)。"
+            )
+        upstream = upstreams.pool.select(None, avoid=failed_upstreams, by_weight=False)
+        breaker = upstream.breaker
+
+        current_key_config: Optional[Dict[str, Any]] = None
+        try:
+            current_key_config = await utils.get_next_openai_key_config(upstream=upstream.name)
+            if current_key_config is None:
+                if attempt == 0:  # 初始无可用Key
+                    raise HTTPException(status_code=503, detail="Models API无可用OpenAI Key，请添加或激活。")
+                raise HTTPException(status_code=503, detail="Models API此尝试未能获取到可用的API Key。")
+
+            current_api_key = current_key_config["api_key"]
+            key_id_for_db = current_key_config["id"]
+
+            headers["Authorization"] = f"Bearer {current_api_key}"
+            key_short = utils.mask_api_key_for_display(current_api_key)
+            _name_from_config = current_key_config.get("name")
+            key_name_for_log = _name_from_config if _name_from_config else key_short
+
+            logger.info(
+                f"尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES} 对/v1/models使用密钥ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})"
+            )
+
+            upstream.begin_request()
+            response = await client.get(
+                upstream.models_url,
+                headers=headers,
+                timeout=deadline.build_timeout(model_timeouts, is_stream=False),
+            )
+            if breaker is not None:
+                breaker.record_status(response.status_code)
+
+            if response.status_code == 200:
+                key_scheduler.scheduler.record_success(str(key_id_for_db))
+                await utils.record_api_key_usage(
+                    str(key_id_for_db), model="models", status="success", touch_last_used=True
+                )
                 logger.info(
-                    f"尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES} 对/v1/models使用密钥ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})"
+                    f"/v1/models请求成功，使用Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})。"
                 )
-
-                response = await client.get(config.OPENAI_VALIDATION_ENDPOINT, headers=headers, timeout=30.0)
-
-                if response.status_code == 200:
-                    await utils.record_api_key_usage(str(key_id_for_db), model="models", status="success")
-                    # 使用异步数据库操作
-                    await db.update_api_key_last_used_at(str(key_id_for_db))
-                    logger.info(
-                        f"/v1/models请求成功，使用Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short})。"
-                    )
-                    return response.json()
-                else:
-                    error_content = response.text
-                    logger.error(
-                        f"/v1/models请求错误，Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short}): {response.status_code}"
-                    )
-                    if response.status_code in [401, 403, 429] and key_id_for_db:
-                        # 使用异步方法更新状态
-                        await db.update_api_key_status(str(key_id_for_db), config.KEY_STATUS_INACTIVE)
-                        logger.info(
-                            f"Key ID {key_id_for_db} (名称: {key_name_for_log}) 因API错误{response.status_code} (Models API)被设为'{config.KEY_STATUS_INACTIVE}'。"
-                        )
-                        await utils.update_openai_key_cycle()
-                    raise HTTPException(status_code=response.status_code, detail=error_content)
-
-            except httpx.RequestError as e:  # 网络连接错误
-                key_id_for_db_error = current_key_config.get("id") if current_key_config else None
-                key_name_for_error_log = key_name_for_log if current_key_config else "N/A"
-                key_short_for_error = key_short if current_key_config else "N/A"
-                
-                log_key_id_display = key_id_for_db_error if key_id_for_db_error is not None else "N/A"
+                await key_models.remember_models_response(str(key_id_for_db), response.content)
+                return _build_passthrough_response(response)
+            else:
+                error_content = response.text
                 logger.error(
-                    f"Models API RequestError (Key ID: {log_key_id_display}, 名称: {key_name_for_error_log}, 后缀: {key_short_for_error}): {e}"
+                    f"/v1/models请求错误，Key ID: {key_id_for_db} (名称: {key_name_for_log}, 后缀: {key_short}): {response.status_code}"
                 )
-                
-                if key_id_for_db_error:  # 如果获取到了Key，则禁用
-                    await db.update_api_key_status(str(key_id_for_db_error), config.KEY_STATUS_INACTIVE)
-                    logger.info(
-                        f"Key ID {key_id_for_db_error} (名称: {key_name_for_error_log}) 因Models API RequestError被设为'{config.KEY_STATUS_INACTIVE}'。"
+                if retry_policy.classify_status_code(response.status_code) == retry_policy.FAULT_CLIENT:
+                    return _build_passthrough_response(response)
+                if key_id_for_db:
+                    await _handle_key_error_status(
+                        str(key_id_for_db), key_name_for_log, response.status_code, response.headers, source="Models "
                     )
-                    await utils.update_openai_key_cycle()
-                
-                if attempt < config.APP_CONFIG_MAX_RETRIES - 1:
-                    await asyncio.sleep(0.1)
-                    continue  # 继续尝试下一个Key
-                else:  # 所有尝试失败
-                    raise HTTPException(status_code=500, detail=f"连接OpenAI Models API多次尝试失败: {e}")
-
-            except HTTPException as e:  # 其他HTTP异常
-                key_id_display = current_key_config.get("id") if current_key_config else "N/A"
-                logger.error(
-                    f"Models API调用期间发生HTTPException (Key ID: {key_id_display}, 尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}): {e.status_code} - {e.detail}"
-                )
-
-                # 如果是初次尝试就因无可用Key而失败(503)，则直接抛出
-                if e.status_code == 503 and "无可用OpenAI Key" in e.detail and attempt == 0:
-                    raise
-
-                if attempt < config.APP_CONFIG_MAX_RETRIES - 1:
-                    await asyncio.sleep(0.1)
-                    continue  # 继续尝试
-                else:  # 所有尝试失败或遇到不可重试的错误
-                    raise
-
-        raise HTTPException(status_code=500, detail=f"所有{config.APP_CONFIG_MAX_RETRIES}次尝试均失败。")
+                raise HTTPException(status_code=response.status_code, detail=error_content)
+
+        except httpx.RequestError as e:  # 网络连接错误
+            key_id_for_db_error = current_key_config.get("id") if current_key_config else None
+            key_name_for_error_log = key_name_for_log if current_key_config else "N/A"
+            key_short_for_error = key_short if current_key_config else "N/A"
+            
+            log_key_id_display = key_id_for_db_error if key_id_for_db_error is not None else "N/A"
+            logger.error(
+                f"Models API RequestError (Key ID: {log_key_id_display}, 名称: {key_name_for_error_log}, 后缀: {key_short_for_error}): {e}"
+            )
+
+            # 传输错误归因于上游端点而不是Key
+            if breaker is not None:
+                breaker.record_failure()
+            failed_upstreams.add(upstream.name)
+
+            if attempt == config.APP_CONFIG_MAX_RETRIES - 1:  # 所有尝试失败
+                raise HTTPException(status_code=500, detail=f"连接OpenAI Models API多次尝试失败: {e}")
+            fault = retry_policy.FAULT_UPSTREAM
+
+        except HTTPException as e:  # 其他HTTP异常
+            key_id_display = current_key_config.get("id") if current_key_config else "N/A"
+            logger.error(
+                f"Models API调用期间发生HTTPException (Key ID: {key_id_display}, 尝试 {attempt + 1}/{config.APP_CONFIG_MAX_RETRIES}): {e.status_code} - {e.detail}"
+            )
+
+            # 如果是初次尝试就因无可用Key而失败(503)，则直接抛出
+            if e.status_code == 503 and "无可用OpenAI Key" in e.detail and attempt == 0:
+                raise
+
+            if current_key_config is not None and not isinstance(e, circuit_breaker.CircuitOpen):
+                key_scheduler.scheduler.record_failure(str(current_key_config["id"]))
+            if e.status_code in circuit_breaker.ENDPOINT_FAULT_STATUS_CODES:
+                failed_upstreams.add(upstream.name)
+
+            if attempt == config.APP_CONFIG_MAX_RETRIES - 1:  # 所有尝试失败
+                raise
+            fault = retry_policy.classify_status_code(e.status_code)
+
+        finally:
+            if current_key_config is not None:
+                key_scheduler.scheduler.release(str(current_key_config["id"]))
+
+        if fault == retry_policy.FAULT_UPSTREAM:
+            await asyncio.sleep(min(retry_policy.compute_backoff_seconds(attempt), deadline.remaining()))
+
+    raise HTTPException(status_code=500, detail=f"所有{config.APP_CONFIG_MAX_RETRIES}次尝试均失败。")
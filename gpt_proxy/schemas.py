@@ -14,6 +14,7 @@ class OpenAIChatRequest(BaseModel):
     top_p: Optional[float] = None
     n: Optional[int] = None
     stream: Optional[bool] = False
+    stream_options: Optional[Dict[str, Any]] = None
     stop: Optional[List[str]] = None
     max_tokens: Optional[int] = None
     presence_penalty: Optional[float] = None
@@ -30,11 +31,17 @@ class OpenAIKeyDisplay(BaseModel):
     created_at: Optional[str] = None
     last_used_at: Optional[str] = None
     total_requests: Optional[int] = 0
+    total_prompt_tokens: Optional[int] = 0
+    total_completion_tokens: Optional[int] = 0
+    total_cached_tokens: Optional[int] = 0
+    models: Optional[List[str]] = None  # 可调用的模型列表，None表示不限制
+    upstream: Optional[str] = None  # 绑定的上游名称，None表示可用于任意上游
 
 
 class NewOpenAIKeyPayload(BaseModel):
     api_key: str
     name: Optional[str] = None
+    upstream: Optional[str] = None
 
 
 class AddKeyResult(BaseModel):
@@ -96,8 +103,23 @@ class APIKeyNameUpdate(BaseModel):
     name: str
 
 
+class APIKeyModelsUpdate(BaseModel):
+    """更新API密钥可调用模型列表的请求模型"""
+
+    models: Optional[List[str]] = None  # None表示不限制
+
+
+class APIKeyUpstreamUpdate(BaseModel):
+    """更新API密钥绑定上游的请求模型"""
+
+    upstream: Optional[str] = None  # None表示不绑定上游
+
+
 class GlobalStats(BaseModel):
     grand_total_requests_all_time: int
+    grand_total_prompt_tokens_all_time: int = 0
+    grand_total_completion_tokens_all_time: int = 0
+    grand_total_cached_tokens_all_time: int = 0
     grand_total_usage_last_1m: int
     grand_total_usage_last_1h: int
     grand_total_usage_last_24h: int
@@ -109,3 +131,21 @@ class GlobalStats(BaseModel):
 
 class GlobalStatsResponse(BaseModel):
     global_stats: GlobalStats
+
+
+class ResponseCacheStats(BaseModel):
+    """响应缓存统计"""
+
+    enabled: bool
+    persist: bool
+    entries: int
+    bytes: int
+    max_entries: int
+    max_bytes: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+    bypasses: int
+    stores: int
+    evictions: int
+    hit_rate: float
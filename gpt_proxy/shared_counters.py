@@ -0,0 +1,306 @@
+"""
+多进程共享Key计数器模块
+
+使用 uvicorn --workers N 时每个工作进程的调度器只按自己的流量扣减令牌桶和TPM额度，每个Key的实际速率会是上限的N倍。
+开启后同一台机器上的所有工作进程通过一个内存映射文件共享每个Key的滑动窗口计数：
+
+- 文件由固定大小的槽位组成，Key ID的哈希值决定起始槽位（线性探测），槽位中保存该哈希值作为标记；
+- 每个槽位有两个环形计数数组：请求数（窗口为 usage_window_seconds）和Token数（窗口为60秒），
+  每个窗口分为 WINDOW_BUCKETS 段，窗口内的计数为仍在窗口内的各段之和；
+- 读写一个槽位时用fcntl对该槽位的字节范围加锁（按槽位分段加锁），不同Key之间互不阻塞。
+
+选取Key时先按全局请求数和Token数检查额度，通过后计入一次请求；请求结束后按实际用量计入Token数。
+未开启、平台不支持fcntl或文件无法使用时，调度器只使用进程内的令牌桶。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+try:
+    import fcntl
+except ImportError:  # Windows不支持fcntl，只能使用进程内的计数
+    fcntl = None
+
+from . import config
+from . import logger
+
+MAGIC = b"GPKC"
+LAYOUT_VERSION = 1
+WINDOW_BUCKETS = 12  # 每个滑动窗口的分段数
+HEADER_SIZE = 64
+SLOT_SIZE = 512
+TOKEN_WINDOW_SECONDS = 60.0
+
+# 文件头：标记、布局版本、槽位数、分段数、请求数窗口秒数、Token数窗口秒数
+_HEADER = struct.Struct("<4sIIIdd")
+# 槽位：Key标记、最近使用时间、请求数环形数组和Token数环形数组（每段为 (段序号, 计数)）
+_SLOT = struct.Struct("<Qd" + "q" * (4 * WINDOW_BUCKETS))
+_SLOT_HEAD = struct.Struct("<Qd")  # 槽位开头的Key标记和最近使用时间
+
+_TAG_INDEX = 0
+_LAST_USED_INDEX = 1
+_REQUESTS_BASE = 2
+_TOKENS_BASE = 2 + 2 * WINDOW_BUCKETS
+
+T = TypeVar("T")
+
+
+def _key_tag(key_id: str) -> int:
+    tag = int.from_bytes(hashlib.blake2b(key_id.encode("utf-8"), digest_size=8).digest(), "little")
+    return tag or 1  # 0表示空槽位
+
+
+def _window_total(values: List[int], base: int, epoch: int) -> int:
+    total = 0
+    for i in range(base, base + 2 * WINDOW_BUCKETS, 2):
+        if epoch - WINDOW_BUCKETS < values[i] <= epoch:
+            total += values[i + 1]
+    return total
+
+
+def _wait_seconds(values: List[int], base: int, epoch: int, bucket_seconds: float, limit: int, now: float) -> float:
+    """窗口内的计数达到limit时，返回最早的若干段移出窗口、计数低于limit所需的秒数；未达到时返回0"""
+    buckets = sorted(
+        (values[i], values[i + 1])
+        for i in range(base, base + 2 * WINDOW_BUCKETS, 2)
+        if epoch - WINDOW_BUCKETS < values[i] <= epoch and values[i + 1] > 0
+    )
+    excess = sum(count for _, count in buckets) - limit + 1
+    if excess <= 0:
+        return 0.0
+    for bucket_epoch, count in buckets:
+        excess -= count
+        if excess <= 0:
+            return max(0.001, (bucket_epoch + WINDOW_BUCKETS) * bucket_seconds - now)
+    return bucket_seconds
+
+
+def _add(values: List[int], base: int, epoch: int, amount: int):
+    i = base + 2 * (epoch % WINDOW_BUCKETS)
+    if values[i] != epoch:
+        values[i] = epoch
+        values[i + 1] = 0
+    values[i + 1] += amount
+
+
+class SharedKeyCounters:
+    """基于内存映射文件、按槽位加锁的每Key滑动窗口请求数和Token数计数器"""
+
+    def __init__(self, path: str, slots: int, request_window_seconds: float):
+        self.path = path
+        self.slots = max(1, slots)
+        self.request_window_seconds = float(request_window_seconds)
+        self.request_bucket_seconds = self.request_window_seconds / WINDOW_BUCKETS
+        self.token_bucket_seconds = TOKEN_WINDOW_SECONDS / WINDOW_BUCKETS
+        self._fd: Optional[int] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._slot_of: Dict[str, int] = {}  # Key ID -> 槽位（使用时在锁内校验标记）
+
+        self.rejected = 0  # 因全局额度用尽而拒绝的次数
+        self.table_full = 0  # 没有空闲槽位、该Key只使用进程内计数的次数
+        self.errors = 0
+
+    @property
+    def available(self) -> bool:
+        return self._mmap is not None
+
+    def open(self) -> bool:
+        """打开（或创建）计数器文件，返回是否可用；文件头与当前配置不一致时不使用"""
+        if fcntl is None:
+            logger.warning("当前平台不支持fcntl，无法使用多进程共享Key计数器，使用进程内计数。")
+            return False
+        if self.available:
+            return True
+        size = HEADER_SIZE + self.slots * SLOT_SIZE
+        expected_header = _HEADER.pack(
+            MAGIC, LAYOUT_VERSION, self.slots, WINDOW_BUCKETS, self.request_window_seconds, TOKEN_WINDOW_SECONDS
+        )
+        fd = None
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            # 文件头区域加锁，多个工作进程同时启动时只有一个进程初始化文件
+            fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                current_size = os.fstat(fd).st_size
+                if current_size == 0:
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, expected_header, 0)
+                compatible = current_size in (0, size) and os.pread(fd, _HEADER.size, 0) == expected_header
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+            if not compatible:
+                logger.error(
+                    f"共享Key计数器文件 {self.path} 的布局与当前配置（槽位数、使用窗口）不一致，使用进程内计数；"
+                    f"请在所有工作进程停止后删除该文件。"
+                )
+                os.close(fd)
+                return False
+            self._mmap = mmap.mmap(fd, size)
+        except OSError as e:
+            logger.error(f"打开共享Key计数器文件 {self.path} 失败，使用进程内计数: {e}")
+            if fd is not None:
+                os.close(fd)
+            return False
+        self._fd = fd
+        logger.info(f"已打开共享Key计数器文件 {self.path}（{self.slots} 个槽位）。")
+        return True
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._slot_of.clear()
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * SLOT_SIZE
+
+    def _lock(self, index: int):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT_SIZE, self._offset(index))
+
+    def _unlock(self, index: int):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT_SIZE, self._offset(index))
+
+    def _claim(self, index: int, tag: int, now: float):
+        values = [0] * (2 + 4 * WINDOW_BUCKETS)
+        values[_TAG_INDEX] = tag
+        values[_LAST_USED_INDEX] = now
+        _SLOT.pack_into(self._mmap, self._offset(index), *values)
+
+    def _find_slot(self, key_id: str, tag: int) -> Optional[int]:
+        """线性探测查找Key的槽位，不存在时占用第一个空槽位；没有空槽位时占用一个超过使用窗口未使用的槽位"""
+        now = time.time()
+        start = tag % self.slots
+        stale_before = now - self.request_window_seconds - self.request_bucket_seconds
+        stale_index = None
+        for probe in range(self.slots):
+            index = (start + probe) % self.slots
+            self._lock(index)
+            try:
+                stored_tag, last_used = _SLOT_HEAD.unpack_from(self._mmap, self._offset(index))
+                if stored_tag == tag:
+                    return index
+                if stored_tag == 0:
+                    self._claim(index, tag, now)
+                    return index
+            finally:
+                self._unlock(index)
+            if stale_index is None and last_used < stale_before:
+                stale_index = index
+        if stale_index is not None:
+            self._lock(stale_index)
+            try:
+                # 加锁后重新检查：其他进程可能刚刚占用或使用了该槽位
+                stored_tag, last_used = _SLOT_HEAD.unpack_from(self._mmap, self._offset(stale_index))
+                if stored_tag == tag or last_used < stale_before:
+                    if stored_tag != tag:
+                        self._claim(stale_index, tag, now)
+                    return stale_index
+            finally:
+                self._unlock(stale_index)
+        return None
+
+    def _update(self, key_id: str, update: Callable[[List[int], float], T], write: bool = True) -> Optional[T]:
+        """在槽位锁内读取、修改并写回Key的计数，Key没有槽位或出错时返回None"""
+        if self._mmap is None:
+            return None
+        tag = _key_tag(key_id)
+        try:
+            for _ in range(2):
+                index = self._slot_of.get(key_id)
+                if index is None:
+                    index = self._find_slot(key_id, tag)
+                    if index is None:
+                        self.table_full += 1
+                        return None
+                    self._slot_of[key_id] = index
+                offset = self._offset(index)
+                self._lock(index)
+                try:
+                    values = list(_SLOT.unpack_from(self._mmap, offset))
+                    if values[_TAG_INDEX] != tag:
+                        # 槽位已被其他Key占用（本Key长时间未使用），重新查找
+                        del self._slot_of[key_id]
+                        continue
+                    now = time.time()
+                    result = update(values, now)
+                    if write:
+                        values[_LAST_USED_INDEX] = now
+                        _SLOT.pack_into(self._mmap, offset, *values)
+                    return result
+                finally:
+                    self._unlock(index)
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            logger.error(f"更新共享Key计数器失败 (Key ID: {key_id}): {e}")
+        return None
+
+    def try_acquire(self, key_id: str, max_requests: int, max_tokens: int) -> Optional[float]:
+        """
+        检查Key在所有进程中的全局额度：窗口内请求数少于max_requests且Token数少于max_tokens（不大于0表示不限制）时
+        计入一次请求并返回0；额度用尽时返回额度恢复所需的秒数；Key无法使用共享计数时返回None。
+        """
+
+        def update(values: List[int], now: float) -> float:
+            request_epoch = int(now // self.request_bucket_seconds)
+            wait = 0.0
+            if max_requests > 0:
+                wait = _wait_seconds(
+                    values, _REQUESTS_BASE, request_epoch, self.request_bucket_seconds, max_requests, now
+                )
+            if max_tokens > 0:
+                token_epoch = int(now // self.token_bucket_seconds)
+                wait = max(
+                    wait,
+                    _wait_seconds(values, _TOKENS_BASE, token_epoch, self.token_bucket_seconds, max_tokens, now),
+                )
+            if wait <= 0:
+                _add(values, _REQUESTS_BASE, request_epoch, 1)
+            return wait
+
+        wait = self._update(key_id, update)
+        if wait:
+            self.rejected += 1
+        return wait
+
+    def add_tokens(self, key_id: str, tokens: int):
+        """计入Key一次请求实际消耗的Token数"""
+        if tokens > 0:
+            self._update(
+                key_id, lambda values, now: _add(values, _TOKENS_BASE, int(now // self.token_bucket_seconds), tokens)
+            )
+
+    def usage(self, key_id: str) -> Optional[Tuple[int, int]]:
+        """返回Key在所有进程中窗口内的 (请求数, Token数)"""
+        return self._update(
+            key_id,
+            lambda values, now: (
+                _window_total(values, _REQUESTS_BASE, int(now // self.request_bucket_seconds)),
+                _window_total(values, _TOKENS_BASE, int(now // self.token_bucket_seconds)),
+            ),
+            write=False,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "slots": self.slots,
+            "available": self.available,
+            "request_window_seconds": self.request_window_seconds,
+            "token_window_seconds": TOKEN_WINDOW_SECONDS,
+            "rejected": self.rejected,
+            "table_full": self.table_full,
+            "errors": self.errors,
+        }
+
+
+counters = SharedKeyCounters(
+    path=config.SHARED_COUNTERS_PATH,
+    slots=config.SHARED_COUNTERS_SLOTS,
+    request_window_seconds=config.USAGE_WINDOW_SECONDS,
+)
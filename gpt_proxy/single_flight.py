@@ -0,0 +1,307 @@
+"""
+在途请求合并（single-flight）模块
+
+相同的非流式请求在途时，重复的调用方等待首个请求（leader）的结果，而不是各自调用上游；
+可选地将一个上游SSE流扇出给多个订阅者，后加入的订阅者会先收到已转发的数据再接收后续数据；
+重放缓冲有上限，超过后新的相同请求各自打开上游流，长时间不读取数据的订阅者被断开。
+"""
+import asyncio
+import hashlib
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi.responses import Response, StreamingResponse
+
+from . import config
+from . import logger
+from . import streaming
+from . import utils
+
+
+def build_flight_key(raw_body: bytes, is_stream: bool) -> Optional[str]:
+    """
+    根据原始请求体计算合并键；请求不应被合并时返回None。
+
+    配置 deterministic_only = true 时只合并 temperature=0 的请求，避免多个调用方拿到同一个随机采样结果。
+    """
+    if config.COALESCING_DETERMINISTIC_ONLY:
+        try:
+            if utils.sniff_chat_request_temperature(raw_body) != 0:
+                return None
+        except ValueError:
+            return None
+    prefix = b"stream:" if is_stream else b"chat:"
+    return hashlib.sha256(prefix + raw_body).hexdigest()
+
+
+def clone_response(response: Response) -> Response:
+    """为跟随者复制leader的响应（不包含后台任务）"""
+    headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+    headers["x-proxy-coalesced"] = "1"
+    return Response(content=response.body, status_code=response.status_code, headers=headers)
+
+
+class SingleFlight:
+    """合并相同键的并发调用，所有调用方共享同一个任务的结果或异常"""
+
+    def __init__(self):
+        self._calls: Dict[str, "asyncio.Task[Any]"] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行func或等待相同键的在途调用，返回 (结果, 是否为共享结果)。
+
+        任务独立于调用方运行，leader的客户端断开不会影响仍在等待的跟随者。
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.followers += 1
+            return await asyncio.shield(task), True
+
+        self.leaders += 1
+        task = asyncio.ensure_future(func())
+        self._calls[key] = task
+        task.add_done_callback(lambda finished_task: self._release(key, finished_task))
+        return await asyncio.shield(task), False
+
+    def _release(self, key: str, task: "asyncio.Task[Any]"):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # 标记异常已被获取，避免无人等待时产生警告
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class StreamBroadcast:
+    """
+    将一个上游流转发给多个订阅者，订阅者从加入时起读取全部数据块（后加入的订阅者先重放已转发的数据）。
+
+    流累计超过replay_max_bytes后不再接受新的订阅者，所有已加入的订阅者都读取过的数据块随即释放；
+    有待读数据却超过subscriber_timeout_seconds未读取的订阅者被断开，所有订阅者都断开后停止读取上游流。
+    """
+
+    def __init__(self, replay_max_bytes: int, subscriber_timeout_seconds: float):
+        self.replay_max_bytes = replay_max_bytes
+        self.subscriber_timeout_seconds = subscriber_timeout_seconds
+        self.ready: "asyncio.Future[Optional[Response]]" = asyncio.get_running_loop().create_future()
+        self.headers: Dict[str, str] = {}
+        self.media_type: Optional[str] = None
+        self.chunks: List[bytes] = []
+        self.first_index = 0  # chunks[0]的序号，之前的数据块已释放
+        self.total_bytes = 0
+        self.buffered_bytes = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.evicted = 0
+        self._next_index: Dict[int, int] = {}  # 订阅者 -> 下一个要读取的数据块序号
+        self._pending_since: Dict[int, float] = {}  # 订阅者 -> 最近一次读取（或有新数据可读）的时间
+        self._next_subscriber_id = 0
+        self._changed = asyncio.Event()
+        self._pump_task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._next_index)
+
+    @property
+    def joinable(self) -> bool:
+        """新的订阅者能否加入（流未结束且从第一个数据块起都还能重放）"""
+        return not self.done and (self.replay_max_bytes <= 0 or self.total_bytes <= self.replay_max_bytes)
+
+    def start(self, open_stream: Callable[[], Awaitable[Response]], on_done: Callable[[], None]):
+        self._pump_task = asyncio.ensure_future(self._pump(open_stream, on_done))
+
+    async def _pump(self, open_stream: Callable[[], Awaitable[Response]], on_done: Callable[[], None]):
+        response: Optional[Response] = None
+        try:
+            response = await open_stream()
+            if not isinstance(response, StreamingResponse):
+                # 上游返回了非流式响应（例如客户端错误），所有订阅者共享该响应
+                self.ready.set_result(response)
+                self._finish()
+                return
+
+            self.headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+            self.media_type = response.media_type
+            self.ready.set_result(None)
+            async for chunk in response.body_iterator:
+                self._append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+            self._finish()
+        except BaseException as e:
+            if not self.ready.done():
+                self.ready.set_exception(e)
+                self.ready.exception()  # 标记异常已被获取
+            self._finish(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            if isinstance(response, streaming.ClosingStreamingResponse):
+                # 响应不经过ASGI发送，由这里执行其关闭回调（释放Key和准入名额、写入使用记录、关闭上游响应）
+                await response.aclose()
+            on_done()
+
+    def _append(self, chunk: bytes):
+        now = time.monotonic()
+        end = self.first_index + len(self.chunks)
+        for subscriber_id, index in self._next_index.items():
+            if index == end:  # 已读完的订阅者从现在起有新数据可读
+                self._pending_since[subscriber_id] = now
+        self.chunks.append(chunk)
+        self.total_bytes += len(chunk)
+        self.buffered_bytes += len(chunk)
+        self._trim()
+        self._evict_stalled(now)
+        self._notify()
+
+    def _trim(self):
+        """不再接受新的订阅者后，释放所有订阅者都已读取的数据块"""
+        if self.joinable:
+            return
+        oldest = min(self._next_index.values(), default=self.first_index + len(self.chunks))
+        released = oldest - self.first_index
+        if released > 0:
+            self.buffered_bytes -= sum(len(chunk) for chunk in self.chunks[:released])
+            del self.chunks[:released]
+            self.first_index = oldest
+
+    def _evict_stalled(self, now: float):
+        if self.subscriber_timeout_seconds <= 0:
+            return
+        end = self.first_index + len(self.chunks)
+        stalled = [
+            subscriber_id
+            for subscriber_id, index in self._next_index.items()
+            if index < end and now - self._pending_since[subscriber_id] > self.subscriber_timeout_seconds
+        ]
+        for subscriber_id in stalled:
+            self.evicted += 1
+            logger.warning(f"流式扇出的订阅者超过 {self.subscriber_timeout_seconds} 秒未读取数据，已断开。")
+            self.detach(subscriber_id)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def attach(self) -> int:
+        """加入一个订阅者（从第一个数据块开始读取），返回订阅者ID；只能在joinable时调用"""
+        subscriber_id = self._next_subscriber_id
+        self._next_subscriber_id += 1
+        self._next_index[subscriber_id] = self.first_index
+        self._pending_since[subscriber_id] = time.monotonic()
+        return subscriber_id
+
+    def detach(self, subscriber_id: int):
+        """移除订阅者（可重复调用）；所有订阅者都已断开时停止读取上游流"""
+        if self._next_index.pop(subscriber_id, None) is None:
+            return
+        self._pending_since.pop(subscriber_id, None)
+        if not self._next_index and not self.done and self._pump_task is not None:
+            self._pump_task.cancel()
+        else:
+            self._trim()
+
+    async def subscribe(self, subscriber_id: int):
+        """读取订阅者的数据块直到流结束；订阅者因长时间未读取被断开时抛出TimeoutError"""
+        try:
+            while True:
+                index = self._next_index.get(subscriber_id)
+                if index is None:
+                    raise asyncio.TimeoutError("流式扇出的订阅者长时间未读取数据，已被断开")
+                if index < self.first_index + len(self.chunks):
+                    yield self.chunks[index - self.first_index]
+                    if subscriber_id in self._next_index:
+                        self._next_index[subscriber_id] = index + 1
+                        self._pending_since[subscriber_id] = time.monotonic()
+                        self._trim()
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.detach(subscriber_id)
+
+
+class StreamFanout:
+    """按合并键管理在途的上游流，相同请求订阅同一个流"""
+
+    def __init__(self):
+        self._broadcasts: Dict[str, StreamBroadcast] = {}  # 仍可加入的流
+        self._running: Set[StreamBroadcast] = set()
+        self.streams_opened = 0
+        self.subscribers_joined = 0
+        self.subscribers_evicted = 0
+
+    async def subscribe(self, key: str, open_stream: Callable[[], Awaitable[Response]]) -> Response:
+        """订阅相同键的在途流，不存在或已不能加入时打开新的上游流"""
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None or not broadcast.joinable:
+            broadcast = StreamBroadcast(
+                replay_max_bytes=config.COALESCING_STREAM_REPLAY_MAX_BYTES,
+                subscriber_timeout_seconds=config.COALESCING_STREAM_SUBSCRIBER_TIMEOUT_SECONDS,
+            )
+            self._broadcasts[key] = broadcast
+            self._running.add(broadcast)
+            self.streams_opened += 1
+            subscriber_id = broadcast.attach()
+            broadcast.start(open_stream, on_done=lambda: self._release(key, broadcast))
+        else:
+            subscriber_id = broadcast.attach()
+            self.subscribers_joined += 1
+            logger.debug(f"流式请求合并到在途上游流: {key[:16]}")
+
+        try:
+            shared_response = await asyncio.shield(broadcast.ready)
+        except BaseException:
+            broadcast.detach(subscriber_id)
+            raise
+        if shared_response is not None:
+            broadcast.detach(subscriber_id)
+            return clone_response(shared_response)
+        response = streaming.ClosingStreamingResponse(
+            broadcast.subscribe(subscriber_id), media_type=broadcast.media_type, headers=broadcast.headers
+        )
+        # 响应体从未被读取（例如客户端在响应开始前断开）时也要移除订阅者
+        response.call_on_close(lambda: broadcast.detach(subscriber_id))
+        return response
+
+    def _release(self, key: str, broadcast: StreamBroadcast):
+        if self._broadcasts.get(key) is broadcast:
+            del self._broadcasts[key]
+        self._running.discard(broadcast)
+        self.subscribers_evicted += broadcast.evicted
+
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def buffered_bytes(self) -> int:
+        return sum(broadcast.buffered_bytes for broadcast in self._running)
+
+
+request_flights = SingleFlight()
+stream_fanout = StreamFanout()
+
+
+def get_stats() -> Dict[str, Any]:
+    return {
+        "enabled": config.COALESCING_ENABLED,
+        "stream_fanout": config.COALESCING_STREAM_FANOUT,
+        "requests_in_flight": request_flights.in_flight(),
+        "request_leaders": request_flights.leaders,
+        "request_followers": request_flights.followers,
+        "streams_in_flight": stream_fanout.in_flight(),
+        "streams_opened": stream_fanout.streams_opened,
+        "stream_subscribers_joined": stream_fanout.subscribers_joined,
+        "stream_subscribers_evicted": stream_fanout.subscribers_evicted,
+        "stream_buffered_bytes": stream_fanout.buffered_bytes(),
+    }
@@ -0,0 +1,49 @@
+"""
+流式响应模块
+
+StreamingResponse只有在响应体被迭代时才会执行生成器中的清理代码：客户端在响应开始前断开时，
+生成器从未开始执行，写在其finally中的释放逻辑（Key的在途名额、准入名额、上游连接）永远不会运行。
+
+ClosingStreamingResponse在发送结束后（无论响应体是否被迭代、是否正常结束）执行注册的关闭回调，每个回调只执行一次。
+不经过ASGI发送而直接读取响应体的调用方（流扇出）读取结束后需自行调用aclose()。
+"""
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+from fastapi.responses import StreamingResponse
+
+from . import logger
+
+CloseCallback = Callable[[], Optional[Awaitable[None]]]
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """发送结束后执行关闭回调的流式响应"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._close_callbacks: List[CloseCallback] = []
+
+    def call_on_close(self, callback: CloseCallback):
+        """注册关闭回调（同步函数或协程函数），按注册顺序执行"""
+        self._close_callbacks.append(callback)
+
+    async def aclose(self):
+        """关闭响应体迭代器并执行关闭回调；可重复调用，回调只执行一次"""
+        body_aclose = getattr(self.body_iterator, "aclose", None)
+        if body_aclose is not None:
+            await body_aclose()
+        callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"执行流式响应的关闭回调失败: {e}")
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.aclose()
@@ -0,0 +1,91 @@
+"""
+Token用量解析模块
+
+从上游响应中读取 usage 字段（prompt_tokens、completion_tokens、prompt_tokens_details.cached_tokens）。
+响应体原样透传，不做完整的JSON解码：从末尾反向查找 "usage" 字段，只解码该字段的值；
+流式响应只保留最后一段字节，流结束后从中读取最后的usage数据块。
+"""
+import json
+from typing import Any, NamedTuple, Optional
+
+_USAGE_FIELD = b'"usage"'
+_STREAM_OPTIONS_FIELD = b'"stream_options"'
+_INCLUDE_USAGE_OPTION = b'"stream_options":{"include_usage":true}'
+_MAX_USAGE_FIELD_LOOKUPS = 4  # 最多尝试的 "usage" 出现位置数量
+
+STREAM_TAIL_BYTES = 4096  # 流式响应保留的末尾字节数，足以包含最后的usage数据块和[DONE]
+
+_decoder = json.JSONDecoder()
+
+
+class TokenUsage(NamedTuple):
+    """一次请求的Token用量"""
+
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def _as_count(value: Any) -> int:
+    return value if isinstance(value, int) and not isinstance(value, bool) and value > 0 else 0
+
+
+def usage_from_dict(usage: Any) -> Optional[TokenUsage]:
+    """将上游的usage对象转换为TokenUsage，不是有效的usage对象时返回None"""
+    if not isinstance(usage, dict):
+        return None
+    details = usage.get("prompt_tokens_details")
+    cached_tokens = details.get("cached_tokens") if isinstance(details, dict) else None
+    return TokenUsage(
+        _as_count(usage.get("prompt_tokens")), _as_count(usage.get("completion_tokens")), _as_count(cached_tokens)
+    )
+
+
+def parse_usage(body: bytes) -> Optional[TokenUsage]:
+    """
+    从响应体（或流式响应的末尾字节）中读取最后一个非空的usage对象，没有时返回None。
+
+    字符串中的 "usage" 会被转义为 \\"usage\\"，因此按字节查找只会命中JSON对象的键。
+    """
+    end = len(body)
+    for _ in range(_MAX_USAGE_FIELD_LOOKUPS):
+        position = body.rfind(_USAGE_FIELD, 0, end)
+        if position < 0:
+            return None
+        end = position
+        text = body[position + len(_USAGE_FIELD):].decode("utf-8", errors="replace").lstrip()
+        if not text.startswith(":"):
+            continue
+        try:
+            value, _ = _decoder.raw_decode(text[1:].lstrip())
+        except ValueError:
+            continue
+        if value is None:
+            return None  # 流式响应中最后一个usage为null，说明上游没有返回用量
+        usage = usage_from_dict(value)
+        if usage is not None:
+            return usage
+    return None
+
+
+def inject_stream_include_usage(body: bytes) -> bytes:
+    """
+    为流式聊天请求体设置 stream_options.include_usage = true。
+
+    请求体中没有stream_options时直接在对象开头插入字段，不重新序列化；已有stream_options时解码后合并。
+    """
+    if _STREAM_OPTIONS_FIELD not in body:
+        start = body.index(b"{") + 1
+        separator = b"" if body[start:].lstrip().startswith(b"}") else b","
+        return body[:start] + _INCLUDE_USAGE_OPTION + separator + body[start:]
+
+    payload = json.loads(body)
+    stream_options = payload.get("stream_options")
+    if isinstance(stream_options, dict) and stream_options.get("include_usage") is True:
+        return body
+    payload["stream_options"] = {**(stream_options if isinstance(stream_options, dict) else {}), "include_usage": True}
+    return json.dumps(payload).encode("utf-8")
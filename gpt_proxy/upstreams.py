@@ -0,0 +1,264 @@
+"""
+多上游模块
+
+config.ini 中每个 [Upstream:名称] 部分定义一个OpenAI兼容的上游（聊天URL、模型列表URL、权重、提供的模型和模型名映射），
+没有定义时[OpenAI_Endpoints]作为名为default的唯一上游。
+
+转发请求时先选择上游，再选择绑定到该上游（或未绑定上游）的Key：
+只考虑提供所请求模型、有可用Key、健康检查通过且熔断器放行的上游，按权重随机选择；
+权重为0的上游只在其他上游都不可用时使用，重试时优先换一个上游。
+
+- 主动健康检查：后台任务定期请求每个上游的models_url，连接失败、超时或5xx计为失败
+  （不带Key，401等4xx说明上游可达），连续失败达到阈值后不再选择该上游，连续成功后恢复；
+- 被动异常剔除：请求上游时的传输错误和502/503/504计入该上游端点的熔断器（circuit_breaker），
+  熔断中的上游不再被选择，所有可选上游都熔断时快速失败。
+"""
+import asyncio
+import json
+import math
+import random
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+import httpx
+
+from . import config
+from . import logger
+from . import circuit_breaker
+from . import http_client
+from . import key_scheduler
+
+
+class Upstream:
+    """单个上游的配置和健康状态"""
+
+    def __init__(
+        self,
+        name: str,
+        chat_completions_url: str,
+        models_url: str,
+        weight: int = 1,
+        models: Optional[List[str]] = None,
+        model_map: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.chat_completions_url = chat_completions_url
+        self.models_url = models_url
+        self.weight = weight
+        self.models: Optional[FrozenSet[str]] = frozenset(models) if models is not None else None
+        self.model_map = model_map or {}
+
+        self.healthy = True
+        self.consecutive_probe_failures = 0
+        self.consecutive_probe_successes = 0
+        self.last_probe_error: Optional[str] = None
+        self.selected = 0
+
+    @property
+    def breaker(self) -> Optional[circuit_breaker.CircuitBreaker]:
+        return circuit_breaker.breakers.get(self.chat_completions_url)
+
+    def serves(self, model: Optional[str]) -> bool:
+        """上游是否提供所请求的模型"""
+        return model is None or self.models is None or model in self.models or model in self.model_map
+
+    def upstream_model(self, model: Optional[str]) -> Optional[str]:
+        """所请求的模型在该上游的名称"""
+        return self.model_map.get(model, model) if model is not None else None
+
+    def map_request_body(self, body: bytes, model: Optional[str]) -> bytes:
+        """模型名需要映射时改写请求体中的model，否则原样返回"""
+        upstream_model = self.upstream_model(model)
+        if upstream_model == model:
+            return body
+        payload = json.loads(body)
+        payload["model"] = upstream_model
+        return json.dumps(payload).encode("utf-8")
+
+    def is_available(self) -> bool:
+        breaker = self.breaker
+        return self.healthy and (breaker is None or breaker.is_available())
+
+    def begin_request(self):
+        """
+        即将向上游发送请求时调用（与发送之间不能有await）：半开状态下占用一个探测名额，熔断器未放行时抛出CircuitOpen。
+
+        选择上游时只判断是否可用而不占用名额，没有Key、排队超时等请求未到达上游的情况不会遗留探测名额。
+        """
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow_request():
+            retry_after = max(1, math.ceil(breaker.retry_after()))
+            raise circuit_breaker.CircuitOpen(
+                status_code=503,
+                detail=f"上游 {self.name} 暂时不可用（熔断中），请 {retry_after} 秒后重试。",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+    def record_probe(self, ok: bool, error: Optional[str], healthy_threshold: int, unhealthy_threshold: int):
+        if ok:
+            self.consecutive_probe_failures = 0
+            self.consecutive_probe_successes += 1
+            self.last_probe_error = None
+            if not self.healthy and self.consecutive_probe_successes >= healthy_threshold:
+                self.healthy = True
+                logger.info(f"上游 {self.name} 健康检查恢复正常。")
+        else:
+            self.consecutive_probe_successes = 0
+            self.consecutive_probe_failures += 1
+            self.last_probe_error = error
+            if self.healthy and self.consecutive_probe_failures >= unhealthy_threshold:
+                self.healthy = False
+                logger.warning(f"上游 {self.name} 连续 {self.consecutive_probe_failures} 次健康检查失败，暂停使用: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        breaker = self.breaker
+        return {
+            "name": self.name,
+            "chat_completions_url": self.chat_completions_url,
+            "models_url": self.models_url,
+            "weight": self.weight,
+            "models": sorted(self.models) if self.models is not None else None,
+            "model_map": self.model_map,
+            "healthy": self.healthy,
+            "consecutive_probe_failures": self.consecutive_probe_failures,
+            "last_probe_error": self.last_probe_error,
+            "circuit_state": breaker.stats()["state"] if breaker is not None else None,
+            "eligible_keys": key_scheduler.scheduler.eligible_count(None, self.name),
+            "selected": self.selected,
+        }
+
+
+class UpstreamPool:
+    """按权重选择上游，并定期进行主动健康检查"""
+
+    def __init__(
+        self,
+        upstream_configs: Iterable[Dict[str, Any]],
+        health_check_interval_seconds: float,
+        health_check_timeout_seconds: float,
+        unhealthy_threshold: int,
+        healthy_threshold: int,
+    ):
+        self.upstreams = [Upstream(**upstream_config) for upstream_config in upstream_configs]
+        self._by_name = {upstream.name: upstream for upstream in self.upstreams}
+        self.health_check_interval_seconds = health_check_interval_seconds
+        self.health_check_timeout_seconds = health_check_timeout_seconds
+        self.unhealthy_threshold = max(1, unhealthy_threshold)
+        self.healthy_threshold = max(1, healthy_threshold)
+        self._health_check_task: Optional["asyncio.Task[None]"] = None
+
+    def get(self, name: Optional[str]) -> Optional[Upstream]:
+        return self._by_name.get(name) if name is not None else None
+
+    def resolve(self, name: Optional[str]) -> Upstream:
+        """名称对应的上游，未绑定（或绑定的上游已不在配置中）时为第一个上游"""
+        return self.get(name) or self.upstreams[0]
+
+    def for_key(self, key_id: str) -> Upstream:
+        """池中Key绑定的上游"""
+        return self.resolve(key_scheduler.scheduler.upstream_of(key_id))
+
+    def _candidates(self, model: Optional[str]) -> List[Upstream]:
+        # 提供所请求模型并且有能调用该模型的Key的上游
+        return [
+            upstream
+            for upstream in self.upstreams
+            if upstream.serves(model)
+            and key_scheduler.scheduler.eligible_count(upstream.upstream_model(model), upstream.name) > 0
+        ]
+
+    def serves(self, model: Optional[str]) -> bool:
+        """是否有上游能用池中的Key提供所请求的模型"""
+        return bool(self._candidates(model))
+
+    def select(self, model: Optional[str], avoid: Iterable[str] = (), by_weight: bool = True) -> Upstream:
+        """
+        选择一个可用的上游：优先不在avoid中的上游，by_weight为False时按配置顺序选择第一个。
+
+        没有任何上游有可用的Key时返回第一个提供该模型的上游（由选取Key的流程处理无Key的情况）；
+        有这样的上游但都不可用（包括熔断器半开且探测名额已被占用）时抛出CircuitOpen（503和Retry-After）。
+        选择时不占用探测名额，发送请求前由begin_request占用。
+        """
+        candidates = self._candidates(model)
+        if not candidates:
+            return next((upstream for upstream in self.upstreams if upstream.serves(model)), self.upstreams[0])
+        available = [upstream for upstream in candidates if upstream.is_available()]
+        preferred = [upstream for upstream in available if upstream.name not in avoid] or available
+        weighted = [upstream for upstream in preferred if upstream.weight > 0] or preferred
+        if not weighted:
+            retry_after = self._retry_after(candidates)
+            raise circuit_breaker.CircuitOpen(
+                status_code=503,
+                detail=f"没有可用的上游（健康检查失败或熔断中），请 {retry_after} 秒后重试。",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        if by_weight and len(weighted) > 1:
+            chosen = random.choices(weighted, weights=[upstream.weight or 1 for upstream in weighted])[0]
+        else:
+            chosen = weighted[0]
+        chosen.selected += 1
+        return chosen
+
+    def _retry_after(self, candidates: List[Upstream]) -> int:
+        waits = [upstream.breaker.retry_after() for upstream in candidates if upstream.healthy and upstream.breaker]
+        if not waits:
+            waits = [self.health_check_interval_seconds or 1.0]
+        return max(1, math.ceil(min(waits)))
+
+    # --- 主动健康检查 ---
+
+    async def probe(self, upstream: Upstream):
+        """请求一次上游的models_url并记录结果"""
+        try:
+            response = await http_client.get_http_client().get(
+                upstream.models_url, timeout=self.health_check_timeout_seconds
+            )
+        except httpx.RequestError as e:
+            upstream.record_probe(False, f"{type(e).__name__}: {e}", self.healthy_threshold, self.unhealthy_threshold)
+            return
+        ok = response.status_code < 500
+        upstream.record_probe(
+            ok, None if ok else f"HTTP {response.status_code}", self.healthy_threshold, self.unhealthy_threshold
+        )
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.gather(*(self.probe(upstream) for upstream in self.upstreams))
+            await asyncio.sleep(self.health_check_interval_seconds)
+
+    def start_health_checks(self):
+        """启动定期健康检查，间隔不大于0时不启动"""
+        if self.health_check_interval_seconds > 0 and (
+            self._health_check_task is None or self._health_check_task.done()
+        ):
+            self._health_check_task = asyncio.ensure_future(self._health_check_loop())
+
+    def stop_health_checks(self):
+        if self._health_check_task is not None and not self._health_check_task.done():
+            self._health_check_task.cancel()
+        self._health_check_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "health_check_interval_seconds": self.health_check_interval_seconds,
+            "upstreams": [upstream.stats() for upstream in self.upstreams],
+        }
+
+
+def _default_upstream_configs() -> List[Dict[str, Any]]:
+    return [
+        {
+            "name": config.DEFAULT_UPSTREAM_NAME,
+            "chat_completions_url": config.OPENAI_API_ENDPOINT,
+            "models_url": config.OPENAI_VALIDATION_ENDPOINT,
+        }
+    ]
+
+
+pool = UpstreamPool(
+    upstream_configs=config.UPSTREAMS or _default_upstream_configs(),
+    health_check_interval_seconds=config.UPSTREAM_HEALTH_CHECK_INTERVAL_SECONDS,
+    health_check_timeout_seconds=config.UPSTREAM_HEALTH_CHECK_TIMEOUT_SECONDS,
+    unhealthy_threshold=config.UPSTREAM_UNHEALTHY_THRESHOLD,
+    healthy_threshold=config.UPSTREAM_HEALTHY_THRESHOLD,
+)
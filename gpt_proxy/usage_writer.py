@@ -0,0 +1,181 @@
+"""
+API Key使用记录的批量异步写入模块
+
+请求路径只把使用记录放入内存队列，由后台任务按时间间隔或行数批量写入数据库：
+请求日志使用多行INSERT，每个Key每批只执行一次聚合UPDATE（total_requests、Token累计数和last_used_at）。
+关闭时会写入所有待处理的记录。
+"""
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, NamedTuple, Optional
+
+from . import config
+from . import database as db
+from . import logger
+from .token_usage import TokenUsage
+
+
+class UsageRecord(NamedTuple):
+    """一条待写入的API Key使用记录"""
+
+    key_id: str
+    model: Optional[str]
+    status: Optional[str]
+    timestamp: datetime
+    touch_last_used: bool  # 是否同时更新Key的last_used_at
+    enqueued_at: float  # time.monotonic() 时间戳，用于计算队列延迟
+    usage: Optional[TokenUsage] = None  # 上游返回的Token用量
+
+
+class UsageWriter:
+    """内存队列 + 后台批量写入任务"""
+
+    def __init__(self, flush_interval_seconds: float, batch_size: int, max_pending: int):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: Deque[UsageRecord] = deque()
+        self._batch_ready = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._flush_lock = asyncio.Lock()
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_rows = 0
+        self.last_flush_duration = 0.0
+        self.last_flush_lag = 0.0
+
+    def enqueue(
+        self,
+        key_id: str,
+        model: Optional[str],
+        status: Optional[str],
+        touch_last_used: bool = False,
+        usage: Optional[TokenUsage] = None,
+    ):
+        """记录一次使用（不等待数据库），队列已满时丢弃最旧的记录"""
+        if len(self._pending) >= self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"使用记录队列已满 ({self.max_pending})，已丢弃 {self.dropped} 条最旧的记录。")
+        self._pending.append(
+            UsageRecord(key_id, model, status, datetime.now(), touch_last_used, time.monotonic(), usage)
+        )
+        self.enqueued += 1
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入所有待处理的记录"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._pending:
+            if not await self.flush():
+                logger.error(f"关闭时写入使用记录失败，{len(self._pending)} 条记录未能保存。")
+                break
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            while self._pending:
+                if not await self.flush():
+                    break  # 写入失败时等待下一个周期再重试
+                if len(self._pending) < self.batch_size:
+                    break
+
+    async def flush(self) -> bool:
+        """写入最多batch_size条待处理记录，失败时将记录放回队首，返回是否成功"""
+        async with self._flush_lock:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return True
+
+            log_rows = []
+            key_updates: Dict[str, Dict[str, Any]] = {}
+            for record in batch:
+                usage = record.usage
+                log_rows.append(
+                    {
+                        "key_id": record.key_id,
+                        "timestamp": record.timestamp,
+                        "model": record.model,
+                        "status": record.status,
+                        "prompt_tokens": usage.prompt_tokens if usage is not None else None,
+                        "completion_tokens": usage.completion_tokens if usage is not None else None,
+                        "cached_tokens": usage.cached_tokens if usage is not None else None,
+                    }
+                )
+                update = key_updates.setdefault(
+                    record.key_id,
+                    {"requests": 0, "last_used_at": None, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0},
+                )
+                update["requests"] += 1
+                if usage is not None:
+                    update["prompt_tokens"] += usage.prompt_tokens
+                    update["completion_tokens"] += usage.completion_tokens
+                    update["cached_tokens"] += usage.cached_tokens
+                if record.touch_last_used:
+                    update["last_used_at"] = record.timestamp
+
+            started_at = time.monotonic()
+            try:
+                await db.write_api_usage_batch(log_rows, key_updates)
+            except Exception as e:
+                self.failed_flushes += 1
+                self._pending.extendleft(reversed(batch))
+                logger.error(f"批量写入 {len(batch)} 条使用记录失败: {e}")
+                return False
+
+            self.flushes += 1
+            self.written += len(batch)
+            self.last_flush_rows = len(batch)
+            self.last_flush_duration = time.monotonic() - started_at
+            self.last_flush_lag = started_at - batch[0].enqueued_at
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        oldest_age = time.monotonic() - self._pending[0].enqueued_at if self._pending else 0.0
+        return {
+            "flush_interval_ms": round(self.flush_interval_seconds * 1000),
+            "batch_size": self.batch_size,
+            "max_pending": self.max_pending,
+            "pending": self.pending_count(),
+            "oldest_pending_age_ms": round(oldest_age * 1000, 1),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_duration_ms": round(self.last_flush_duration * 1000, 1),
+            "last_flush_lag_ms": round(self.last_flush_lag * 1000, 1),
+        }
+
+
+writer = UsageWriter(
+    flush_interval_seconds=config.USAGE_WRITER_FLUSH_INTERVAL_MS / 1000,
+    batch_size=config.USAGE_WRITER_BATCH_SIZE,
+    max_pending=config.USAGE_WRITER_MAX_PENDING,
+)
@@ -1,7 +1,8 @@
-import itertools
+import json
+import re
 from datetime import datetime, timedelta
 from collections import deque
-from typing import Dict, Any, Optional, Deque
+from typing import Dict, Any, Optional, Deque, Tuple
 from jose import jwt
 from datetime import datetime, timedelta
 import asyncio
@@ -9,68 +10,158 @@ import asyncio
 from . import database as db
 from . import config
 from . import logger
+from . import usage_writer
+from . import key_scheduler
+from . import token_usage
 
 # API密钥轮换和使用情况跟踪的全局状态
-_active_key_configs_cycle = itertools.cycle([])
 api_key_usage: Dict[str, Deque[datetime]] = {}
 MAX_TIMESTAMPS_PER_KEY = 10000
 USAGE_WINDOW_SECONDS = 24 * 60 * 60
-_key_cycle_lock = asyncio.Lock()  # 添加异步锁用于保护key循环访问
+# 流式请求首字节时间（TTFT，秒）跟踪
+api_key_ttft: Dict[str, Deque[float]] = {}
+MAX_TTFT_SAMPLES_PER_KEY = 100
 
 
-async def update_openai_key_cycle() -> int:
-    """从数据库更新活动的OpenAI API密钥循环，返回找到的活动密钥数量"""
-    global _active_key_configs_cycle
-    
+_key_pool_sync_task: Optional["asyncio.Task[int]"] = None  # 正在进行的全量同步（single-flight）
+_key_pool_resync_task: Optional["asyncio.Task[None]"] = None  # 已安排的防抖同步
+_key_pool_resync_loop_task: Optional["asyncio.Task[None]"] = None  # 定期同步任务
+
+
+async def _sync_key_pool_from_db() -> int:
     # 首先获取活动的API密钥
     active_keys = await db.get_active_api_keys()
     active_key_count = len(active_keys)
     
-    # 然后更新循环，使用锁保护以确保线程安全
-    async with _key_cycle_lock:
-        if active_keys:
-            _active_key_configs_cycle = itertools.cycle(active_keys)
-            logger.info(f"已更新OpenAI密钥循环。找到 {active_key_count} 个活动密钥。")
-        else:
-            _active_key_configs_cycle = itertools.cycle([])
-            logger.warning("在数据库中未找到用于循环的活动OpenAI密钥。")
+    # 然后与密钥池同步（保留仍然活动的密钥的状态和轮询位置）。
+    # set_keys是同步方法，执行期间不会切换协程，对选取密钥的请求而言是原子的，无需加锁
+    key_scheduler.scheduler.set_keys(active_keys)
+    if active_keys:
+        logger.info(f"已从数据库同步OpenAI密钥池。找到 {active_key_count} 个活动密钥。")
+    else:
+        logger.warning("在数据库中未找到用于调度的活动OpenAI密钥。")
     
     return active_key_count
 
 
-async def get_next_openai_key_config() -> Optional[Dict[str, Any]]:
-    """获取下一个可用的OpenAI API密钥配置，无可用密钥时返回None"""
-    global _active_key_configs_cycle
-    
-    # 先尝试获取一个密钥，使用锁以确保线程安全
-    async with _key_cycle_lock:
-        try:
-            next_key = next(_active_key_configs_cycle, None)
-            if next_key is not None:
-                return next_key
-        except (StopIteration, IndexError, ValueError):
-            # 迭代器为空或出现问题
-            logger.warning("API密钥循环为空或出错，将尝试刷新。")
+async def update_openai_key_cycle(fresh: bool = False) -> int:
+    """
+    从数据库全量同步活动的OpenAI API密钥池，返回找到的活动密钥数量；并发调用共享同一次数据库查询。
+
+    fresh为True时不复用调用之前就已开始的同步（其查询结果可能早于调用方看到的修改），等它结束后再同步一次。
+    """
+    global _key_pool_sync_task
+    if fresh and _key_pool_sync_task is not None and not _key_pool_sync_task.done():
+        await asyncio.wait([_key_pool_sync_task])
+    if _key_pool_sync_task is None or _key_pool_sync_task.done():
+        _key_pool_sync_task = asyncio.ensure_future(_sync_key_pool_from_db())
+    return await asyncio.shield(_key_pool_sync_task)
+
+
+def schedule_key_pool_resync():
+    """安排一次防抖的全量同步：防抖时间内的多次请求只触发一次数据库查询"""
+    global _key_pool_resync_task
+    if _key_pool_resync_task is None or _key_pool_resync_task.done():
+        _key_pool_resync_task = asyncio.ensure_future(_debounced_key_pool_resync())
+
+
+async def _debounced_key_pool_resync():
+    await asyncio.sleep(config.KEY_POOL_RESYNC_DEBOUNCE_SECONDS)
+    try:
+        await update_openai_key_cycle()
+    except Exception as e:
+        logger.error(f"同步OpenAI密钥池失败: {e}")
+
+
+async def _key_pool_resync_loop():
+    while True:
+        await asyncio.sleep(config.KEY_POOL_RESYNC_INTERVAL_SECONDS)
+        schedule_key_pool_resync()
+
+
+def start_key_pool_resync_loop():
+    """启动定期全量同步（作为增量更新的兜底），间隔不大于0时不启动"""
+    global _key_pool_resync_loop_task
+    if config.KEY_POOL_RESYNC_INTERVAL_SECONDS > 0 and (
+        _key_pool_resync_loop_task is None or _key_pool_resync_loop_task.done()
+    ):
+        _key_pool_resync_loop_task = asyncio.ensure_future(_key_pool_resync_loop())
+
+
+def stop_key_pool_resync_loop():
+    global _key_pool_resync_loop_task
+    for task in (_key_pool_resync_loop_task, _key_pool_resync_task):
+        if task is not None and not task.done():
+            task.cancel()
+    _key_pool_resync_loop_task = None
+
+
+def add_key_to_pool(key_config: Dict[str, Any]):
+    """将状态变为active的密钥增量加入密钥池"""
+    key_id = str(key_config["id"])
+    if (
+        config.MAX_ACTIVE_KEYS_LIMIT > 0
+        and key_id not in key_scheduler.scheduler
+        and key_scheduler.scheduler.size() >= config.MAX_ACTIVE_KEYS_LIMIT
+    ):
+        logger.warning(f"密钥池已达到活跃密钥上限 {config.MAX_ACTIVE_KEYS_LIMIT}，密钥ID {key_id} 暂不加入。")
+        return
+    key_scheduler.scheduler.add_key(key_config)
+
+
+def remove_key_from_pool(key_id: str):
+    """将被删除或状态不再是active的密钥移出密钥池"""
+    key_scheduler.scheduler.remove_key(str(key_id))
+
+
+def apply_key_status_to_pool(key_config: Dict[str, Any], status: str):
+    """根据密钥的新状态增量更新密钥池"""
+    if status == config.KEY_STATUS_ACTIVE:
+        add_key_to_pool(key_config)
+    else:
+        remove_key_from_pool(key_config["id"])
+
+
+def get_active_key_count() -> int:
+    """返回调度器中的活动密钥数量"""
+    return key_scheduler.scheduler.size()
+
+
+async def get_next_openai_key_config(model: Optional[str] = None, upstream: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    获取下一个能在upstream调用model且仍有调用额度和在途名额的OpenAI API密钥配置，无可用密钥时返回None。
+
+    所有密钥的额度都已耗尽时同样返回None，可通过key_scheduler.scheduler.next_available_in()获取最早恢复时间。
+    """
+    # 选取密钥是同步操作，不等待任何锁：在事件循环中执行期间不会被其他协程打断
+    if key_scheduler.scheduler.size() > 0:
+        return key_scheduler.scheduler.acquire(model, upstream)
+    logger.warning("API密钥调度器为空，将尝试刷新。")
     
-    # 如果没有可用的密钥，尝试从数据库刷新
-    # 注意：此处释放了锁，所以update_openai_key_cycle可以安全地获取锁
+    # 如果没有活动的密钥，尝试从数据库同步（并发请求共享同一次同步）
     active_key_count = await update_openai_key_cycle()
     
     if active_key_count > 0:
-        # 刷新后，尝试再次获取密钥
-        async with _key_cycle_lock:
-            try:
-                return next(_active_key_configs_cycle, None)
-            except (StopIteration, IndexError, ValueError):
-                logger.error("即使刷新后也没有找到活动的OpenAI API密钥。")
-                return None
+        # 同步后，尝试再次获取密钥
+        return key_scheduler.scheduler.acquire(model, upstream)
     else:
         logger.warning("数据库中没有活动的OpenAI密钥。")
         return None
 
 
-async def record_api_key_usage(key_id: str, model: Optional[str] = None, status: Optional[str] = None):
-    """记录API Key使用信息到数据库"""
+async def record_api_key_usage(
+    key_id: str,
+    model: Optional[str] = None,
+    status: Optional[str] = None,
+    touch_last_used: bool = False,
+    usage: Optional[token_usage.TokenUsage] = None,
+):
+    """
+    记录API Key使用信息，数据库写入由后台任务批量完成；touch_last_used为True时同时更新last_used_at。
+
+    usage为上游返回的Token用量，写入请求日志、累计到Key，并从调度器中该Key的TPM额度中扣减
+    （使用多进程共享计数器时同时计入所有工作进程共享的Token数）。
+    """
     try:
         # 增加内存中的计数器（兼容现有代码）
         now = datetime.utcnow()
@@ -86,15 +177,151 @@ async def record_api_key_usage(key_id: str, model: Optional[str] = None, status:
         while len(api_key_usage[key_id]) > MAX_TIMESTAMPS_PER_KEY:
             api_key_usage[key_id].popleft()
             
-        # 记录到数据库
-        await db.log_api_request(key_id, model, status)
-        
-        # 增加该密钥的total_requests计数
-        await db.increment_api_key_requests(key_id)
+        # 放入批量写入队列（请求日志和total_requests计数）
+        usage_writer.writer.enqueue(key_id, model, status, touch_last_used=touch_last_used, usage=usage)
+        if usage is not None:
+            key_scheduler.scheduler.record_tokens(key_id, usage.total_tokens)
     except Exception as e:
         logger.error(f"记录API密钥使用情况时出错: {str(e)}")
 
 
+def record_api_key_ttft(key_id: str, ttft_seconds: float):
+    """记录某个API Key的流式请求首字节时间"""
+    samples = api_key_ttft.get(key_id)
+    if samples is None:
+        samples = api_key_ttft[key_id] = deque(maxlen=MAX_TTFT_SAMPLES_PER_KEY)
+    samples.append(ttft_seconds)
+
+
+def get_api_key_ttft_stats() -> Dict[str, Dict[str, Any]]:
+    """获取每个API Key最近的流式请求首字节时间统计（毫秒）"""
+    stats = {}
+    for key_id, samples in api_key_ttft.items():
+        if not samples:
+            continue
+        sorted_samples = sorted(samples)
+        stats[key_id] = {
+            "samples": len(sorted_samples),
+            "last_ms": round(samples[-1] * 1000, 1),
+            "avg_ms": round(sum(sorted_samples) / len(sorted_samples) * 1000, 1),
+            "p50_ms": round(sorted_samples[len(sorted_samples) // 2] * 1000, 1),
+            "max_ms": round(sorted_samples[-1] * 1000, 1),
+        }
+    return stats
+
+
+# 透传模式下快速扫描请求体中字段值的模式（从键名之后开始匹配）
+_MODEL_VALUE_PATTERN = re.compile(rb'\s*:\s*"((?:[^"\\]|\\.)*)"')
+_STREAM_VALUE_PATTERN = re.compile(rb"\s*:\s*(true|false|null)")
+_NUMBER_VALUE_PATTERN = re.compile(rb"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)")
+_JSON_STRING_PATTERN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_BRACKET_PATTERN = re.compile(rb"[\[\]{}]")
+_JSON_WHITESPACE = b" \t\r\n"
+
+
+def _is_key_position(raw_body: bytes, pos: int) -> bool:
+    """pos处的引号前（跳过空白）是'{'或','，即位于对象的键位置而不在字符串内部"""
+    i = pos - 1
+    while i >= 0 and raw_body[i] in _JSON_WHITESPACE:
+        i -= 1
+    return i >= 0 and raw_body[i] in b"{,"
+
+
+def _is_top_level(raw_body: bytes, pos: int, body_end: int) -> bool:
+    """键位置pos之后到顶层对象的'}'之前，去掉字符串后括号是否配平，即该键是否属于顶层对象"""
+    tail = raw_body[pos:body_end]
+    if not _JSON_BRACKET_PATTERN.search(tail):
+        return True
+    tail = _JSON_STRING_PATTERN.sub(b"", tail)
+    return tail.count(b"{") + tail.count(b"[") == tail.count(b"}") + tail.count(b"]")
+
+
+def _scan_json_field(raw_body: bytes, quoted_key: bytes, value_pattern: "re.Pattern[bytes]") -> Tuple[Optional[bytes], bool]:
+    """
+    查找顶层对象中位于键位置（'{'或','之后）的指定键，返回 (值, 是否需要回退到完整解析)。
+
+    先在第一个嵌套对象/数组之前查找，这里的匹配必然属于顶层对象；找不到时从请求体末尾向前查找，
+    OpenAI SDK把model、stream等字段放在messages之后，通常不需要扫描messages。末尾部分的候选通过其后的括号是否配平
+    确认属于顶层对象，开销只与候选之后的长度有关；候选属于嵌套对象（tools、metadata、response_format等）时回退到完整解析。
+    请求体不是JSON对象时同样回退。
+    """
+    body_start = 0
+    while body_start < len(raw_body) and raw_body[body_start] in _JSON_WHITESPACE:
+        body_start += 1
+    body_end = len(raw_body)
+    while body_end > body_start and raw_body[body_end - 1] in _JSON_WHITESPACE:
+        body_end -= 1
+    if raw_body[body_start:body_start + 1] != b"{" or raw_body[body_end - 1:body_end] != b"}":
+        return None, True
+    body_end -= 1
+    nested_positions = [p for p in (raw_body.find(b"{", body_start + 1), raw_body.find(b"[", body_start)) if p >= 0]
+    first_nested = min(nested_positions) if nested_positions else body_end
+
+    start = body_start
+    while True:
+        pos = raw_body.find(quoted_key, start, first_nested)
+        if pos < 0:
+            break
+        start = pos + len(quoted_key)
+        if _is_key_position(raw_body, pos):
+            match = value_pattern.match(raw_body, start)
+            if match:
+                return match.group(1), False
+
+    end = body_end
+    while True:
+        pos = raw_body.rfind(quoted_key, first_nested, end)
+        if pos < 0:
+            return None, False
+        end = pos
+        if not _is_key_position(raw_body, pos):
+            continue
+        match = value_pattern.match(raw_body, pos + len(quoted_key))
+        if not match:
+            continue
+        if not _is_top_level(raw_body, pos, body_end):
+            return None, True
+        return match.group(1), False
+
+
+def sniff_chat_request_fields(raw_body: bytes) -> Tuple[Optional[str], bool]:
+    """
+    从原始请求体中快速提取model和stream字段，避免完整解析JSON。
+
+    当字段存在歧义（可能存在同名嵌套字段）或无法找到model时，回退到完整的JSON解析。
+
+    Returns:
+        (model, is_stream) 元组
+
+    Raises:
+        ValueError: 回退解析时请求体不是有效的JSON对象
+    """
+    model_raw, model_ambiguous = _scan_json_field(raw_body, b'"model"', _MODEL_VALUE_PATTERN)
+    stream_raw, stream_ambiguous = _scan_json_field(raw_body, b'"stream"', _STREAM_VALUE_PATTERN)
+
+    if model_raw is not None and not model_ambiguous and not stream_ambiguous:
+        model = json.loads(b'"' + model_raw + b'"') if b"\\" in model_raw else model_raw.decode("utf-8")
+        return model, stream_raw == b"true"
+
+    # 扫描结果不明确，回退到完整解析
+    payload = json.loads(raw_body)
+    if not isinstance(payload, dict):
+        raise ValueError("请求体必须是JSON对象")
+    model = payload.get("model")
+    return (model if isinstance(model, str) else None), payload.get("stream") is True
+
+
+def sniff_chat_request_temperature(raw_body: bytes) -> Optional[float]:
+    """从原始请求体中快速提取temperature字段，不存在时返回None；存在歧义时回退到完整的JSON解析"""
+    temperature_raw, ambiguous = _scan_json_field(raw_body, b'"temperature"', _NUMBER_VALUE_PATTERN)
+    if not ambiguous:
+        return float(temperature_raw) if temperature_raw is not None else None
+
+    payload = json.loads(raw_body)
+    temperature = payload.get("temperature") if isinstance(payload, dict) else None
+    return float(temperature) if isinstance(temperature, (int, float)) else None
+
+
 def mask_api_key_for_display(api_key: str) -> str:
     """
     将API密钥遮罩以便显示，固定长度为10个字符。
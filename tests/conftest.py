@@ -0,0 +1,163 @@
+"""
+测试公共设置
+
+gpt_proxy在导入时读取数据目录下的config.ini并初始化数据库，这里在导入前把数据目录指向临时目录，
+测试不会读写项目根目录下的data。异步测试使用anyio的pytest插件（asyncio后端）；
+需要完整代理服务的测试通过proxy_factory在子进程中启动uvicorn。
+"""
+import configparser
+import datetime
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+os.environ.setdefault("GPT_PROXY_DATA_DIR", tempfile.mkdtemp(prefix="gpt_proxy_test_"))
+
+import httpx
+import pytest
+
+from .stub_upstream import StubUpstream, free_port
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+PROXY_API_KEY = "sk-proxy-test"
+
+
+class ProxyProcess:
+    """在子进程中运行的代理服务，使用独立的数据目录"""
+
+    def __init__(self, data_dir: Path, sections: Dict[str, Dict[str, str]], keys: List[Dict[str, Optional[str]]]):
+        self.data_dir = data_dir
+        self.port = free_port()
+        self.env = {**os.environ, "GPT_PROXY_DATA_DIR": str(data_dir)}
+        self._write_config(sections)
+        self._seed_keys(keys)
+        self._process: Optional[subprocess.Popen] = None
+        self._log = None
+        self.client = httpx.Client(
+            base_url=self.base_url, headers={"Authorization": f"Bearer {PROXY_API_KEY}"}, timeout=10
+        )
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _write_config(self, sections: Dict[str, Dict[str, str]]):
+        parser = configparser.ConfigParser()
+        parser["proxy_auth"] = {"api_keys": PROXY_API_KEY}
+        parser["jwt"] = {"secret_key": "test-secret"}
+        parser["HTTP_Client"] = {"http2": "false"}
+        for name, values in sections.items():
+            parser[name] = values
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.data_dir / "config.ini", "w") as config_file:
+            parser.write(config_file)
+
+    def _seed_keys(self, keys: List[Dict[str, Optional[str]]]):
+        # 导入数据库模块即创建表结构，然后直接写入Key
+        subprocess.run(
+            [sys.executable, "-c", "import gpt_proxy.database"], cwd=PROJECT_ROOT, env=self.env, check=True, capture_output=True
+        )
+        connection = sqlite3.connect(self.data_dir / "gpt_proxy.db")
+        for key in keys:
+            connection.execute(
+                "INSERT INTO openai_keys (id, api_key, status, created_at, total_requests, name, upstream) "
+                "VALUES (?, ?, 'active', ?, 0, ?, ?)",
+                (str(uuid.uuid4()), key["api_key"], datetime.datetime.now(), key.get("name"), key.get("upstream")),
+            )
+        connection.commit()
+        connection.close()
+
+    def start(self):
+        self._log = open(self.data_dir / "proxy.log", "wb")
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "gpt_proxy.main:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            cwd=PROJECT_ROOT,
+            env=self.env,
+            stdout=self._log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"代理进程启动失败: {self.read_log()}")
+            try:
+                if self.client.get("/health/ready", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"代理进程启动超时: {self.read_log()}")
+
+    def stop(self):
+        self.client.close()
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._log is not None:
+            self._log.close()
+
+    def read_log(self) -> str:
+        return (self.data_dir / "proxy.log").read_text(errors="replace")
+
+    def chat(self, model: str, content: str, **kwargs) -> httpx.Response:
+        return self.client.post(
+            "/v1/chat/completions", json={"model": model, "messages": [{"role": "user", "content": content}], **kwargs}
+        )
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def database():
+    """连接临时数据目录中的数据库，清空Key相关的表"""
+    from gpt_proxy import database as db
+
+    await db.connect_to_db()
+    for table in (db.openai_keys, db.key_pool_changes, db.key_leases):
+        await db.database.execute(table.delete())
+    yield db
+    await db.disconnect_from_db()
+
+
+@pytest.fixture(scope="module")
+def stub_upstreams():
+    """三个本地上游：a和b提供gpt-4o-mini，c提供上游名为meta-llama-3-8b的模型"""
+    stubs = {
+        "a": StubUpstream("a"),
+        "b": StubUpstream("b"),
+        "c": StubUpstream("c", models=("meta-llama-3-8b",)),
+    }
+    for stub in stubs.values():
+        stub.start()
+    yield stubs
+    for stub in stubs.values():
+        stub.stop()
+
+
+@pytest.fixture
+def proxy_factory(tmp_path):
+    """按给定的配置部分和Key启动代理子进程，测试结束后停止"""
+    processes: List[ProxyProcess] = []
+
+    def start(sections: Dict[str, Dict[str, str]], keys: List[Dict[str, Optional[str]]]) -> ProxyProcess:
+        process = ProxyProcess(tmp_path / f"proxy-{len(processes)}", sections, keys)
+        processes.append(process)
+        process.start()
+        return process
+
+    yield start
+    for process in processes:
+        process.stop()
@@ -0,0 +1,118 @@
+"""
+测试用的本地上游
+
+StubUpstream在后台线程中运行一个OpenAI兼容的HTTP服务（/v1/models 和 /v1/chat/completions），
+记录收到的聊天请求，并可以切换健康检查和聊天接口返回的状态码，用于模拟上游故障和恢复。
+"""
+import json
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+def free_port() -> int:
+    """返回一个当前未被占用的本地端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubUpstream:
+    """本地OpenAI兼容上游"""
+
+    def __init__(self, name: str, models: Sequence[str] = ("gpt-4o-mini",)):
+        self.name = name
+        self.models = list(models)
+        self.port = free_port()
+        self.chat_requests: List[Dict[str, Any]] = []  # 收到的聊天请求体
+        self.models_status = 200  # /v1/models（健康检查）返回的状态码
+        self.chat_status = 200  # /v1/chat/completions 返回的状态码
+        self.probes_ok = 0
+        self.probes_failed = 0
+
+        app = Starlette(
+            routes=[
+                Route("/v1/models", self._models),
+                Route("/v1/chat/completions", self._chat, methods=["POST"]),
+            ]
+        )
+        self._server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="off")
+        )
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def config_section(self, weight: int = 1, models: str = "", model_map: str = "") -> Dict[str, str]:
+        """该上游在config.ini中的 [Upstream:名称] 部分"""
+        return {
+            "chat_completions_url": f"{self.base_url}/chat/completions",
+            "models_url": f"{self.base_url}/models",
+            "weight": str(weight),
+            "models": models,
+            "model_map": model_map,
+        }
+
+    def reset(self):
+        self.chat_requests.clear()
+        self.models_status = 200
+        self.chat_status = 200
+        self.probes_ok = 0
+        self.probes_failed = 0
+
+    @property
+    def hits(self) -> int:
+        return len(self.chat_requests)
+
+    async def _models(self, request: Request):
+        if self.models_status >= 400:
+            self.probes_failed += 1
+            return JSONResponse({"error": {"message": "stub unavailable"}}, status_code=self.models_status)
+        self.probes_ok += 1
+        return JSONResponse({"object": "list", "data": [{"id": model, "object": "model"} for model in self.models]})
+
+    async def _chat(self, request: Request):
+        payload = json.loads(await request.body())
+        self.chat_requests.append(payload)
+        if self.chat_status != 200:
+            return JSONResponse({"error": {"message": "stub unavailable"}}, status_code=self.chat_status)
+        return JSONResponse(
+            {
+                "id": f"chatcmpl-{self.name}-{len(self.chat_requests)}",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "upstream": self.name,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6},
+            },
+            headers={
+                "x-request-id": f"req-{self.name}-{len(self.chat_requests)}",
+                "openai-processing-ms": "1",
+                "x-ratelimit-limit-requests": "10000",
+                "x-ratelimit-remaining-requests": str(10000 - len(self.chat_requests)),
+                "x-ratelimit-reset-requests": "1s",
+            },
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.run, name=f"stub-upstream-{self.name}", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"本地上游 {self.name} 启动超时")
+            time.sleep(0.02)
+
+    def stop(self):
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=5)
@@ -0,0 +1,140 @@
+"""
+优雅关闭测试：排空期间拒绝新请求、就绪检查、排空超时后取消请求，以及应用关闭流程复用uvicorn关闭时开始的排空
+"""
+import asyncio
+import signal
+import time
+
+import httpx
+import pytest
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from gpt_proxy import drain
+
+pytestmark = pytest.mark.anyio
+
+
+class SlowApp:
+    """聊天补全接口等待release后才返回的应用，外面包一层DrainMiddleware"""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        app = Starlette(
+            routes=[
+                Route("/v1/chat/completions", self._chat, methods=["POST"]),
+                Route("/v1/models", self._models),
+            ]
+        )
+        self.asgi = drain.DrainMiddleware(app)
+
+    async def _chat(self, request):
+        self.started.set()
+        await self.release.wait()
+        return JSONResponse({"ok": True})
+
+    async def _models(self, request):
+        return JSONResponse({"object": "list", "data": []})
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=self.asgi), base_url="http://proxy")
+
+
+@pytest.fixture
+def make_controller(monkeypatch):
+    """用新的DrainController替换模块中的单例"""
+
+    def make(drain_timeout_seconds: float = 5.0) -> drain.DrainController:
+        controller = drain.DrainController(drain_timeout_seconds)
+        controller.ready = True
+        monkeypatch.setattr(drain, "controller", controller)
+        return controller
+
+    return make
+
+
+async def test_new_requests_get_503_with_connection_close(make_controller):
+    controller = make_controller()
+    app = SlowApp()
+    async with app.client() as client:
+        assert (await client.get("/v1/models")).status_code == 200
+        assert controller.in_flight == 0  # 只统计聊天补全请求
+
+        controller.begin()
+        for response in (await client.post("/v1/chat/completions", json={}), await client.get("/v1/models")):
+            assert response.status_code == 503
+            assert response.headers["connection"] == "close"
+            assert response.headers["retry-after"] == "1"
+        assert controller.rejected == 2
+        assert not app.started.is_set()
+
+
+async def test_readiness_flips_to_503_when_draining(database, make_controller):
+    from gpt_proxy import main
+
+    controller = make_controller()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        ready = await client.get("/health/ready")
+        assert ready.status_code == 200 and ready.json()["status"] == "ready"
+
+        controller.begin()
+        not_ready = await client.get("/health/ready")
+        assert not_ready.status_code == 503 and not_ready.json()["status"] == "draining"
+        # 存活检查在排空期间仍返回200
+        live = await client.get("/health/live")
+        assert live.status_code == 200 and live.json()["draining"] is True
+
+
+async def test_in_flight_requests_are_cancelled_after_drain_timeout(make_controller):
+    controller = make_controller(drain_timeout_seconds=0.2)
+    app = SlowApp()
+    async with app.client() as client:
+        request = asyncio.ensure_future(client.post("/v1/chat/completions", json={}))
+        await asyncio.wait_for(app.started.wait(), timeout=5)
+        assert controller.in_flight == 1
+
+        started_at = time.monotonic()
+        assert await controller.drain() is False
+        assert 0.2 <= time.monotonic() - started_at < 2
+        assert controller.cancelled == 1
+        assert controller.in_flight == 0
+        with pytest.raises(asyncio.CancelledError):
+            await request
+
+
+async def test_shutdown_event_reuses_drain_started_by_server_shutdown(make_controller, monkeypatch):
+    controller = make_controller()
+    app = SlowApp()
+    server = uvicorn.Server(uvicorn.Config(app.asgi))
+    original_shutdown_calls = []
+
+    async def original_shutdown(sockets=None):
+        # uvicorn在这里等待在途连接结束；包装后的shutdown在此之前已经开始排空
+        original_shutdown_calls.append(controller.draining)
+
+    server.shutdown = original_shutdown
+    monkeypatch.setattr(drain.signal, "getsignal", lambda signum: server.handle_exit if signum == signal.SIGTERM else None)
+    controller.attach_to_server()
+
+    async with app.client() as client:
+        request = asyncio.ensure_future(client.post("/v1/chat/completions", json={}))
+        await asyncio.wait_for(app.started.wait(), timeout=5)
+
+        await server.shutdown()
+        assert original_shutdown_calls == [True]
+        drain_task = controller._drain_task
+        assert drain_task is not None and not drain_task.done()
+
+        # 应用关闭流程（shutdown_event）中的drain()等待同一次排空，而不是重新开始
+        shutdown_drain = asyncio.ensure_future(controller.drain())
+        await asyncio.sleep(0.05)
+        assert not shutdown_drain.done()
+        app.release.set()
+        assert await asyncio.wait_for(shutdown_drain, timeout=5) is True
+        assert controller._drain_task is drain_task
+        assert (await request).status_code == 200
+        assert controller.cancelled == 0
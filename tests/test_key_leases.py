@@ -0,0 +1,81 @@
+"""
+多节点Key租约测试：三个KeyLeaseManager（各自的调度器）共用同一个数据库，续约使用database中的租约SQL
+"""
+import asyncio
+import time
+
+import pytest
+
+from gpt_proxy import key_leases
+from gpt_proxy import key_scheduler
+
+pytestmark = pytest.mark.anyio
+
+TTL_SECONDS = 1.0
+RENEW_INTERVAL_SECONDS = 0.1
+CALLS_PER_KEY = 90
+
+
+async def _wait_until(condition, timeout: float = 5.0, message: str = "等待条件超时"):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail(message)
+        await asyncio.sleep(0.02)
+
+
+@pytest.fixture
+async def nodes(database):
+    managers = [
+        key_leases.KeyLeaseManager(
+            enabled=True,
+            node_id=f"node-{index}",
+            ttl_seconds=TTL_SECONDS,
+            renew_interval_seconds=RENEW_INTERVAL_SECONDS,
+            scheduler=key_scheduler.KeyScheduler(capacity=CALLS_PER_KEY, window_seconds=60),
+        )
+        for index in range(3)
+    ]
+    for manager in managers:
+        await manager.start()
+    yield managers
+    for manager in managers:
+        await manager.stop()
+
+
+def _shares(managers):
+    return [manager.share for manager in managers]
+
+
+async def test_shares_converge_and_rebalance(database, nodes):
+    # 先启动的节点在下一次续约时才看到后加入的节点
+    await _wait_until(lambda: _shares(nodes) == [1 / 3] * 3, message=f"份额未收敛到1/3: {_shares(nodes)}")
+    assert [manager.scheduler.capacity for manager in nodes] == [CALLS_PER_KEY / 3] * 3
+    assert [lease["node_id"] for lease in await database.get_key_leases()] == ["node-0", "node-1", "node-2"]
+
+    # 正常退出：删除租约，其余节点在一个续约间隔内平分额度
+    leaving = nodes.pop()
+    await leaving.stop()
+    await _wait_until(lambda: _shares(nodes) == [1 / 2] * 2, message=f"节点退出后份额未调整: {_shares(nodes)}")
+    assert [manager.scheduler.capacity for manager in nodes] == [CALLS_PER_KEY / 2] * 2
+
+
+async def test_crashed_node_lease_lapses_after_ttl(database, nodes):
+    await _wait_until(lambda: _shares(nodes) == [1 / 3] * 3, message=f"份额未收敛到1/3: {_shares(nodes)}")
+
+    # 异常退出：停止续约但不删除租约
+    crashed = nodes.pop()
+    crashed._renew_task.cancel()
+    crashed_at = time.monotonic()
+
+    await asyncio.sleep(TTL_SECONDS / 2)
+    assert _shares(nodes) == [1 / 3] * 2, "租约有效期内不应重新分配额度"
+
+    await _wait_until(lambda: _shares(nodes) == [1 / 2] * 2, message=f"租约过期后份额未调整: {_shares(nodes)}")
+    assert time.monotonic() - crashed_at >= TTL_SECONDS - RENEW_INTERVAL_SECONDS
+    assert "node-2" not in nodes[0].live_nodes
+
+    # 过期的行在下一个节点启动时被清理
+    await asyncio.sleep(TTL_SECONDS * 1.5)
+    assert await database.delete_expired_key_leases(TTL_SECONDS) == 1
+    await crashed.stop()
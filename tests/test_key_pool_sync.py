@@ -0,0 +1,82 @@
+"""
+多进程密钥池同步测试：其他进程只修改数据库（通过database中的函数），本进程的KeyPoolSync按变更记录更新密钥池
+"""
+import pytest
+
+from gpt_proxy import config
+from gpt_proxy import key_pool_sync
+from gpt_proxy import key_scheduler
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def pool_sync(database):
+    sync = key_pool_sync.KeyPoolSync(poll_interval_seconds=0, listen=False, max_incremental_changes=10)
+    key_scheduler.scheduler.set_keys([])
+    await sync.check()  # 第一次检查全量同步，记录当前版本号
+    return sync
+
+
+def _forbid_full_resync(database, monkeypatch):
+    async def fail():
+        raise AssertionError("不应从数据库全量同步密钥池")
+
+    monkeypatch.setattr(database, "get_active_api_keys", fail)
+
+
+async def test_single_key_changes_are_applied_in_place(database, pool_sync, monkeypatch):
+    stopped, rebound, deleted = [await database.add_api_key(f"sk-sync-{index}") for index in range(3)]
+    assert await pool_sync.check()
+    assert pool_sync.incremental_updates == 1
+
+    _forbid_full_resync(database, monkeypatch)
+    await database.update_api_key_status(stopped, config.KEY_STATUS_INACTIVE)
+    await database.update_api_key_upstream(rebound, "other")
+    await database.delete_api_key(deleted)
+    added = await database.add_api_key("sk-sync-new")
+    assert await pool_sync.check()
+
+    scheduler = key_scheduler.scheduler
+    assert stopped not in scheduler and deleted not in scheduler
+    assert scheduler.upstream_of(rebound) == "other"
+    assert added in scheduler
+    assert pool_sync.resyncs == 0
+    assert pool_sync.keys_updated == 7
+
+    await database.update_api_key_status(stopped, config.KEY_STATUS_ACTIVE)
+    assert await pool_sync.check()
+    assert stopped in scheduler
+
+
+async def test_bulk_changes_fall_back_to_full_resync(database, pool_sync):
+    key_ids = [await database.add_api_key(f"sk-bulk-{index}") for index in range(pool_sync.max_incremental_changes + 1)]
+    assert await pool_sync.check()
+
+    assert pool_sync.resyncs == 1 and pool_sync.incremental_updates == 0
+    assert all(key_id in key_scheduler.scheduler for key_id in key_ids)
+
+
+async def test_missing_change_records_fall_back_to_full_resync(database, pool_sync):
+    key_id = await database.add_api_key("sk-pruned")
+    await database.database.execute(database.key_pool_changes.delete())
+    assert await pool_sync.check()
+
+    assert pool_sync.resyncs == 1
+    assert key_id in key_scheduler.scheduler
+
+
+async def test_key_write_rolls_back_with_failed_version_bump(database, monkeypatch):
+    key_id = await database.add_api_key("sk-atomic")
+    version = await database.get_key_pool_version()
+
+    async def fail(key_id=None, status=None):
+        raise RuntimeError("模拟写入变更记录失败")
+
+    monkeypatch.setattr(database, "bump_key_pool_version", fail)
+    with pytest.raises(RuntimeError):
+        await database.update_api_key_status(key_id, config.KEY_STATUS_INACTIVE)
+
+    # Key的修改和版本号在同一事务中，其他进程不会看到没有变更记录的修改
+    assert (await database.get_api_key_by_id(key_id))["status"] == config.KEY_STATUS_ACTIVE
+    assert await database.get_key_pool_version() == version
@@ -0,0 +1,171 @@
+"""
+Key调度器单元测试：令牌耗尽与恢复顺序、冷却到期、删除仍在队列或最小堆中的Key、按模型和上游分组的可用Key，
+以及在途请求上限。调度器的时钟替换为可手动推进的FakeClock。
+"""
+import asyncio
+
+import pytest
+
+from gpt_proxy import key_scheduler
+
+
+class FakeClock:
+    """替换key_scheduler模块中的time，monotonic()返回手动推进的时间"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(key_scheduler, "time", fake)
+    return fake
+
+
+def _scheduler(key_ids, capacity: int = 0, window_seconds: float = 10.0, **kwargs) -> key_scheduler.KeyScheduler:
+    scheduler = key_scheduler.KeyScheduler(capacity=capacity, window_seconds=window_seconds, **kwargs)
+    for key_id in key_ids:
+        scheduler.add_key({"id": key_id, "api_key": f"sk-{key_id}"})
+    return scheduler
+
+
+def _acquire_id(scheduler: key_scheduler.KeyScheduler, model=None, upstream=None):
+    key_config = scheduler.acquire(model, upstream)
+    if key_config is None:
+        return None
+    scheduler.release(key_config["id"])
+    return key_config["id"]
+
+
+def test_exhausted_keys_recover_in_exhaustion_order(clock):
+    # 每个Key每10秒1次，补充一个令牌需要10秒
+    scheduler = _scheduler(["k0", "k1", "k2"], capacity=1)
+    for key_id in ["k0", "k1", "k2"]:
+        assert _acquire_id(scheduler) == key_id
+        clock.advance(1)
+
+    assert scheduler.acquire() is None
+    assert scheduler.throttled_picks == 1
+    assert scheduler.next_available_in() == pytest.approx(7.0)  # k0在t=0耗尽，t=10恢复；当前t=3
+    assert scheduler.stats()["exhausted_keys"] == 3
+
+    clock.advance(7.5)
+    assert _acquire_id(scheduler) == "k0"
+    assert scheduler.acquire() is None
+    assert scheduler.next_available_in() == pytest.approx(0.5)
+
+    clock.advance(2)
+    assert [_acquire_id(scheduler) for _ in range(2)] == ["k1", "k2"]
+    assert scheduler.acquire() is None
+
+
+def test_cooldown_expires_and_backs_off(clock):
+    scheduler = _scheduler(["a", "b"], cooldown_base_seconds=1.0)
+
+    assert scheduler.cooldown("a") == 1.0
+    assert [_acquire_id(scheduler) for _ in range(3)] == ["b", "b", "b"]
+    clock.advance(1)
+    assert {_acquire_id(scheduler) for _ in range(2)} == {"a", "b"}
+
+    # 连续冷却按指数退避，且不短于上游给出的Retry-After
+    assert scheduler.cooldown("a") == 2.0
+    assert scheduler.cooldown("b", retry_after_seconds=5.0) == 5.0
+    assert scheduler.acquire() is None
+    assert scheduler.next_available_in() == pytest.approx(2.0)
+    clock.advance(2)
+    assert [_acquire_id(scheduler) for _ in range(2)] == ["a", "a"]
+
+    # 调用成功后退避重置
+    scheduler.record_success("a")
+    assert scheduler.cooldown("a") == 1.0
+
+
+def test_removed_key_is_dropped_from_ready_queue_and_heap(clock):
+    scheduler = _scheduler(["a", "b", "c"])
+    scheduler.cooldown("b", retry_after_seconds=5.0)
+
+    assert scheduler.remove_key("a")  # 仍在就绪队列中
+    assert scheduler.remove_key("b")  # 仍在最小堆中
+    assert scheduler.stats()["exhausted_keys"] == 0
+    assert scheduler.next_available_in() is None
+    assert [_acquire_id(scheduler) for _ in range(3)] == ["c", "c", "c"]
+
+    clock.advance(5)
+    assert [_acquire_id(scheduler) for _ in range(3)] == ["c", "c", "c"]
+
+    # 重新加入的Key只有新条目，旧的队列和堆条目不会让它被选取两次
+    scheduler.add_key({"id": "a", "api_key": "sk-a"})
+    scheduler.add_key({"id": "b", "api_key": "sk-b"})
+    assert sorted(_acquire_id(scheduler) for _ in range(6)) == ["a", "a", "b", "b", "c", "c"]
+
+
+def test_eligible_count_and_next_available_in_per_model_and_upstream(clock):
+    scheduler = key_scheduler.KeyScheduler(capacity=0, window_seconds=10.0)
+    scheduler.add_key({"id": "a-4o", "api_key": "sk-1", "models": ["gpt-4o"], "upstream": "a"})
+    scheduler.add_key({"id": "a-any", "api_key": "sk-2", "models": None, "upstream": "a"})
+    scheduler.add_key({"id": "b-4o", "api_key": "sk-3", "models": ["gpt-4o"], "upstream": "b"})
+    scheduler.add_key({"id": "unbound", "api_key": "sk-4"})
+
+    assert scheduler.eligible_count("gpt-4o", "a") == 3
+    assert scheduler.eligible_count("gpt-4o", "b") == 2
+    assert scheduler.eligible_count("llama3", "a") == 2
+    assert scheduler.eligible_count("llama3", "b") == 1
+    assert scheduler.eligible_count(None) == 4
+
+    scheduler.cooldown("unbound", retry_after_seconds=3.0)
+    assert scheduler.next_available_in("llama3", "b") == pytest.approx(3.0)
+    assert scheduler.next_available_in("gpt-4o", "b") is None  # b-4o仍可用
+    assert scheduler.acquire("llama3", "b") is None
+    assert _acquire_id(scheduler, "gpt-4o", "b") == "b-4o"
+
+    scheduler.cooldown("b-4o", retry_after_seconds=5.0)
+    scheduler.cooldown("a-any", retry_after_seconds=4.0)
+    assert scheduler.next_available_in("gpt-4o", "b") == pytest.approx(3.0)
+    assert scheduler.next_available_in("llama3", "a") == pytest.approx(3.0)
+    assert scheduler.next_available_in("gpt-4o", "a") is None  # a-4o仍可用
+    assert scheduler.next_available_in() is None
+
+    scheduler.cooldown("a-4o", retry_after_seconds=1.0)
+    assert scheduler.next_available_in() == pytest.approx(1.0)
+    assert scheduler.next_available_in("llama3", "a") == pytest.approx(3.0)
+
+    clock.advance(3)
+    assert _acquire_id(scheduler, "llama3", "b") == "unbound"
+    assert scheduler.next_available_in("gpt-4o", "b") is None
+    assert scheduler.eligible_count("gpt-4o", "b") == 2  # 不可用的Key仍计入
+
+
+def test_saturated_key_is_parked_until_release(clock):
+    scheduler = _scheduler(["a", "b"], max_in_flight_per_key=1)
+
+    first, second = scheduler.acquire(), scheduler.acquire()
+    assert {first["id"], second["id"]} == {"a", "b"}
+    assert scheduler.acquire() is None
+    assert scheduler.next_available_in() is None  # 不是额度耗尽，应等待release
+    assert scheduler.in_flight_by_key() == {"a": 1, "b": 1}
+
+    scheduler.release(first["id"])
+    assert scheduler.acquire()["id"] == first["id"]
+    assert scheduler.acquire() is None
+
+
+@pytest.mark.anyio
+async def test_release_wakes_waiters():
+    scheduler = _scheduler(["a"], max_in_flight_per_key=1)
+    key_config = scheduler.acquire()
+    event = scheduler.released_event()
+
+    waiter = asyncio.ensure_future(event.wait())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    scheduler.release(key_config["id"])
+    await asyncio.wait_for(waiter, timeout=1)
+    assert scheduler.released_event() is not event  # 每次release后换成新的事件
@@ -0,0 +1,42 @@
+"""
+透传模式请求体扫描测试：sniff_chat_request_fields的结果应与完整解析JSON一致，与字段顺序无关
+"""
+import json
+
+import pytest
+
+from gpt_proxy import utils
+
+MESSAGES = [{"role": "user", "content": 'say "model": "evil", "stream": true ] } ['}]
+TOOLS = [{"type": "function", "function": {"name": "f", "parameters": {"model": "inner", "stream": True}}}]
+
+
+def _expected(raw_body: bytes):
+    payload = json.loads(raw_body)
+    model = payload.get("model")
+    return (model if isinstance(model, str) else None), payload.get("stream") is True
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"model": "gpt-4o-mini", "temperature": 0, "messages": MESSAGES},
+        {"model": "gpt-4o-mini", "messages": MESSAGES, "stream": True},
+        {"messages": MESSAGES, "model": "gpt-4o-mini"},
+        {"messages": MESSAGES, "model": "gpt-4o-mini", "stream": True, "stream_options": {"include_usage": True}},
+        {"messages": MESSAGES, "model": "gpt-4o-mini", "stream": False, "tools": TOOLS},
+        {"messages": MESSAGES, "tools": TOOLS, "model": "gpt-4o-mini"},
+        {"metadata": {"model": "inner", "stream": True}, "model": "outer"},
+        {"messages": MESSAGES, "response_format": {"type": "json_schema", "stream": True}},
+        {"user": "[", "model": "café \"1\"", "messages": []},
+    ],
+)
+@pytest.mark.parametrize("separators", [(",", ":"), (", ", ": ")])
+def test_sniff_matches_full_parse(payload, separators):
+    raw_body = json.dumps(payload, separators=separators).encode("utf-8")
+    assert utils.sniff_chat_request_fields(raw_body) == _expected(raw_body)
+
+
+def test_sniff_rejects_non_object_body():
+    with pytest.raises(ValueError):
+        utils.sniff_chat_request_fields(b'["model", "stream"]')
@@ -0,0 +1,28 @@
+"""
+响应缓存端到端测试：代理子进程 + 本地上游
+"""
+
+
+def test_cache_hit_does_not_replay_per_request_headers(stub_upstreams, proxy_factory):
+    stub = stub_upstreams["a"]
+    stub.reset()
+    proxy = proxy_factory(
+        {"Response_Cache": {"enabled": "true"}, "Upstream:a": stub.config_section()},
+        [{"api_key": "sk-cache", "upstream": "a"}],
+    )
+
+    miss = proxy.chat("gpt-4o-mini", "cached", temperature=0)
+    assert miss.status_code == 200
+    assert miss.headers["x-proxy-cache"] == "MISS"
+    assert miss.headers["x-request-id"] == "req-a-1"
+    assert miss.headers["x-ratelimit-remaining-requests"] == "9999"
+
+    hit = proxy.chat("gpt-4o-mini", "cached", temperature=0)
+    assert hit.status_code == 200
+    assert hit.headers["x-proxy-cache"] == "HIT"
+    assert hit.content == miss.content
+    assert hit.headers["content-type"] == miss.headers["content-type"]
+    assert "x-request-id" not in hit.headers
+    assert "openai-processing-ms" not in hit.headers
+    assert not [name for name in hit.headers if name.startswith("x-ratelimit-")]
+    assert stub.hits == 1
@@ -0,0 +1,137 @@
+"""
+多上游端到端测试：代理子进程 + 本地上游
+
+覆盖按权重选择上游、每个上游的模型名映射、主动健康检查剔除与恢复，以及熔断器的被动异常剔除。
+"""
+import time
+import uuid
+
+import pytest
+
+PROBE_INTERVAL_SECONDS = 0.2
+
+
+def _wait_until(condition, timeout: float = 10.0, message: str = "等待条件超时"):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail(message)
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def proxy(stub_upstreams, proxy_factory):
+    """a（权重3）和b（权重1）提供gpt-4o-mini，c只提供llama3并映射为meta-llama-3-8b；每个上游绑定一个Key"""
+    for stub in stub_upstreams.values():
+        stub.reset()
+    sections = {
+        "App": {"max_retries": "3", "log_level": "warning"},
+        "Retry_Policy": {"backoff_base_seconds": "0.01", "backoff_max_seconds": "0.02"},
+        "Upstreams": {
+            "health_check_interval_seconds": str(PROBE_INTERVAL_SECONDS),
+            "health_check_timeout_seconds": "1",
+            "unhealthy_threshold": "2",
+            "healthy_threshold": "1",
+        },
+        "Circuit_Breaker": {"failure_threshold": "2", "open_seconds": "60"},
+        "Upstream:a": stub_upstreams["a"].config_section(weight=3, models="gpt-4o-mini"),
+        "Upstream:b": stub_upstreams["b"].config_section(weight=1, models="gpt-4o-mini"),
+        "Upstream:c": stub_upstreams["c"].config_section(models="llama3", model_map="llama3=meta-llama-3-8b"),
+    }
+    keys = [{"api_key": f"sk-test-{name}", "name": name, "upstream": name} for name in stub_upstreams]
+    return proxy_factory(sections, keys)
+
+
+def _send(proxy, count: int, model: str = "gpt-4o-mini"):
+    responses = [proxy.chat(model, f"hello {uuid.uuid4()}") for _ in range(count)]
+    assert [response.status_code for response in responses] == [200] * count, responses[-1].text
+    return responses
+
+
+def test_weighted_selection_across_upstreams(proxy, stub_upstreams):
+    responses = _send(proxy, 200)
+
+    served_by = [response.json()["upstream"] for response in responses]
+    share_a = served_by.count("a") / len(served_by)
+    assert 0.6 <= share_a <= 0.9, f"权重3:1时a的占比为{share_a}"
+    assert served_by.count("b") > 0
+    assert stub_upstreams["c"].hits == 0  # c不提供gpt-4o-mini
+
+
+def test_model_mapping_per_upstream(proxy, stub_upstreams):
+    responses = _send(proxy, 5, model="llama3")
+
+    assert {response.json()["upstream"] for response in responses} == {"c"}
+    assert [request["model"] for request in stub_upstreams["c"].chat_requests] == ["meta-llama-3-8b"] * 5
+    assert stub_upstreams["a"].hits == 0 and stub_upstreams["b"].hits == 0
+
+
+def test_health_probe_ejects_and_recovers_upstream(proxy, stub_upstreams):
+    stub_b = stub_upstreams["b"]
+    stub_b.models_status = 500
+    _wait_until(lambda: stub_b.probes_failed >= 3, message="上游b未收到健康检查")
+
+    _send(proxy, 40)
+    assert stub_b.hits == 0, "健康检查失败的上游仍被选择"
+
+    stub_b.models_status = 200
+    probes_before = stub_b.probes_ok
+    _wait_until(lambda: stub_b.probes_ok >= probes_before + 2, message="上游b恢复后未收到健康检查")
+
+    _send(proxy, 80)
+    assert stub_b.hits > 0, "健康检查恢复后上游未重新被选择"
+
+
+def test_circuit_breaker_ejects_failing_upstream(proxy, stub_upstreams):
+    stub_b = stub_upstreams["b"]
+    stub_b.chat_status = 503
+
+    # 每个请求在b返回503后换到a重试，客户端始终得到200；b累计失败两次后熔断
+    for _ in range(200):
+        _send(proxy, 1)
+        if stub_b.hits >= 2:
+            break
+    assert stub_b.hits == 2
+
+    _send(proxy, 40)
+    assert stub_b.hits == 2, "熔断中的上游仍被选择"
+    assert stub_b.probes_ok > 0  # 健康检查仍然通过，剔除来自熔断器
+
+
+def test_half_open_probe_is_taken_only_before_send(monkeypatch):
+    from gpt_proxy import circuit_breaker, key_scheduler, upstreams
+
+    monkeypatch.setattr(
+        circuit_breaker,
+        "breakers",
+        circuit_breaker.CircuitBreakerRegistry(enabled=True, failure_threshold=1, open_seconds=60, half_open_max_probes=1),
+    )
+    monkeypatch.setattr(key_scheduler, "scheduler", key_scheduler.KeyScheduler(capacity=0, window_seconds=60))
+    key_scheduler.scheduler.add_key({"id": "k", "api_key": "sk-k"})
+    pool = upstreams.UpstreamPool(
+        [{"name": "a", "chat_completions_url": "http://a.test/v1/chat/completions", "models_url": "http://a.test/v1/models"}],
+        health_check_interval_seconds=0,
+        health_check_timeout_seconds=1,
+        unhealthy_threshold=1,
+        healthy_threshold=1,
+    )
+    upstream = pool.upstreams[0]
+    breaker = upstream.breaker
+    breaker.record_failure()
+    breaker.opened_at -= breaker.open_seconds  # 熔断到期，进入半开状态
+
+    # 选择上游不占用探测名额：请求没有发出（例如没有Key、排队超时）时不会遗留名额
+    for _ in range(3):
+        assert pool.select("gpt-4o-mini") is upstream
+    assert breaker.probes_in_flight == 0
+
+    upstream.begin_request()
+    assert breaker.probes_in_flight == 1
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        upstream.begin_request()
+    with pytest.raises(circuit_breaker.CircuitOpen):
+        pool.select("gpt-4o-mini")
+
+    breaker.record_success()
+    assert breaker.state == circuit_breaker.STATE_CLOSED
+    assert pool.select("gpt-4o-mini") is upstream